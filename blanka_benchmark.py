@@ -0,0 +1,314 @@
+import argparse, os, sys, json, base64, shutil, tempfile, timeit, numpy
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
+import blanka_lcms as lcms
+import blanka_maldi_dd as dd
+import blanka_run
+import blanka_profile as profile
+import blanka_spectrum
+
+benchmark_names = ['select_control_spectrum', 'noise_removal', 'noise_removal_block', 'blank_removal',
+                   'consensus_control_spectrum', 'mgf_writer', 'binary_writer', 'run_lcms', 'run_maldi_dd']
+
+def get_args():
+    parser = argparse.ArgumentParser(description='BLANKA benchmarks on synthetic data')
+    parser.add_argument('--benchmarks', help="comma separated benchmarks to run - default = all",
+                        default=','.join(benchmark_names), type=str)
+    parser.add_argument('--scans', help="number of sample scans - default = 2000", default=2000, type=int)
+    parser.add_argument('--peaks', help="peaks per scan - default = 200", default=200, type=int)
+    parser.add_argument('--ms2_ratio', help="fraction of scans that are ms2 - default = 0.5", default=0.5, type=float)
+    parser.add_argument('--control_scans', help="number of control scans - default = 2000", default=2000, type=int)
+    parser.add_argument('--spots', help="dd: number of sample spots - default = 200", default=200, type=int)
+    parser.add_argument('--control_spots', help="dd: number of control spots - default = 10", default=10, type=int)
+    parser.add_argument('--cpu', help="number of threads used by run_lcms/run_maldi_dd - default = max-1",
+                        default=max(1, cpu_count() - 1), type=int)
+    parser.add_argument('--repeat', help="best of n runs - default = 3", default=3, type=int)
+    parser.add_argument('--seed', help="random seed for synthetic data - default = 0", default=0, type=int)
+    parser.add_argument('--report', help="write results to .json file", default='', type=str)
+    parser.add_argument('--baseline', help="compare against results .json saved by --report", default='', type=str)
+    parser.add_argument('--tolerance', help="fraction slower (or more memory) than baseline reported as a \
+                                             regression - default = 0.2", default=0.2, type=float)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+def synthetic_spectra(scans, peaks, ms2_ratio, seed, shared_mz=None, shared_fraction=0.3):
+    # Spectrum objects converted from dicts in the same form as pyteomics.mzxml (big endian float32 arrays,
+    # retentionTime in minutes), the same way spectra are loaded from .mzXML files
+    # scan n at n * 0.01 min so sample and control scans line up; precursor m/z rounded to 0.1 Da so ms2 scans
+    # match control scans; shared_fraction of peaks taken from shared_mz (control m/z values) for blank removal
+    random_state = numpy.random.RandomState(seed)
+    spectra = []
+    for count in range(1, scans + 1):
+        ms_level = 2 if random_state.rand() < ms2_ratio else 1
+        if shared_mz is not None and len(shared_mz) > 0:
+            shared_count = int(peaks * shared_fraction)
+            mz_array = numpy.concatenate((random_state.uniform(100, 1000, peaks - shared_count),
+                                          random_state.choice(shared_mz, shared_count) +
+                                          random_state.uniform(-0.005, 0.005, shared_count)))
+        else:
+            mz_array = random_state.uniform(100, 1000, peaks)
+        mz_array = numpy.unique(mz_array.astype(numpy.float32))
+        intensity_array = numpy.where(random_state.rand(len(mz_array)) < 0.5,
+                                      random_state.uniform(1, 10, len(mz_array)),
+                                      random_state.uniform(100, 10000, len(mz_array)))
+        spectrum = {'num': str(count),
+                    'msLevel': ms_level,
+                    'retentionTime': count * 0.01,
+                    'm/z array': mz_array.astype('>f4'),
+                    'intensity array': intensity_array.astype('>f4')}
+        if ms_level == 2:
+            spectrum['precursorMz'] = [{'precursorMz': round(random_state.uniform(200, 220), 1),
+                                        'precursorIntensity': 1000.0}]
+        spectra.append(blanka_spectrum.from_pyteomics(spectrum))
+    return spectra
+
+def sample_control_spectra(args):
+    # synthetic control dataset and sample dataset sharing part of its peaks with the control
+    control_spectra = synthetic_spectra(args['control_scans'], args['peaks'], args['ms2_ratio'], args['seed'] + 1)
+    shared_mz = numpy.unique(numpy.concatenate([spectrum['m/z array'] for spectrum in control_spectra[:50]]))
+    sample_spectra = synthetic_spectra(args['scans'], args['peaks'], args['ms2_ratio'], args['seed'], shared_mz)
+    return sample_spectra, control_spectra
+
+def write_mzxml(path, spectra):
+    # write spectrum dicts to .mzXML (uncompressed 32 bit network byte order peaks)
+    with open(path, 'w') as mzxml_file:
+        mzxml_file.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                         '<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n'
+                         '<msRun scanCount="' + str(len(spectra)) + '">\n')
+        for spectrum in spectra:
+            peaks = numpy.empty(len(spectrum['m/z array']) * 2, dtype='>f4')
+            peaks[0::2] = spectrum['m/z array']
+            peaks[1::2] = spectrum['intensity array']
+            mzxml_file.write('<scan num="' + spectrum['num'] + '" msLevel="' + str(spectrum['msLevel']) +
+                             '" peaksCount="' + str(len(spectrum['m/z array'])) + '" polarity="+" retentionTime="PT' +
+                             repr(spectrum['retentionTime'] * 60) + 'S">\n')
+            if spectrum['msLevel'] >= 2:
+                mzxml_file.write('<precursorMz precursorIntensity="' +
+                                 repr(spectrum['precursorMz'][0]['precursorIntensity']) + '">' +
+                                 repr(spectrum['precursorMz'][0]['precursorMz']) + '</precursorMz>\n')
+            mzxml_file.write('<peaks precision="32" byteOrder="network" contentType="m/z-int" '
+                             'compressionType="none" compressedLen="0">' + base64.b64encode(peaks.tobytes()) +
+                             '</peaks>\n</scan>\n')
+        mzxml_file.write('</msRun>\n</mzXML>\n')
+
+def copy_spectra(spectra):
+    # shallow copies; benchmarked functions replace arrays in the dicts they are given
+    return [spectrum.copy() for spectrum in spectra]
+
+def bench_select_control_spectrum(args, work_dir):
+    sample_spectra, control_spectra = sample_control_spectra(args)
+    pipeline = blanka_run.get_args([])
+    control_index = lcms.build_control_index(control_spectra)
+    start = timeit.default_timer()
+    for spectrum in sample_spectra:
+        if spectrum['msLevel'] > 1:
+            precursor_mz = spectrum['precursorMz'][0]['precursorMz']
+        else:
+            precursor_mz = None
+        lcms.select_control_spectrum(pipeline, spectrum['msLevel'], spectrum['retentionTime'] * 60, precursor_mz,
+                                     control_index)
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_noise_removal(args, work_dir):
+    sample_spectra = copy_spectra(sample_control_spectra(args)[0])
+    start = timeit.default_timer()
+    for spectrum in sample_spectra:
+        lcms.noise_removal(4, 5, spectrum)
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_noise_removal_block(args, work_dir):
+    sample_spectra = copy_spectra(sample_control_spectra(args)[0])
+    start = timeit.default_timer()
+    for count in range(0, len(sample_spectra), 200):
+        lcms.noise_removal_block(4, 5, sample_spectra[count:count + 200])
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_blank_removal(args, work_dir):
+    sample_spectra, control_spectra = sample_control_spectra(args)
+    control_index = lcms.build_control_index(control_spectra)
+    pipeline = blanka_run.get_args([])
+    pairs = []
+    for spectrum in sample_spectra:
+        if spectrum['msLevel'] > 1:
+            precursor_mz = spectrum['precursorMz'][0]['precursorMz']
+        else:
+            precursor_mz = None
+        control_spectrum = lcms.select_control_spectrum(pipeline, spectrum['msLevel'], spectrum['retentionTime'] * 60,
+                                                        precursor_mz, control_index)
+        if control_spectrum != None:
+            pairs.append([spectrum.copy(), control_spectrum])
+    # control spectra selected before timing so only blank removal is measured
+    start = timeit.default_timer()
+    for sample_spectrum, control_spectrum in pairs:
+        lcms.blank_removal(sample_spectrum, control_spectrum, pipeline['peak_mz_tolerance'])
+    return len(pairs), timeit.default_timer() - start
+
+def bench_consensus_control_spectrum(args, work_dir):
+    control_spectra = synthetic_spectra(args['control_spots'], args['peaks'], 0, args['seed'] + 1)
+    control_spectra = [[spectrum, 'control_' + str(count) + '.mzXML'] for count, spectrum in enumerate(control_spectra)]
+    pipeline = blanka_run.get_args([])
+    start = timeit.default_timer()
+    dd.consensus_control_spectrum(control_spectra, pipeline['peak_mz_tolerance'], pipeline['control_min_spots'])
+    return len(control_spectra), timeit.default_timer() - start
+
+def bench_mgf_writer(args, work_dir):
+    sample_spectra = sample_control_spectra(args)[0]
+    start = timeit.default_timer()
+    with lcms.dataset_mgf_writer(os.path.join(work_dir, 'sample_blanka_')) as mgf_files:
+        for spectrum in sample_spectra:
+            mgf_files.write(spectrum, 'processed')
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_binary_writer(args, work_dir):
+    sample_spectra = sample_control_spectra(args)[0]
+    start = timeit.default_timer()
+    with lcms.dataset_mgf_writer(os.path.join(work_dir, 'sample_blanka_'), output_format='binary') as binary_files:
+        for spectrum in sample_spectra:
+            binary_files.write(spectrum, 'processed')
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_run_lcms(args, work_dir):
+    sample_spectra, control_spectra = sample_control_spectra(args)
+    os.makedirs(os.path.join(work_dir, 'sample'))
+    write_mzxml(os.path.join(work_dir, 'sample', 'sample.mzXML'), sample_spectra)
+    write_mzxml(os.path.join(work_dir, 'control.mzXML'), control_spectra)
+    pipeline = blanka_run.get_args(['--sample', os.path.join(work_dir, 'sample'), '--control',
+                                    os.path.join(work_dir, 'control.mzXML'), '--instrument', 'lcq', '--cpu',
+                                    str(args['cpu'])])
+    start = timeit.default_timer()
+    blanka_run.start_run(pipeline)
+    blanka_run.run_lcms(pipeline)
+    blanka_run.finish_run()
+    return len(sample_spectra), timeit.default_timer() - start
+
+def bench_run_maldi_dd(args, work_dir):
+    control_spectra = synthetic_spectra(args['control_spots'], args['peaks'], 0, args['seed'] + 1)
+    shared_mz = numpy.unique(numpy.concatenate([spectrum['m/z array'] for spectrum in control_spectra]))
+    sample_spectra = synthetic_spectra(args['spots'], args['peaks'], 0, args['seed'], shared_mz)
+    for count, spectrum in enumerate(control_spectra):
+        write_mzxml(os.path.join(work_dir, 'control_' + str(count) + '.mzXML'), [spectrum])
+    for count, spectrum in enumerate(sample_spectra):
+        write_mzxml(os.path.join(work_dir, 'sample_' + str(count) + '.mzXML'), [spectrum])
+    pipeline = blanka_run.get_args(['--sample', work_dir, '--control', 'control', '--instrument', 'dd', '--cpu',
+                                    str(args['cpu'])])
+    start = timeit.default_timer()
+    blanka_run.start_run(pipeline)
+    blanka_run.run_maldi_dd(pipeline)
+    blanka_run.finish_run()
+    return len(sample_spectra), timeit.default_timer() - start
+
+def benchmark_worker(name, args, result_queue):
+    # run one benchmark in its own process so peak memory only covers that benchmark
+    work_dir = tempfile.mkdtemp(prefix='blanka_benchmark_')
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    # hide pipeline progress output
+    try:
+        spectra_count, seconds = globals()['bench_' + name](args, work_dir)
+        result_queue.put([spectra_count, seconds, profile.peak_rss_mb(), None])
+    except Exception as error:
+        result_queue.put([0, 0, None, repr(error)])
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def benchmark_result(worker, result_queue, poll_seconds=1):
+    # [spectra, seconds, peak MB, error] put on result_queue by worker; error result if the process exits without
+    # one (ex: killed when out of memory) instead of waiting forever
+    while True:
+        exited = not worker.is_alive()
+        # checked before waiting so a result sent just before the process exited is still read
+        try:
+            return result_queue.get(timeout=poll_seconds)
+        except Empty:
+            if exited:
+                return [0, 0, None, 'benchmark process exited with code ' + str(worker.exitcode)]
+
+def run_benchmark(name, args):
+    # best of args['repeat'] runs; each run in a fresh process
+    best = None
+    for count in range(args['repeat']):
+        result_queue = Queue()
+        worker = Process(target=benchmark_worker, args=(name, args, result_queue))
+        worker.start()
+        spectra_count, seconds, peak_rss, error = benchmark_result(worker, result_queue)
+        worker.join()
+        if error != None:
+            return {'error': error}
+        if best == None or seconds < best['seconds']:
+            best = {'spectra': spectra_count, 'seconds': seconds,
+                    'spectra_per_second': spectra_count / seconds if seconds > 0 else 0, 'peak_rss_mb': peak_rss}
+    return best
+
+def compare_baseline(results, baseline, tolerance):
+    # regressions: throughput below (1 - tolerance) or peak memory above (1 + tolerance) times the baseline
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or 'error' in result or 'error' in baseline[name]:
+            continue
+        result['baseline_spectra_per_second'] = baseline[name]['spectra_per_second']
+        if result['spectra_per_second'] < baseline[name]['spectra_per_second'] * (1 - tolerance):
+            regressions.append(name + ': ' + '%.1f' % result['spectra_per_second'] + ' spectra/s vs ' +
+                               '%.1f' % baseline[name]['spectra_per_second'] + ' spectra/s baseline')
+        if result['peak_rss_mb'] != None and baseline[name]['peak_rss_mb'] != None and \
+                result['peak_rss_mb'] > baseline[name]['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(name + ': ' + '%.1f' % result['peak_rss_mb'] + ' MB vs ' +
+                               '%.1f' % baseline[name]['peak_rss_mb'] + ' MB baseline')
+    return regressions
+
+def print_results(results):
+    print '%-26s %10s %12s %14s %12s %12s' % ('benchmark', 'spectra', 'seconds', 'spectra/s', 'peak MB',
+                                               'baseline/s')
+    for name in benchmark_names:
+        if name not in results:
+            continue
+        result = results[name]
+        if 'error' in result:
+            print '%-26s failed: %s' % (name, result['error'])
+            continue
+        print '%-26s %10d %12.4f %14.1f %12s %12s' % (name, result['spectra'], result['seconds'],
+                                                       result['spectra_per_second'],
+                                                       '-' if result['peak_rss_mb'] == None else
+                                                       '%.1f' % result['peak_rss_mb'],
+                                                       '%.1f' % result['baseline_spectra_per_second']
+                                                       if 'baseline_spectra_per_second' in result else '-')
+
+if __name__ == "__main__":
+
+    arguments = get_args()
+    parameters = {key: arguments[key] for key in ['scans', 'peaks', 'ms2_ratio', 'control_scans', 'spots',
+                                                   'control_spots', 'cpu', 'seed']}
+    for benchmark in arguments['benchmarks'].split(','):
+        if benchmark not in benchmark_names:
+            print "Unknown benchmark " + benchmark + "; choose from " + ', '.join(benchmark_names)
+            sys.exit(1)
+    if arguments['baseline'] != '':
+        with open(arguments['baseline'], 'r') as baseline_file:
+            baseline_report = json.load(baseline_file)
+        if baseline_report['parameters'] != parameters:
+            print "Baseline was run with different parameters; results cannot be compared"
+            print "  baseline: " + json.dumps(baseline_report['parameters'], sort_keys=True)
+            print "  this run: " + json.dumps(parameters, sort_keys=True)
+            sys.exit(1)
+    benchmark_results = {}
+    for benchmark in arguments['benchmarks'].split(','):
+        benchmark_results[benchmark] = run_benchmark(benchmark, arguments)
+
+    regression_list = []
+    if arguments['baseline'] != '':
+        regression_list = compare_baseline(benchmark_results, baseline_report['results'], arguments['tolerance'])
+    print_results(benchmark_results)
+    if arguments['report'] != '':
+        with open(arguments['report'], 'w') as report_file:
+            json.dump({'parameters': parameters, 'results': benchmark_results}, report_file, indent=2,
+                      sort_keys=True)
+    failed_list = [name for name in benchmark_names if 'error' in benchmark_results.get(name, {})]
+    if failed_list != []:
+        print "Failed: " + ', '.join(failed_list)
+    if regression_list != []:
+        print "Regressions:"
+        for regression in regression_list:
+            print "  " + regression
+    if failed_list != [] or regression_list != []:
+        sys.exit(1)
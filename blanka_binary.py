@@ -0,0 +1,237 @@
+import os, json, shutil, argparse, numpy
+import blanka_mgf
+import blanka_spectrum
+
+metadata_dtype = [('num', 'S32'), ('msLevel', 'i4'), ('retentionTime', 'f8'), ('precursorMz', 'f8'),
+                  ('precursorIntensity', 'f8')]
+# per spectrum metadata table; precursorMz/precursorIntensity are nan when not set
+
+def npy_header(dtype, count):
+    # version 1.0 .npy header for a 1d array of count items
+    # padded to the same size for any count (up to 20 digits) so the header can be rewritten in place with the final
+    # count once all spectra are written
+    header = repr({'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), 'fortran_order': False,
+                   'shape': (int(count),)})
+    header_size = int(numpy.ceil((10 + len(header) - len(str(int(count))) + 20 + 1) / 64.0)) * 64
+    header = header + ' ' * (header_size - 10 - 1 - len(header)) + '\n'
+    return b'\x93NUMPY\x01\x00' + numpy.array([len(header)], dtype='<u2').tostring() + header.encode('latin1')
+
+class NpyAppender(object):
+    # 1d .npy file written in pieces; items appended to the end and the header written with the final count on close
+    # so results are never held in memory
+    # resume_size: size from a checkpoint; an existing file is cut back to it and appended to (dtype read from file)
+
+    def __init__(self, path, dtype, resume_size=None):
+        self.path = path
+        if resume_size != None and os.path.isfile(path):
+            self.npy_file = open(path, 'r+b')
+            numpy.lib.format.read_magic(self.npy_file)
+            self.dtype = numpy.lib.format.read_array_header_1_0(self.npy_file)[2]
+            self.count = (resume_size - self.npy_file.tell()) // self.dtype.itemsize
+            self.npy_file.truncate(resume_size)
+            self.npy_file.seek(resume_size)
+        else:
+            self.dtype = numpy.dtype(dtype).newbyteorder('<')
+            self.count = 0
+            self.npy_file = open(path, 'wb')
+            self.npy_file.write(npy_header(self.dtype, 0))
+
+    def append(self, array):
+        array = numpy.asarray(array, dtype=self.dtype)
+        self.npy_file.write(array.tostring())
+        self.count += len(array)
+
+    def close(self):
+        self.npy_file.seek(0)
+        self.npy_file.write(npy_header(self.dtype, self.count))
+        self.npy_file.close()
+
+class PeakContainer(object):
+    # binary results for one datatype of a dataset; a directory with all peaks as flat m/z and intensity arrays,
+    # offsets (spectrum i = [offsets[i]:offsets[i + 1]]), a metadata table (.npy files) and info.json with the title
+    # and retention time factor needed to export the same .mgf text
+    # written to <path>.part and renamed by BinaryWriter when complete
+    # resume_files: {file in path: size} from BinaryWriter.checkpoint(); files cut back to those sizes and appended to
+
+    def __init__(self, path, title, ms2_retention_time_factor, mz_dtype, intensity_dtype, resume_files=None):
+        self.path = path
+        self.part_path = path + '.part'
+        if resume_files == None or not os.path.isdir(self.part_path):
+            resume_files = {}
+            if os.path.isdir(self.part_path):
+                shutil.rmtree(self.part_path)
+            os.makedirs(self.part_path)
+        with open(os.path.join(self.part_path, 'info.json'), 'w') as info_file:
+            json.dump({'title': title, 'ms2_retention_time_factor': ms2_retention_time_factor}, info_file)
+        self.npy_files = {}
+        for name, dtype in (('mz', mz_dtype), ('intensity', intensity_dtype), ('offsets', numpy.int64),
+                            ('metadata', metadata_dtype)):
+            self.npy_files[name] = NpyAppender(os.path.join(self.part_path, name + '.npy'), dtype,
+                                               resume_files.get(os.path.join(path, name + '.npy')))
+        self.mz = self.npy_files['mz']
+        self.intensity = self.npy_files['intensity']
+        self.offsets = self.npy_files['offsets']
+        self.metadata = self.npy_files['metadata']
+        if self.offsets.count == 0:
+            self.offsets.append([0])
+
+    def write(self, spectrum_data_dict):
+        self.mz.append(spectrum_data_dict['m/z array'])
+        self.intensity.append(spectrum_data_dict['intensity array'])
+        self.offsets.append([self.mz.count])
+        if 'precursorMz' in spectrum_data_dict and spectrum_data_dict['precursorMz'][0]['precursorMz'] != None:
+            precursor_mz = spectrum_data_dict['precursorMz'][0]['precursorMz']
+            precursor_intensity = spectrum_data_dict['precursorMz'][0].get('precursorIntensity')
+        else:
+            precursor_mz = None
+            precursor_intensity = None
+        metadata = numpy.zeros(1, dtype=metadata_dtype)
+        metadata[0] = (spectrum_data_dict['num'], spectrum_data_dict['msLevel'], spectrum_data_dict['retentionTime'],
+                       numpy.nan if precursor_mz == None else precursor_mz,
+                       numpy.nan if precursor_intensity == None else precursor_intensity)
+        self.metadata.append(metadata)
+
+    def output_files(self):
+        # {file in path: open .part file}
+        return {os.path.join(self.path, name + '.npy'): npy_file.npy_file for name, npy_file in self.npy_files.items()}
+
+    def close(self):
+        for npy_file in self.npy_files.values():
+            npy_file.close()
+
+class BinaryWriter(blanka_mgf.MgfWriter):
+    # MgfWriter with the same interface that writes <output_dir><datatype>_data binary containers (PeakContainer)
+    # instead of .mgf text; ms2 spectra are not written twice since _data_ms2.mgf is exported from the full container
+    # containers are replaced, not appended to, when a dataset is written again
+
+    def __init__(self, output_dir, background=False, ms2_retention_time_factor=60, queue_size=1000,
+                 resume_files=None):
+        self.containers = {}
+        blanka_mgf.MgfWriter.__init__(self, output_dir, background, ms2_retention_time_factor, queue_size,
+                                      resume_files=resume_files)
+
+    def write_spectrum(self, spectrum_data_dict, datatype):
+        if datatype not in self.containers:
+            self.containers[datatype] = PeakContainer(self.output_dir + datatype + '_data', self.title,
+                                                      self.ms2_retention_time_factor,
+                                                      spectrum_data_dict['m/z array'].dtype,
+                                                      spectrum_data_dict['intensity array'].dtype,
+                                                      self.resume_files)
+            # array dtypes of the first spectrum written are used for the whole container
+        self.containers[datatype].write(spectrum_data_dict)
+
+    def resumed_datatypes(self):
+        # datatypes with .part containers in resume_files
+        return set([os.path.dirname(path)[len(self.output_dir):-len('_data')] for path in self.resume_files
+                    if os.path.dirname(path).startswith(self.output_dir) and os.path.dirname(path).endswith('_data')
+                    and os.path.isdir(os.path.dirname(path) + '.part')])
+
+    def open_datatype(self, datatype):
+        # container reopened with the array dtypes it was written with (read from the resumed .npy files)
+        self.containers[datatype] = PeakContainer(self.output_dir + datatype + '_data', self.title,
+                                                  self.ms2_retention_time_factor, numpy.float64, numpy.float64,
+                                                  self.resume_files)
+
+    def output_files(self):
+        return {path: npy_file for container in self.containers.values()
+                for path, npy_file in container.output_files().items()}
+
+    def close_files(self):
+        # write final container headers; returns container paths
+        for container in self.containers.values():
+            container.close()
+        container_paths = [container.path for container in self.containers.values()]
+        self.containers = {}
+        return container_paths
+
+def concatenate_containers(paths, path):
+    # merge containers written in pieces (ex: scan ranges of --sample_store workers) into one container at path
+    # peak arrays and metadata tables appended as stored and offsets shifted; spectra are not decoded
+    part_path = path + '.part'
+    if os.path.isdir(part_path):
+        shutil.rmtree(part_path)
+    os.makedirs(part_path)
+    shutil.copy(os.path.join(paths[0], 'info.json'), part_path)
+    npy_files = {'offsets': NpyAppender(os.path.join(part_path, 'offsets.npy'), numpy.int64)}
+    npy_files['offsets'].append([0])
+    for piece_path in paths:
+        for name in ('mz', 'intensity', 'metadata'):
+            array = numpy.load(os.path.join(piece_path, name + '.npy'), mmap_mode='r')
+            if name not in npy_files:
+                npy_files[name] = NpyAppender(os.path.join(part_path, name + '.npy'), array.dtype)
+                # dtypes of the first piece, same as BinaryWriter
+            npy_files[name].append(array)
+        offsets = numpy.load(os.path.join(piece_path, 'offsets.npy'))
+        npy_files['offsets'].append(offsets[1:] + (npy_files['mz'].count - offsets[-1]))
+    for npy_file in npy_files.values():
+        npy_file.close()
+    blanka_mgf.replace_file(part_path, path)
+
+def load_container(path):
+    # peak arrays (memory mapped), offsets, metadata table and info of a container written by BinaryWriter
+    mz_array = numpy.load(os.path.join(path, 'mz.npy'), mmap_mode='r')
+    intensity_array = numpy.load(os.path.join(path, 'intensity.npy'), mmap_mode='r')
+    offsets = numpy.load(os.path.join(path, 'offsets.npy'))
+    metadata = numpy.load(os.path.join(path, 'metadata.npy'))
+    with open(os.path.join(path, 'info.json'), 'r') as info_file:
+        info = json.load(info_file)
+    return mz_array, intensity_array, offsets, metadata, info
+
+def read_container(path):
+    # spectra of a container written by BinaryWriter as Spectrum objects; peak arrays are memory mapped views
+    mz_array, intensity_array, offsets, metadata, info = load_container(path)
+    return container_spectra(metadata, mz_array, intensity_array, offsets)
+
+def container_spectra(metadata, mz_array, intensity_array, offsets):
+    # Spectrum objects from a metadata table and flat peak arrays; spectrum i = [offsets[i]:offsets[i + 1]] (views)
+    for count, (num, ms_level, ret_time, precursor_mz, precursor_intensity) in enumerate(metadata.tolist()):
+        yield blanka_spectrum.Spectrum(num.decode('utf-8') if not isinstance(num, str) else num, ms_level, ret_time,
+                                       None if numpy.isnan(precursor_mz) else precursor_mz,
+                                       None if numpy.isnan(precursor_intensity) else precursor_intensity,
+                                       mz_array[offsets[count]:offsets[count + 1]],
+                                       intensity_array[offsets[count]:offsets[count + 1]])
+
+def export_mgf(path, output_dir=None):
+    # write _data_ms2.mgf and _data_full.mgf for a container; same text as MgfWriter would have written
+    # output_dir: .mgf prefix (ex: D:\folder\filename_blanka_), default = next to the container
+    with open(os.path.join(path, 'info.json'), 'r') as info_file:
+        info = json.load(info_file)
+    container_name = os.path.basename(os.path.normpath(path))
+    datatype = container_name[container_name.rfind('_blanka_') + len('_blanka_'):-len('_data')]
+    if output_dir == None:
+        output_dir = os.path.normpath(path)[:-len(datatype + '_data')]
+    for mgf_path in (output_dir + datatype + '_data_ms2.mgf', output_dir + datatype + '_data_full.mgf'):
+        if os.path.isfile(mgf_path):
+            os.remove(mgf_path)
+    # MgfWriter appends to existing files
+    with blanka_mgf.MgfWriter(output_dir, ms2_retention_time_factor=info['ms2_retention_time_factor']) as mgf_files:
+        mgf_files.title = info['title']
+        for spectrum in read_container(path):
+            mgf_files.write(spectrum, datatype)
+
+def container_detection(directory):
+    # find containers written by BinaryWriter in directory; .part containers still being written (or left by an
+    # interrupted run) are skipped
+    containers = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [i for i in dirnames if not i.endswith('.part')]
+        if 'metadata.npy' in filenames and 'info.json' in filenames and not dirpath.endswith('.part'):
+            containers.append(dirpath)
+    return containers
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="export BLANKA binary output (--output_format binary) to .mgf")
+    parser.add_argument('--input', help="binary output directory (ex: filename_blanka_processed_data) or directory \
+                                         to search for them", type=str, default='')
+    parser.add_argument('--output', help="output directory for .mgf files; default=next to binary output",
+                        type=str, default='')
+    arguments = vars(parser.parse_args())
+    for container in container_detection(arguments['input']):
+        if arguments['output'] == '':
+            export_mgf(container)
+        else:
+            container_name = os.path.basename(os.path.normpath(container))
+            export_mgf(container, os.path.join(arguments['output'],
+                                               container_name[:container_name.rfind('_blanka_') + len('_blanka_')]))
+        print "Exported " + container
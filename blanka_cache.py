@@ -0,0 +1,149 @@
+import os, json, hashlib, shutil, tempfile, numpy
+import blanka_kernels as kernels
+import blanka_binary
+import blanka_mgf
+import blanka_spectrum
+
+cache_version = 3
+# increment when the cached control library layout changes
+
+index_keys = ['order', 'retention time', 'precursor m/z', 'precursor order', 'sorted precursor m/z']
+# arrays of each ms level of blanka_lcms.build_control_index saved with the control library
+
+def file_hash(path, hash_memo):
+    # sha1 of file contents; hash_memo skips rehashing files with unchanged size and modification time
+    file_stat = os.stat(path)
+    memo_key = os.path.abspath(path)
+    if memo_key in hash_memo and hash_memo[memo_key][:2] == [file_stat.st_size, file_stat.st_mtime]:
+        return hash_memo[memo_key][2]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(1048576), b''):
+            sha1.update(block)
+    hash_memo[memo_key] = [file_stat.st_size, file_stat.st_mtime, sha1.hexdigest()]
+    return sha1.hexdigest()
+
+def load_hash_memo(cache_dir):
+    memo_path = os.path.join(cache_dir, 'file_hashes.json')
+    if os.path.isfile(memo_path):
+        with open(memo_path, 'r') as memo_file:
+            return json.load(memo_file)
+    return {}
+
+def save_hash_memo(cache_dir, hash_memo):
+    memo_path = os.path.join(cache_dir, 'file_hashes.json')
+    temp_path = memo_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as memo_file:
+        json.dump(hash_memo, memo_file)
+    blanka_mgf.replace_file(temp_path, memo_path)
+
+def control_library_path(args, control_files, noise_removed):
+    # cache directory for a prepared control library
+    # key covers control file contents (in load order), noise removal parameters and instrument mode so any change
+    # to inputs or parameters selects a different entry
+    if not os.path.isdir(args['control_cache']):
+        os.makedirs(args['control_cache'])
+    hash_memo = load_hash_memo(args['control_cache'])
+    key = {'version': cache_version,
+           'instrument': args['instrument'],
+           'noise_removed': noise_removed,
+           'signal_noise_ratio': args['signal_noise_ratio'],
+           'noise_percentile': args['noise_percentile'],
+           'control_files': [file_hash(control, hash_memo) for control in control_files]}
+    if args['instrument'] == 'dd':
+        key['peak_mz_tolerance'] = args['peak_mz_tolerance']
+        key['control_min_spots'] = args['control_min_spots']
+        # dd library is the consensus spectrum binned with these parameters
+    save_hash_memo(args['control_cache'], hash_memo)
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(args['control_cache'], args['instrument'] + '_' + key_hash)
+
+def save_control_library(library_path, spectra, control_index):
+    # save control spectra as flat m/z and intensity arrays with offsets and a metadata table (.npy files), with the
+    # arrays of their index (blanka_lcms.build_control_index) so loading does not rebuild it
+    mz_array, intensity_array, offsets = kernels.pack_spectra(spectra)
+    metadata = numpy.zeros(len(spectra), dtype=blanka_binary.metadata_dtype)
+    # same per spectrum fields as the binary output; everything used by control matching and blank removal
+    for count, spectrum in enumerate(spectra):
+        metadata[count] = (spectrum.get('num', ''), spectrum.get('msLevel', 0), spectrum.get('retentionTime', 0),
+                           spectrum['precursorMz'][0]['precursorMz'] if 'precursorMz' in spectrum else 0,
+                           spectrum['precursorMz'][0].get('precursorIntensity', 0) if 'precursorMz' in spectrum
+                           else 0)
+    arrays = {'mz': kernels.native_array(mz_array), 'intensity': kernels.native_array(intensity_array),
+              'offsets': offsets, 'metadata': metadata}
+    for ms_level, level_index in control_index.items():
+        for key in index_keys:
+            arrays[index_file_name(ms_level, key)] = level_index[key]
+    save_arrays(library_path, arrays)
+
+def index_file_name(ms_level, key):
+    # .npy file name of a control index array (ex: 2, 'precursor m/z' -> 'ms2_precursor_mz')
+    return 'ms' + str(ms_level) + '_' + consensus_file_name(key)
+
+def save_arrays(library_path, arrays):
+    # save {name: array} as name.npy files in library_path
+    # written to a temporary directory first so a partially written library is never loaded
+    temp_path = tempfile.mkdtemp(dir=os.path.dirname(library_path))
+    for name, array in arrays.items():
+        numpy.save(os.path.join(temp_path, name + '.npy'), array)
+    try:
+        os.rename(temp_path, library_path)
+    except OSError:
+        # saved by another run in the meantime
+        shutil.rmtree(temp_path)
+
+def load_control_index(library_path):
+    # control index saved by save_control_library (same layout as blanka_lcms.build_control_index); index arrays
+    # memory mapped and spectra created only when selected (LibrarySpectra)
+    control_index = {}
+    for ms_level in (1, 2):
+        control_index[ms_level] = {key: numpy.load(os.path.join(library_path, index_file_name(ms_level, key) + '.npy'),
+                                                   mmap_mode='r') for key in index_keys}
+        control_index[ms_level]['spectra'] = LibrarySpectra(library_path, ms_level)
+    return control_index
+
+class LibrarySpectra(object):
+    # control spectra of one ms level of a saved control library in retention time order (the 'spectra' list of a
+    # control index); Spectrum objects created from the memory mapped arrays when indexed instead of all at load
+    # pickled as library path and ms level so pool workers memory map the same files instead of receiving the peaks
+
+    def __init__(self, library_path, ms_level):
+        self.library_path = library_path
+        self.ms_level = ms_level
+        self.order = numpy.load(os.path.join(library_path, index_file_name(ms_level, 'order') + '.npy'),
+                                mmap_mode='r')
+        self.mz_array = numpy.load(os.path.join(library_path, 'mz.npy'), mmap_mode='r')
+        self.intensity_array = numpy.load(os.path.join(library_path, 'intensity.npy'), mmap_mode='r')
+        self.offsets = numpy.load(os.path.join(library_path, 'offsets.npy'), mmap_mode='r')
+        self.metadata = numpy.load(os.path.join(library_path, 'metadata.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        count = int(self.order[position])
+        num, ms_level, ret_time, precursor_mz, precursor_intensity = self.metadata[count].tolist()
+        if ms_level < 2:
+            precursor_mz = None
+            precursor_intensity = None
+        start = int(self.offsets[count])
+        end = int(self.offsets[count + 1])
+        return blanka_spectrum.Spectrum(num.decode('utf-8') if not isinstance(num, str) else num, ms_level, ret_time,
+                                        precursor_mz, precursor_intensity, self.mz_array[start:end],
+                                        self.intensity_array[start:end])
+
+    def __reduce__(self):
+        return (LibrarySpectra, (self.library_path, self.ms_level))
+
+def consensus_file_name(key):
+    # .npy file name of a consensus spectrum or control index array (ex: 'm/z min array' -> 'mz_min')
+    return key.replace('m/z', 'mz').replace(' array', '').replace(' ', '_')
+
+def save_control_consensus(library_path, consensus_spectrum):
+    # save dd consensus control spectrum (blanka_maldi_dd.consensus_control_spectrum) as one .npy file per array
+    save_arrays(library_path, {consensus_file_name(key): array for key, array in consensus_spectrum.items()})
+
+def load_control_consensus(library_path, keys):
+    # load consensus control spectrum saved by save_control_consensus; arrays memory mapped
+    return {key: numpy.load(os.path.join(library_path, consensus_file_name(key) + '.npy'), mmap_mode='r')
+            for key in keys}
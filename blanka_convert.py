@@ -0,0 +1,96 @@
+import os, subprocess, timeit
+from multiprocessing.pool import ThreadPool
+from functools import partial
+
+msconvert_settings = ['--mzXML', '--32', '--mz32', '--inten32',
+                      '--filter', 'titleMaker <RunId>.<ScanNumber>.<ScanNumber>.<ChargeState>',
+                      '--filter', 'peakPicking true 1-2']
+# default Sanchez Lab MSConvert settings
+
+conversion_times = {}
+# seconds taken by each conversion run this session (.mzXML path: seconds), reported by --profile
+
+msconvert_paths = {}
+# MSConvert path read from each config file, so config.ini is only read once per run
+
+def read_msconvert_path(config_path='config.ini'):
+    # path to MSConvert executable from config.ini (msconvert=C:\PATH\TO\msconvert.exe)
+    if config_path not in msconvert_paths:
+        with open(config_path, 'r') as config_file:
+            msconvert_paths[config_path] = config_file.read().split('=')[1].strip()
+    return msconvert_paths[config_path]
+
+def conversion_job(raw_path, output_dir, outfile=None):
+    # raw data file/directory, output directory, --outfile name (or None) and expected .mzXML output path
+    if outfile == None:
+        output_name = os.path.splitext(os.path.basename(raw_path.rstrip('\\/')))[0] + '.mzXML'
+    elif outfile.endswith('.mzXML'):
+        output_name = outfile
+    else:
+        output_name = outfile + '.mzXML'
+    return (raw_path, output_dir, outfile, os.path.join(output_dir, output_name))
+
+def source_mtime(raw_path):
+    # modification time of raw data; newest file for raw data directories (ex: Agilent .d)
+    if os.path.isdir(raw_path):
+        return max([os.path.getmtime(os.path.join(dirpath, files)) for dirpath, dirnames, filenames in
+                    os.walk(raw_path) for files in filenames] + [os.path.getmtime(raw_path)])
+    return os.path.getmtime(raw_path)
+
+def up_to_date(job):
+    # converted .mzXML exists, is not empty and is newer than its raw data
+    output_path = job[3]
+    return (os.path.isfile(output_path) and os.path.getsize(output_path) > 0 and
+            os.path.getmtime(output_path) >= source_mtime(job[0]))
+
+def run_conversion(msconvert_path, job):
+    # run one MSConvert process; returns job and whether the .mzXML file was written
+    # output directory created if needed (ex: plate subdirectories in dd mode)
+    raw_path, output_dir, outfile, output_path = job
+    if not os.path.isdir(output_dir):
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            pass
+            # created by another conversion thread
+    command = [msconvert_path, raw_path, '-o', output_dir]
+    if outfile != None:
+        command += ['--outfile', outfile]
+    command += msconvert_settings
+    print ' '.join(command)
+    start = timeit.default_timer()
+    return_code = subprocess.call(command)
+    conversion_times[output_path] = timeit.default_timer() - start
+    return job, return_code == 0 and os.path.isfile(output_path)
+
+def convert(jobs, max_conversions=2, msconvert_path=None):
+    # convert raw data with up to max_conversions MSConvert processes at once
+    # yields each .mzXML file as soon as it is ready so processing can start while other conversions are running
+    # up to date .mzXML files are yielded without reconverting; duplicate jobs converted once
+    unique_jobs = []
+    output_paths = set()
+    for job in jobs:
+        if job[3] not in output_paths:
+            output_paths.add(job[3])
+            unique_jobs.append(job)
+    pending_jobs = []
+    for job in unique_jobs:
+        if up_to_date(job):
+            print "Skipping conversion of " + job[0] + "; " + job[3] + " is up to date"
+            yield job[3]
+        else:
+            pending_jobs.append(job)
+    if pending_jobs == []:
+        return
+    if msconvert_path == None:
+        msconvert_path = read_msconvert_path()
+    conversion_pool = ThreadPool(processes=max(1, min(max_conversions, len(pending_jobs))))
+    try:
+        for job, converted in conversion_pool.imap_unordered(partial(run_conversion, msconvert_path), pending_jobs):
+            if converted:
+                yield job[3]
+            else:
+                print "MSConvert failed to convert " + job[0]
+    finally:
+        conversion_pool.close()
+        conversion_pool.join()
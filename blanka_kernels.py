@@ -0,0 +1,112 @@
+import numpy
+
+def pack_spectra(spectra):
+    # concatenate m/z and intensity arrays of a block of spectrum dicts
+    # returns m/z array, intensity array and offsets; spectrum i is [offsets[i]:offsets[i + 1]]
+    peak_counts = [len(spectrum['m/z array']) for spectrum in spectra]
+    offsets = numpy.zeros(len(spectra) + 1, dtype=numpy.int64)
+    numpy.cumsum(peak_counts, out=offsets[1:])
+    if len(spectra) == 0:
+        return numpy.array([], dtype=numpy.float32), numpy.array([], dtype=numpy.float32), offsets
+    mz_array = numpy.concatenate([spectrum['m/z array'] for spectrum in spectra])
+    intensity_array = numpy.concatenate([spectrum['intensity array'] for spectrum in spectra])
+    return mz_array, intensity_array, offsets
+
+def mask_offsets(mask, offsets):
+    # offsets of each spectrum in a packed array after removing peaks where mask is False
+    kept_counts = numpy.concatenate(([0], numpy.cumsum(mask, dtype=numpy.int64)))
+    return kept_counts[offsets]
+
+def noise_levels(intensity_array, offsets, noise_percentile):
+    # noise level of each spectrum in a packed intensity array
+    # average of the lowest noise_percentile % of nonzero intensities; numpy.partition used instead of a full sort
+    # returns noise levels and whether each spectrum had enough peaks to estimate noise
+    noise = numpy.zeros(len(offsets) - 1, dtype=numpy.float64)
+    estimated = numpy.zeros(len(offsets) - 1, dtype=bool)
+    for count in range(len(offsets) - 1):
+        intensities = intensity_array[offsets[count]:offsets[count + 1]]
+        intensities = intensities[intensities != 0]
+        lowest_count = int(round(len(intensities) * noise_percentile / 100.0))
+        if lowest_count > 0:
+            lowest_intensities = numpy.partition(intensities, lowest_count - 1)[:lowest_count]
+            noise[count] = lowest_intensities.sum(dtype=numpy.float64) / lowest_count
+            estimated[count] = True
+    return noise, estimated
+
+def noise_removal_mask(intensity_array, offsets, signal_noise_ratio, noise_percentile):
+    # peaks kept after noise removal for a block of spectra packed into one intensity array
+    # zero intensity peaks and peaks <= signal_noise_ratio * noise level removed
+    # spectra with too few peaks to estimate noise are left unchanged
+    noise, estimated = noise_levels(intensity_array, offsets, noise_percentile)
+    peak_counts = numpy.diff(offsets)
+    peak_thresholds = numpy.repeat(signal_noise_ratio * noise, peak_counts)
+    peak_estimated = numpy.repeat(estimated, peak_counts)
+    return ~peak_estimated | ((intensity_array != 0) & (intensity_array > peak_thresholds))
+
+def native_array(array):
+    # array in native byte order; pyteomics arrays are big endian until pickled
+    return numpy.asarray(array, dtype=array.dtype.newbyteorder('='))
+
+def blank_removal_mask(sample_mz_array, control_mz_array, control_intensity_array, peak_mz_tolerance):
+    # sample peaks removed as blank; True where the nearest control peak is within peak_mz_tolerance
+    # nearest control peak found with searchsorted on sorted m/z arrays, ties go to the lower m/z control peak and
+    # control peaks with zero intensity never match (same as pandas.merge_asof direction='nearest' + fillna(0))
+    if len(sample_mz_array) == 0 or len(control_mz_array) == 0:
+        return numpy.zeros(len(sample_mz_array), dtype=bool)
+    sample_mz_array = native_array(sample_mz_array)
+    control_mz_array = native_array(control_mz_array)
+    last_control = len(control_mz_array) - 1
+    backward = numpy.searchsorted(control_mz_array, sample_mz_array, side='right') - 1
+    forward = numpy.searchsorted(control_mz_array, sample_mz_array, side='left')
+    backward_clipped = numpy.clip(backward, 0, last_control)
+    forward_clipped = numpy.clip(forward, 0, last_control)
+    backward_diff = numpy.where(backward >= 0, sample_mz_array - control_mz_array[backward_clipped], numpy.inf)
+    forward_diff = numpy.where(forward <= last_control, control_mz_array[forward_clipped] - sample_mz_array,
+                               numpy.inf)
+    nearest = numpy.where(backward_diff <= forward_diff, backward_clipped, forward_clipped)
+    nearest_diff = numpy.minimum(backward_diff, forward_diff)
+    return (nearest_diff <= peak_mz_tolerance) & (control_intensity_array[nearest] != 0)
+
+def consensus_bins(mz_array, intensity_array, offsets, peak_mz_tolerance):
+    # cluster the peaks of a block of spectra packed into one array (see pack_spectra) into m/z bins
+    # sorted peaks closer than peak_mz_tolerance to their neighbour share a bin, so bins are at least
+    # peak_mz_tolerance apart and a m/z value is within peak_mz_tolerance of a bin peak only if it is within
+    # peak_mz_tolerance of [lowest m/z, highest m/z] of the bin
+    # returns intensity weighted m/z, summed intensity, max intensity, lowest m/z, highest m/z and number of spectra
+    # with a peak in each bin
+    spectrum_ids = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+    nonzero = intensity_array != 0
+    mz_array = mz_array[nonzero]
+    intensity_array = intensity_array[nonzero]
+    spectrum_ids = spectrum_ids[nonzero]
+    if len(mz_array) == 0:
+        empty = numpy.array([], dtype=numpy.float32)
+        return empty, empty, empty, empty, empty, numpy.array([], dtype=numpy.int64)
+    order = numpy.argsort(mz_array, kind='mergesort')
+    mz_array = mz_array[order]
+    intensity_array = intensity_array[order]
+    spectrum_ids = spectrum_ids[order]
+    bin_starts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(mz_array) > peak_mz_tolerance)[0] + 1))
+    bin_ids = numpy.repeat(numpy.arange(len(bin_starts)), numpy.diff(numpy.append(bin_starts, len(mz_array))))
+    intensity_sum = numpy.add.reduceat(intensity_array.astype(numpy.float64), bin_starts)
+    weighted_mz = numpy.add.reduceat(mz_array.astype(numpy.float64) * intensity_array, bin_starts) / intensity_sum
+    spectra_count = numpy.bincount(numpy.unique(bin_ids * (len(offsets) - 1) + spectrum_ids) // (len(offsets) - 1),
+                                   minlength=len(bin_starts))
+    return (weighted_mz.astype(numpy.float32), intensity_sum.astype(numpy.float32),
+            numpy.maximum.reduceat(intensity_array, bin_starts).astype(numpy.float32),
+            numpy.minimum.reduceat(mz_array, bin_starts), numpy.maximum.reduceat(mz_array, bin_starts),
+            spectra_count)
+
+def consensus_removal_mask(sample_mz_array, bin_mz_min, bin_mz_max, peak_mz_tolerance):
+    # sample peaks removed as blank; True where a consensus bin (see consensus_bins) is within peak_mz_tolerance
+    # bins are sorted and apart, so only the bin starting at or below each peak and the next bin are checked
+    if len(sample_mz_array) == 0 or len(bin_mz_min) == 0:
+        return numpy.zeros(len(sample_mz_array), dtype=bool)
+    sample_mz_array = native_array(sample_mz_array)
+    last_bin = len(bin_mz_min) - 1
+    below = numpy.searchsorted(bin_mz_min, sample_mz_array, side='right') - 1
+    above = below + 1
+    below_clipped = numpy.clip(below, 0, last_bin)
+    above_clipped = numpy.clip(above, 0, last_bin)
+    return (((below >= 0) & (sample_mz_array - bin_mz_max[below_clipped] <= peak_mz_tolerance)) |
+            ((above <= last_bin) & (bin_mz_min[above_clipped] - sample_mz_array <= peak_mz_tolerance)))
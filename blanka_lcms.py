@@ -3,6 +3,12 @@ import pyteomics.mzxml as pytmzxml
 import pyteomics.mgf as pytmgf
 from multiprocessing import Pool, cpu_count
 from functools import partial
+import blanka_kernels as kernels
+import blanka_mgf
+import blanka_binary
+import blanka_convert as convert
+import blanka_mzxml
+import blanka_store
 
 def mzxml_data_detection(directory):
     # scan directory for .mzXML files
@@ -28,37 +34,43 @@ def raw_data_detection(args, file_directory):
         msconvert_list = [(files, files[:files.rfind('\\')]) for files in file_list]
         return msconvert_list
 
-def msconvert(args, msconvert_list):
-    # convert raw data files detected into .mzXML format using MSConvert and default Sanchez Lab settings
-    with open('config.ini', 'r') as config_file:
-        msconvert_path = config_file.read().split('=')[1] + ' '
+def msconvert_jobs(args, msconvert_list):
+    # conversion jobs for raw data files detected; output directory taken from first raw file if not specified
+    jobs = []
     for files in msconvert_list:
         if args['output'] == '':
             args['output'] = files[1]
-        msconvert = msconvert_path + files[0] + " -o " + args['output'] + ' --mzXML --32 --mz32 --inten32\
-                    --filter "titleMaker <RunId>.<ScanNumber>.<ScanNumber>.<ChargeState>"\
-                    --filter "peakPicking true 1-2"'
-        print msconvert
-        subprocess.call(msconvert)
+        jobs.append(convert.conversion_job(files[0], args['output']))
+    return jobs
+
+def msconvert(args, msconvert_list):
+    # convert raw data files detected into .mzXML format using MSConvert and default Sanchez Lab settings
+    # waits for all conversions; returns converted .mzXML files
+    return list(msconvert_iter(args, msconvert_list))
+
+def msconvert_iter(args, msconvert_list):
+    # convert raw data files with up to args['max_conversions'] MSConvert processes at once
+    # yields each .mzXML file as soon as its conversion finishes; up to date .mzXML files are not reconverted
+    return convert.convert(msconvert_jobs(args, msconvert_list), args['max_conversions'])
 
 def spectrum_to_dataframe(spectrum):
     # convert spectrum to dataframe
-    mz_array = spectrum['m/z array'].newbyteorder('=')
-    intensity_array = spectrum['intensity array'].newbyteorder('=')
-    # fix byte ordering issues during multiprocessing
-    # for linear processing: spectrum[''].byteswap().newbyteorder()
+    mz_array = spectrum['m/z array'].astype(spectrum['m/z array'].dtype.newbyteorder('='))
+    intensity_array = spectrum['intensity array'].astype(spectrum['intensity array'].dtype.newbyteorder('='))
+    # fix byte ordering issues; pyteomics arrays are big endian until pickled to/from a worker process
+    # converts values so spectra inherited by forked workers (pool initializer) are read correctly as well
     return pandas.DataFrame({'m/z': mz_array, 'intensity': intensity_array})
 
-def load_control_data(args):
-    # load control dataset
+def control_file_detection(args):
+    # find control .mzXML file(s); converts raw control data in control directory if no .mzXML files found
     if args['control'] == '':
         print "No control file specified. Exiting BLANKA."
         sys.exit(1)
     if args['control'].endswith('.mzXML'):
-        return list(pytmzxml.read(args['control']))
+        return [args['control']]
     elif args['control'].endswith('d') or args['control'].endswith('.RAW'):
         args['control'] = args['control'].split('.')[0] + '.mzXML'
-        return list(pytmzxml.read(args['control']))
+        return [args['control']]
     else:
         control_files = [os.path.join(dirpath, files) for dirpath, dirnames, filenames in os.walk(args['control'])
                          for files in filenames if files.endswith('.mzXML')]
@@ -67,13 +79,109 @@ def load_control_data(args):
             msconvert(args, control_raw_list)
             control_files = [os.path.join(dirpath, files) for dirpath, dirnames, filenames in os.walk(args['control'])
                              for files in filenames if files.endswith('.mzXML')]
-        control_data = []
-        for control in control_files:
-            control_data += list(pytmzxml.read(control))
-        print len(control_data)
-        return control_data
+        return control_files
+
+def load_control_data(args, control_files=None, worker_pool=None):
+    # load control dataset; control_files from control_file_detection if not given
+    # scans decoded in parallel by worker_pool if given
+    if control_files == None:
+        control_files = control_file_detection(args)
+    control_data = []
+    for control in control_files:
+        if worker_pool == None:
+            control_data += list(blanka_mzxml.read_spectra(control))
+        else:
+            control_data += blanka_mzxml.read_spectra_parallel(worker_pool, control, args['cpu'] * 4)
+    print len(control_data)
+    return control_data
 
-def select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_spectra_data):
+def read_control_data(args, control_files=None):
+    # lazily read control dataset one spectrum at a time for streaming mode
+    if control_files == None:
+        control_files = control_file_detection(args)
+    for control in control_files:
+        for spectrum in blanka_mzxml.read_spectra(control):
+            yield spectrum
+
+def build_control_index(control_spectra_data):
+    # index control spectra for select_control_spectrum
+    # spectra grouped by ms level and sorted by retention time (seconds); ms2 spectra also get a precursor m/z sorted
+    # view so candidates come from range queries instead of a scan of the full control dataset
+    control_index = {}
+    for ms_level in (1, 2):
+        level_order = [count for count, i in enumerate(control_spectra_data) if i['msLevel'] == ms_level]
+        ret_times = numpy.array([control_spectra_data[i]['retentionTime'] * 60 for i in level_order],
+                                dtype=numpy.float64)
+        if ms_level == 2:
+            precursor_mzs = numpy.array([control_spectra_data[i]['precursorMz'][0]['precursorMz']
+                                         for i in level_order], dtype=numpy.float64)
+        else:
+            precursor_mzs = numpy.zeros(len(level_order), dtype=numpy.float64)
+        rettime_sorted_indexes = numpy.argsort(ret_times, kind='mergesort')
+        ret_times = ret_times[rettime_sorted_indexes]
+        precursor_mzs = precursor_mzs[rettime_sorted_indexes]
+        precursor_sorted_indexes = numpy.argsort(precursor_mzs, kind='mergesort')
+        control_index[ms_level] = {'spectra': [control_spectra_data[level_order[i]] for i in rettime_sorted_indexes],
+                                   'order': numpy.array(level_order, dtype=numpy.int64)[rettime_sorted_indexes],
+                                   'retention time': ret_times,
+                                   'precursor m/z': precursor_mzs,
+                                   'precursor order': precursor_sorted_indexes,
+                                   'sorted precursor m/z': precursor_mzs[precursor_sorted_indexes]}
+    return control_index
+
+def select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_index):
+    # select spectrum to use as control from indexed control dataset based on given parameters
+    # same matching criteria and best match scoring as old_select_control_spectrum
+    if ms_mode == 1:
+        level_index = control_index[1]
+    elif ms_mode >= 2:
+        level_index = control_index[2]
+    ret_time_tolerance = args['retention_time_tolerance']
+    padding = 1e-6
+    # range bounds are padded slightly; the exact tolerance test below decides edge cases
+    ret_times = level_index['retention time']
+    rettime_start = numpy.searchsorted(ret_times, ret_time - ret_time_tolerance - padding, side='left')
+    rettime_end = numpy.searchsorted(ret_times, ret_time + ret_time_tolerance + padding, side='right')
+    candidates = numpy.arange(rettime_start, rettime_end)
+    if ms_mode >= 2:
+        # use whichever of the retention time or precursor mz ranges is narrower
+        precursor_mz_tolerance = args['precursor_mz_tolerance']
+        sorted_precursor_mzs = level_index['sorted precursor m/z']
+        precursor_start = numpy.searchsorted(sorted_precursor_mzs, precursor_mz - precursor_mz_tolerance - padding,
+                                             side='left')
+        precursor_end = numpy.searchsorted(sorted_precursor_mzs, precursor_mz + precursor_mz_tolerance + padding,
+                                           side='right')
+        if (precursor_end - precursor_start) < (rettime_end - rettime_start):
+            candidates = level_index['precursor order'][precursor_start:precursor_end]
+    candidate_ret_times = ret_times[candidates]
+    matches = ((candidate_ret_times + ret_time_tolerance) >= ret_time) & \
+              (ret_time >= (candidate_ret_times - ret_time_tolerance))
+    if ms_mode >= 2:
+        candidate_precursor_mzs = level_index['precursor m/z'][candidates]
+        matches &= ((candidate_precursor_mzs + precursor_mz_tolerance) >= precursor_mz) & \
+                   (precursor_mz >= (candidate_precursor_mzs - precursor_mz_tolerance))
+    candidates = candidates[matches]
+    if len(candidates) == 0:
+        # return None if no matching spectra found
+        return None
+    # restore control dataset order so ties are broken the same way as the linear scan
+    candidates = candidates[numpy.argsort(level_index['order'][candidates], kind='mergesort')]
+    if len(candidates) == 1:
+        return level_index['spectra'][int(candidates[0])]
+    # return best match if more than one spectra found meeting criteria
+    ret_time_indexes = numpy.abs(ret_time - ret_times[candidates])
+    if ms_mode == 1:
+        return level_index['spectra'][int(candidates[numpy.argmin(ret_time_indexes)])]
+    # scores each spectrum based on how close retention time and precursor mz are compared to each spectra
+    precursor_mz_indexes = numpy.abs(precursor_mz - level_index['precursor m/z'][candidates])
+    ranks = numpy.arange(1, len(candidates) + 1)
+    score = numpy.zeros(len(candidates), dtype=numpy.int64)
+    score[numpy.argsort(ret_time_indexes)] += ranks
+    score[numpy.argsort(precursor_mz_indexes)] += ranks
+    return level_index['spectra'][int(candidates[numpy.argmax(score)])]
+
+def old_select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_spectra_data):
+    # deprecated function; linear scan replaced by build_control_index and select_control_spectrum
     # select spectrum to use as control from control dataset based on given parameters
     if ms_mode == 1:
         # search by retention time for MS1
@@ -111,23 +219,45 @@ def select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_spect
         elif len(control_spectra_list) == 1:
             return control_spectra_list[0]
 
-def noise_removal(signal_noise_ratio, spectrum):
-    # remove noise using average of 5% lowest intensity peaks as noise level and user defined signal/noise ratio
-    if len(spectrum['m/z array']) == 0:
-        spectrum_dataframe = spectrum_to_dataframe(spectrum)
-        spectrum_dataframe = spectrum_dataframe.drop(spectrum_dataframe[spectrum_dataframe['intensity'] == 0].index)
-        if not spectrum_dataframe.empty:
-            sorted_intensities = sorted(spectrum_dataframe['intensity'].values.tolist())
-            lowest_sorted_intensities = sorted_intensities[:int(round((len(sorted_intensities)*0.05)))]
-            if len(lowest_sorted_intensities) == 0:
-                spectrum_noise = sum(lowest_sorted_intensities)/len(lowest_sorted_intensities)
-                print spectrum_noise
-                spectrum_dataframe = spectrum_dataframe.drop(spectrum_dataframe[spectrum_dataframe['intensity'] <= (signal_noise_ratio * spectrum_noise)].index)
-                spectrum['m/z array'] = spectrum_dataframe['m/z'].values
-                spectrum['intensity array'] = spectrum_dataframe['intensity'].values
+def noise_removal(signal_noise_ratio, noise_percentile, spectrum):
+    # remove noise using average of lowest intensity peaks (noise_percentile %, default 5%) as noise level and user
+    # defined signal/noise ratio
+    keep = kernels.noise_removal_mask(spectrum['intensity array'], numpy.array([0, len(spectrum['intensity array'])]),
+                                      signal_noise_ratio, noise_percentile)
+    spectrum['m/z array'] = spectrum['m/z array'][keep]
+    spectrum['intensity array'] = spectrum['intensity array'][keep]
     return spectrum
 
+def noise_removal_block(signal_noise_ratio, noise_percentile, spectra):
+    # noise_removal for a block of spectra in one pass over their concatenated peak arrays
+    mz_array, intensity_array, offsets = kernels.pack_spectra(spectra)
+    keep = kernels.noise_removal_mask(intensity_array, offsets, signal_noise_ratio, noise_percentile)
+    mz_array = mz_array[keep]
+    intensity_array = intensity_array[keep]
+    offsets = kernels.mask_offsets(keep, offsets)
+    for count, spectrum in enumerate(spectra):
+        spectrum['m/z array'] = mz_array[offsets[count]:offsets[count + 1]]
+        spectrum['intensity array'] = intensity_array[offsets[count]:offsets[count + 1]]
+    return spectra
+
 def blank_removal(sample_spectrum, control_spectrum, peak_mz_tolerance):
+    # remove control spectrum peaks from sample spectrum if m/z within specified tolerance
+    # returns processed sample spectrum and dictionary with removed peaks
+    if len(sample_spectrum['m/z array']) != 0 and len(control_spectrum['m/z array']) != 0:
+        removed = kernels.blank_removal_mask(sample_spectrum['m/z array'], control_spectrum['m/z array'],
+                                             control_spectrum['intensity array'], peak_mz_tolerance)
+        changed_dict = sample_spectrum.copy()
+        # shallow copy; spectrum metadata shared with processed spectrum instead of deep copied
+        changed_dict['m/z array'] = sample_spectrum['m/z array'][removed]
+        changed_dict['intensity array'] = sample_spectrum['intensity array'][removed]
+        sample_spectrum['m/z array'] = sample_spectrum['m/z array'][~removed]
+        sample_spectrum['intensity array'] = sample_spectrum['intensity array'][~removed]
+        return [sample_spectrum, changed_dict]
+    else:
+        return [sample_spectrum, None]
+
+def old_blank_removal(sample_spectrum, control_spectrum, peak_mz_tolerance):
+    # deprecated function; merge_asof version of blank_removal
     # remove control spectrum peaks from sample spectrum if m/z within specified tolerance
     # returns processed sample spectrum and dictionary with removed peaks
     sample_spectrum_df = spectrum_to_dataframe(sample_spectrum)
@@ -147,48 +277,107 @@ def blank_removal(sample_spectrum, control_spectrum, peak_mz_tolerance):
     else:
         return [sample_spectrum, None]
 
-def spectra_compare(args, control_dataset, sample_spectrum):
+worker_control_index = None
+# indexed control dataset held by each pool worker
+
+def init_control_worker(control_index):
+    # pool initializer; stores indexed control dataset in the worker process once instead of pickling it per task
+    global worker_control_index
+    worker_control_index = control_index
+
+def worker_spectra_compare(args, sample_spectrum):
+    # spectra_compare using control dataset stored by init_control_worker
+    return spectra_compare(args, worker_control_index, sample_spectrum)
+
+def worker_noise_blank_removal(args, sample_spectrum):
+    # remove noise and blank in a single pass using control dataset stored by init_control_worker
+    # returns noise removed spectrum with spectra_compare output so each spectrum is only sent to a worker once
+    noiseless_spectrum = noise_removal(args['signal_noise_ratio'], args['noise_percentile'], sample_spectrum)
+    processed_spectrum = spectra_compare(args, worker_control_index, noiseless_spectrum.copy())
+    # shallow copy; blank_removal replaces arrays in the spectrum dict it is given
+    return [noiseless_spectrum, processed_spectrum]
+
+def worker_dataset_removal(args, dataset):
+    # process a whole dataset in one worker (file level parallelism) using control dataset stored by
+    # init_control_worker; reads .mzXML, removes noise and/or blank and writes .mgf files in the worker
+    # dataset = [.mzXML path, output prefix]; returns .mzXML path, number of spectra processed and output files
+    sample_data = list(blanka_mzxml.read_spectra(dataset[0]))
+    with dataset_mgf_writer(dataset[1], args['background_writer'], args['output_format']) as mgf_files:
+        if args['blank_removal_only'] == False:
+            sample_data = noise_removal_block(args['signal_noise_ratio'], args['noise_percentile'], sample_data)
+        for spectrum in sample_data:
+            if args['blank_removal_only'] == False:
+                mgf_files.write(spectrum, 'noise_removed')
+            if args['noise_removal_only'] == False:
+                processed_spectrum = spectra_compare(args, worker_control_index, spectrum.copy())
+                if processed_spectrum != None:
+                    mgf_files.write(processed_spectrum[0], 'processed')
+                    if processed_spectrum[1] != None:
+                        mgf_files.write(processed_spectrum[1], 'removed_peaks')
+    return [dataset[0], len(sample_data), mgf_files.output_paths]
+
+def worker_store_removal(args, store_range):
+    # remove noise and/or blank for scans [start, stop) of a sample peak store (--sample_store) using control dataset
+    # stored by init_control_worker; peaks read from the memory mapped store and results written in the output format
+    # at the range's output prefix, so only the range is sent to the worker and only a count sent back
+    # store_range = [peak store path, range output prefix, start, stop, dataset output prefix (spectrum titles)]
+    # returns number of spectra processed
+    mz_array, intensity_array, offsets, metadata = blanka_store.read_range(store_range[0], store_range[2],
+                                                                           store_range[3])
+    if args['blank_removal_only'] == False:
+        keep = kernels.noise_removal_mask(intensity_array, offsets, args['signal_noise_ratio'],
+                                          args['noise_percentile'])
+        mz_array = mz_array[keep]
+        intensity_array = intensity_array[keep]
+        offsets = kernels.mask_offsets(keep, offsets)
+        # same as noise_removal_block on the range's contiguous peaks
+    with dataset_mgf_writer(store_range[1], output_format=args['output_format']) as result_files:
+        result_files.title = blanka_mgf.output_title(store_range[4])
+        for spectrum in blanka_binary.container_spectra(metadata, mz_array, intensity_array, offsets):
+            if args['blank_removal_only'] == False:
+                result_files.write(spectrum, 'noise_removed')
+            if args['noise_removal_only'] == False:
+                processed_spectrum = spectra_compare(args, worker_control_index, spectrum.copy())
+                if processed_spectrum != None:
+                    result_files.write(processed_spectrum[0], 'processed')
+                    if processed_spectrum[1] != None:
+                        result_files.write(processed_spectrum[1], 'removed_peaks')
+    return len(metadata)
+
+def spectra_compare(args, control_index, sample_spectrum, select_function=None, removal_function=None):
     # select control spectrum and remove blanks
+    # select_function/removal_function: called instead of select_control_spectrum/blank_removal with the same
+    # arguments (ex: timed versions for --profile)
+    if select_function == None:
+        select_function = select_control_spectrum
+    if removal_function == None:
+        removal_function = blank_removal
     ms_mode = sample_spectrum['msLevel']
     ret_time = sample_spectrum['retentionTime'] * 60
     if ms_mode > 1:
         precursor_mz = sample_spectrum['precursorMz'][0]['precursorMz']
     else:
         precursor_mz = None
-    control_spectrum = select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_dataset)
+    control_spectrum = select_function(args, ms_mode, ret_time, precursor_mz, control_index)
     if control_spectrum == None:
         return [sample_spectrum, None]
     elif ms_mode != 2:
-        processed_spectrum = blank_removal(sample_spectrum, control_spectrum, args['peak_mz_tolerance'])
+        processed_spectrum = removal_function(sample_spectrum, control_spectrum, args['peak_mz_tolerance'])
         return processed_spectrum
         # processed_spectrum = [sample_spectrum, changed_dict]
 
+def dataset_mgf_writer(output_dir, background=False, output_format='mgf', resume_files=None):
+    # .mgf writer that keeps output files open for a whole dataset; optionally writes on a background thread
+    # output_format = 'binary' writes memory mappable binary containers (blanka_binary) instead of .mgf
+    # resume_files: output file sizes from a checkpoint of an interrupted run to continue from
+    if output_format == 'binary':
+        return blanka_binary.BinaryWriter(output_dir, background, resume_files=resume_files)
+    return blanka_mgf.MgfWriter(output_dir, background, resume_files=resume_files)
+
 def mgf_writer(spectrum_data_dict, output_dir, datatype):
-    with open(output_dir + datatype + '_data_ms2.mgf', 'a') as mgf_file:
-        if spectrum_data_dict['msLevel'] >= 2:
-            mgf_file.write("BEGIN IONS" + "\n")
-            mgf_file.write("TITLE=" + output_dir.split("\\")[-1].split("_blanka_")[0] + "." + spectrum_data_dict['num']
-                       + "." + spectrum_data_dict['num'] + '. File:"' + output_dir.split("\\")[-1].split("_blanka_")[0]
-                       + '.RAW", NativeID:"controllerType=0 controllerNumber=1 scan=' + spectrum_data_dict['num'] + '"'
-                       + "\n")
-            mgf_file.write("RTINSECONDS=" + str(spectrum_data_dict['retentionTime'] * 60) + "\n")
-            mgf_file.write("PEPMASS=" + str(spectrum_data_dict['precursorMz'][0]['precursorMz']) + " "
-                           + str(spectrum_data_dict['precursorMz'][0]['precursorIntensity']) + "\n")
-            for mz, intensity in zip(spectrum_data_dict['m/z array'], spectrum_data_dict['intensity array']):
-                mgf_file.write(str(mz) + ' ' + str(intensity) + "\n")
-            mgf_file.write("END IONS" + "\n")
-    with open(output_dir + datatype + '_data_full.mgf', 'a') as mgf_file:
-        mgf_file.write("BEGIN IONS" + "\n")
-        mgf_file.write("TITLE=" + output_dir.split("\\")[-1].split("_blanka_")[0] + "." + spectrum_data_dict['num']
-                   + "." + spectrum_data_dict['num'] + '. File:"' + output_dir.split("\\")[-1].split("_blanka_")[0]
-                   + '.RAW", NativeID:"controllerType=0 controllerNumber=1 scan=' + spectrum_data_dict['num'] + '"'                       + "\n")
-        mgf_file.write("RTINSECONDS=" + str(spectrum_data_dict['retentionTime'] * 60) + "\n")
-        if spectrum_data_dict['msLevel'] >= 2:
-            mgf_file.write("PEPMASS=" + str(spectrum_data_dict['precursorMz'][0]['precursorMz']) + " "
-                           + str(spectrum_data_dict['precursorMz'][0]['precursorIntensity']) + "\n")
-        for mz, intensity in zip(spectrum_data_dict['m/z array'], spectrum_data_dict['intensity array']):
-            mgf_file.write(str(mz) + ' ' + str(intensity) + "\n")
-        mgf_file.write("END IONS" + "\n")
+    # append single spectrum to .mgf; dataset_mgf_writer avoids reopening the files for every spectrum
+    with blanka_mgf.MgfWriter(output_dir, append=True) as mgf_writer_files:
+        mgf_writer_files.write(spectrum_data_dict, datatype)
 
 def old_mgf_writer(spectrum_data_dict, output_dir, datatype):
     # deprecated function
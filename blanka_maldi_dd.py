@@ -1,8 +1,13 @@
-import argparse, subprocess, os, copy, sys, pandas, numpy, timeit
+import argparse, subprocess, os, re, copy, sys, pandas, numpy, timeit
 import pyteomics.mzxml as pytmzxml
 import pyteomics.mgf as pytmgf
 from multiprocessing import Pool, cpu_count
 from functools import partial
+import blanka_kernels as kernels
+import blanka_mgf
+import blanka_binary
+import blanka_convert as convert
+import blanka_mzxml
 
 def mzxml_data_detection(directory):
     # scan directory for .mzXML files
@@ -14,48 +19,130 @@ def raw_data_detection(args):
     return [os.path.join(dirpath, files) for dirpath, dirnames, filenames in os.walk(args['sample'])
             for files in filenames if files == 'fid']
 
+path_separator_pattern = re.compile(r'[\\/]')
+
+def template_spot_names(args):
+    # (sample name, spot) pairs from IDBac Excel template; spot = template row + column number (ex: A1)
+    template_df = pandas.read_excel(args['dd_template']).fillna(0)
+    template_list = template_df.values.tolist()
+    return [(str(j), str(i[0]) + str(count)) for i in template_list for count, j in enumerate(i[1:], 1) if j != 0]
+
+def spot_path_index(path_list):
+    # {spot: [paths]} index of raw data paths by spot directory, built once so template spots are looked up instead
+    # of searched for in every path
+    # Autoflex spot directories end with the spot after an underscore (ex: D:\plate\0_A1\1\1SLin\fid)
+    index = {}
+    for path in path_list:
+        for spot in set([directory.split('_')[-1] for directory in path_separator_pattern.split(path)[:-1]]):
+            index.setdefault(spot, []).append(path)
+    return index
+
 def parse_maldi_template(args, msconvert_list):
+    # parse MALDI DD names from IDBac Excel template and match them to raw data paths with spot_path_index
+    # returns (raw data path, sample name + '_' + spot) pairs in template order
+    index = spot_path_index(msconvert_list)
+    return [(path, name + '_' + spot) for name, spot in template_spot_names(args) for path in index.get(spot, [])]
+
+def old_parse_maldi_template(args, msconvert_list):
+    # deprecated function; substring search of every raw data path for every template spot
     # parse MALDI DD names from IDBac Excel template
     template_df = pandas.read_excel(args['dd_template']).fillna(0)
     template_list = template_df.values.tolist()
     names_list = [(str(j), str(i[0]) + str(count)) for i in template_list for count, j in enumerate(i[1:], 1) if j != 0]
     return [(j, i[0] + '_' + i[1]) for i in names_list for j in msconvert_list if i[1] + '\\' in j]
 
-def msconvert(args, msconvert_list):
-    # convert raw data files detected into .mzXML format using MSConvert and default Sanchez Lab settings
-    with open('config.ini', 'r') as config_file:
-        msconvert_path = config_file.read().split('=')[1] + ' '
+def raw_plate_directory(args, raw_path):
+    # plate directory of a raw spot relative to the sample directory ('.' if the sample directory is the plate)
+    # Autoflex spot data is <plate>\<spot>\1\1SLin\fid
+    plate = raw_path
+    for count in range(4):
+        plate = os.path.dirname(plate)
+    return os.path.relpath(plate, args['sample'])
+
+def msconvert_jobs(args, msconvert_list):
+    # conversion jobs for raw data files detected; output directory taken from first raw file if not specified
+    # spots of each plate converted into the plate's subdirectory of the output directory so plates stay apart
+    # (see spot_plate)
+    jobs = []
     for files in msconvert_list:
         if args['output'] == '':
             args['output'] = files[0][:files[0].find('fid')]
-        msconvert = msconvert_path + files[0] + " -o " + args['output'] + " --outfile " + files[1] + \
-                    ' --mzXML --32 --mz32 --inten32\
-                    --filter "titleMaker <RunId>.<ScanNumber>.<ScanNumber>.<ChargeState>"\
-                    --filter "peakPicking true 1-2"'
-        print msconvert
-        subprocess.call(msconvert)
+        output_dir = os.path.normpath(os.path.join(args['output'], raw_plate_directory(args, files[0])))
+        jobs.append(convert.conversion_job(files[0], output_dir, files[1]))
+    return jobs
+
+def msconvert(args, msconvert_list):
+    # convert raw data files detected into .mzXML format using MSConvert and default Sanchez Lab settings
+    # up to args['max_conversions'] MSConvert processes at once; up to date .mzXML files are not reconverted
+    # returns converted .mzXML files
+    return list(convert.convert(msconvert_jobs(args, msconvert_list), args['max_conversions']))
 
 def spectrum_to_dataframe(spectrum):
     # convert spectrum to dataframe
-    mz_array = spectrum['m/z array'].newbyteorder('=')
-    intensity_array = spectrum['intensity array'].newbyteorder('=')
-    # fix byte ordering issues during multiprocessing
-    # for linear processing: spectrum[''].byteswap().newbyteorder()
+    mz_array = spectrum['m/z array'].astype(spectrum['m/z array'].dtype.newbyteorder('='))
+    intensity_array = spectrum['intensity array'].astype(spectrum['intensity array'].dtype.newbyteorder('='))
+    # fix byte ordering issues; pyteomics arrays are big endian until pickled to/from a worker process
+    # converts values so spectra inherited by forked workers (pool initializer) are read correctly as well
     return pandas.DataFrame({'m/z': mz_array, 'intensity': intensity_array}).astype({'m/z': numpy.float32,
                                                                                       'intensity': numpy.float32})
     # set all arrays as float32 to prevent different dtype error when using merge_asof
 
-def load_control_data(args):
-    # load control data files
+def control_file_detection(args):
+    # find control spot .mzXML files in sample (or output) directory
     if args['output'] == '':
         directory = args['sample']
     else:
         directory = args['output']
-    mzxml_list = [os.path.join(dirpath, files) for dirpath, dirnames, filenames in os.walk(directory)
-                  for files in filenames if files.startswith(args['control']) and files.endswith('.mzXML')]
-    return [[[list(pytmzxml.read(mzxml))[0], mzxml], mzxml_list] for mzxml in mzxml_list]
+    return [os.path.join(dirpath, files) for dirpath, dirnames, filenames in os.walk(directory)
+            for files in filenames if files.startswith(args['control']) and files.endswith('.mzXML')]
+
+def spot_plate(mzxml):
+    # plate of a spot .mzXML file; spot files of a plate are kept in the same directory
+    return os.path.dirname(os.path.abspath(mzxml))
+
+def group_plates(sample_list, control_list):
+    # [plate, control spot files, sample spot files] for each plate in order of first sample spot
+    # plates without control spots use control spots from all plates
+    plates = []
+    plate_spots = {}
+    for mzxml in sample_list:
+        plate = spot_plate(mzxml)
+        if plate not in plate_spots:
+            plate_spots[plate] = [plate, [], []]
+            plates.append(plate_spots[plate])
+        plate_spots[plate][2].append(mzxml)
+    for mzxml in control_list:
+        if spot_plate(mzxml) in plate_spots:
+            plate_spots[spot_plate(mzxml)][1].append(mzxml)
+    for plate in plates:
+        if plate[1] == []:
+            plate[1] = control_list
+    return plates
+
+def load_control_data(args, mzxml_list=None):
+    # load control data files; mzxml_list from control_file_detection if not given
+    # only the first scan of each spot file is decoded
+    if mzxml_list == None:
+        mzxml_list = control_file_detection(args)
+    return [[[blanka_mzxml.read_first_spectrum(mzxml), mzxml], mzxml_list] for mzxml in mzxml_list]
 
-def combine_control_spectra(noiseless_control_data):
+consensus_keys = ['m/z array', 'intensity array', 'max intensity array', 'm/z min array', 'm/z max array',
+                  'spot count array']
+# per bin arrays of a consensus control spectrum
+
+def consensus_control_spectrum(noiseless_control_data, peak_mz_tolerance, min_spots=1):
+    # combine control spot spectra into one consensus spectrum; peaks within peak_mz_tolerance of each other binned
+    # together so the spectrum stays small with many control spots
+    # each bin has intensity weighted m/z, summed and max intensity, m/z range and the number of control spots with a
+    # peak in it; bins found in fewer than min_spots control spots are dropped
+    mz_array, intensity_array, offsets = kernels.pack_spectra([spectrum[0] for spectrum in noiseless_control_data])
+    bins = kernels.consensus_bins(mz_array.astype(numpy.float32), intensity_array.astype(numpy.float32), offsets,
+                                  peak_mz_tolerance)
+    keep = bins[5] >= min_spots
+    return {key: array[keep] for key, array in zip(consensus_keys, bins)}
+
+def old_combine_control_spectra(noiseless_control_data):
+    # deprecated function; exact m/z groupby version of consensus_control_spectrum
     noiseless_control_dataframes = [pandas.DataFrame({'m/z': spectrum[0]['m/z array'].byteswap().newbyteorder(),
                                                  'intensity': spectrum[0]['intensity array'].byteswap().newbyteorder()})
                                .astype({'m/z': numpy.float32, 'intensity': numpy.float32})
@@ -64,23 +151,53 @@ def combine_control_spectra(noiseless_control_data):
                                                                                                 as_index=False).sum()
     return {'m/z array': big_control_df['m/z'].values, 'intensity array': big_control_df['intensity'].values}
 
-def noise_removal(signal_noise_ratio, spectrum):
-    # remove noise using average of 5% lowest intensity peaks as noise level and user defined signal/noise ratio
-    if len(spectrum['m/z array']) == 0:
-        spectrum_dataframe = spectrum_to_dataframe(spectrum[0])
-        spectrum_dataframe = spectrum_dataframe.drop(spectrum_dataframe[spectrum_dataframe['intensity'] == 0].index)
-        if not spectrum_dataframe.empty:
-            sorted_intensities = sorted(spectrum_dataframe['intensity'].values.tolist())
-            lowest_sorted_intensities = sorted_intensities[:int(round((len(sorted_intensities)*0.05)))]
-            if len(lowest_sorted_intensities) == 0:
-                spectrum_noise = sum(lowest_sorted_intensities)/len(lowest_sorted_intensities)
-                print spectrum_noise
-                spectrum_dataframe = spectrum_dataframe.drop(spectrum_dataframe[spectrum_dataframe['intensity'] <= (signal_noise_ratio * spectrum_noise)].index)
-                spectrum[0]['m/z array'] = spectrum_dataframe['m/z'].values
-                spectrum[0]['intensity array'] = spectrum_dataframe['intensity'].values
+def noise_removal(signal_noise_ratio, noise_percentile, spectrum):
+    # remove noise using average of lowest intensity peaks (noise_percentile %, default 5%) as noise level and user
+    # defined signal/noise ratio
+    keep = kernels.noise_removal_mask(spectrum[0]['intensity array'],
+                                      numpy.array([0, len(spectrum[0]['intensity array'])]), signal_noise_ratio,
+                                      noise_percentile)
+    spectrum[0]['m/z array'] = spectrum[0]['m/z array'][keep]
+    spectrum[0]['intensity array'] = spectrum[0]['intensity array'][keep]
     return [spectrum[0], spectrum[1]]
 
+def noise_removal_block(signal_noise_ratio, noise_percentile, spectra):
+    # noise_removal for a block of [spectrum, filename] pairs in one pass over their concatenated peak arrays
+    mz_array, intensity_array, offsets = kernels.pack_spectra([spectrum[0] for spectrum in spectra])
+    keep = kernels.noise_removal_mask(intensity_array, offsets, signal_noise_ratio, noise_percentile)
+    mz_array = mz_array[keep]
+    intensity_array = intensity_array[keep]
+    offsets = kernels.mask_offsets(keep, offsets)
+    for count, spectrum in enumerate(spectra):
+        spectrum[0]['m/z array'] = mz_array[offsets[count]:offsets[count + 1]]
+        spectrum[0]['intensity array'] = intensity_array[offsets[count]:offsets[count + 1]]
+    return [[spectrum[0], spectrum[1]] for spectrum in spectra]
+
 def blank_removal(peak_mz_tolerance, control_spectrum, sample_spectrum):
+    # remove control spectrum peaks from sample spectrum if m/z within specified tolerance
+    # returns processed sample spectrum and dictionary with removed peaks
+    # control_spectrum from consensus_control_spectrum
+    # sample arrays compared and returned as native float32, same as the merge_asof version (old_blank_removal)
+    # differs from old_blank_removal only for zero intensity control peaks: they are dropped from the consensus
+    # spectrum, so a sample peak is removed if any control peak with intensity is within peak_mz_tolerance instead of
+    # being kept when its nearest control peak has zero intensity
+    if len(sample_spectrum[0]['m/z array']) != 0 and len(control_spectrum['m/z array']) != 0:
+        mz_array = sample_spectrum[0]['m/z array'].astype(numpy.float32)
+        intensity_array = sample_spectrum[0]['intensity array'].astype(numpy.float32)
+        removed = kernels.consensus_removal_mask(mz_array, control_spectrum['m/z min array'],
+                                                 control_spectrum['m/z max array'], peak_mz_tolerance)
+        changed_dict = sample_spectrum[0].copy()
+        # shallow copy; spectrum metadata shared with processed spectrum instead of deep copied
+        changed_dict['m/z array'] = mz_array[removed]
+        changed_dict['intensity array'] = intensity_array[removed]
+        sample_spectrum[0]['m/z array'] = mz_array[~removed]
+        sample_spectrum[0]['intensity array'] = intensity_array[~removed]
+        return [[sample_spectrum[0], sample_spectrum[1]], changed_dict]
+    else:
+        return [[sample_spectrum[0], sample_spectrum[1]], None]
+
+def old_blank_removal(peak_mz_tolerance, control_spectrum, sample_spectrum):
+    # deprecated function; merge_asof version of blank_removal
     # remove control spectrum peaks from sample spectrum if m/z within specified tolerance
     # returns processed sample spectrum and dictionary with removed peaks
     sample_spectrum_df = spectrum_to_dataframe(sample_spectrum[0])
@@ -100,32 +217,62 @@ def blank_removal(peak_mz_tolerance, control_spectrum, sample_spectrum):
     else:
         return [[sample_spectrum[0], sample_spectrum[1]], None]
 
+worker_plate_controls = {}
+# {plate: combined control spectrum} held by each pool worker
+
+def init_plate_control_worker(plate_controls):
+    # pool initializer; stores combined control spectrum of each plate in the worker process once instead of pickling
+    # it per task
+    global worker_plate_controls
+    worker_plate_controls = plate_controls
+
+def worker_plate_control(mzxml):
+    # combined control spectrum stored by init_plate_control_worker for the plate of a spot .mzXML file
+    return worker_plate_controls[spot_plate(mzxml)]
+
+def worker_blank_removal(peak_mz_tolerance, sample_spectrum):
+    # blank_removal using the combined control spectrum of the spot's plate
+    return blank_removal(peak_mz_tolerance, worker_plate_control(sample_spectrum[1]), sample_spectrum)
+
+def worker_noise_blank_removal(args, sample_spectrum):
+    # remove noise and blank in a single pass using the combined control spectrum of the spot's plate
+    # returns noise removed spectrum with blank_removal output so each spectrum is only sent to a worker once
+    noiseless_spectrum = noise_removal(args['signal_noise_ratio'], args['noise_percentile'], sample_spectrum)
+    processed_spectrum = blank_removal(args['peak_mz_tolerance'], worker_plate_control(noiseless_spectrum[1]),
+                                       [noiseless_spectrum[0].copy(), noiseless_spectrum[1]])
+    # shallow copy; blank_removal replaces arrays in the spectrum dict it is given
+    return [noiseless_spectrum, processed_spectrum]
+
+def worker_dataset_removal(args, dataset):
+    # process a whole spot in one worker (file level parallelism) using the combined control spectrum of its plate;
+    # reads .mzXML, removes noise and/or blank and writes .mgf files in the worker
+    # dataset = [.mzXML path, output prefix]; returns .mzXML path, number of spectra processed and output files
+    sample_spectrum = [blanka_mzxml.read_first_spectrum(dataset[0]), dataset[0]]
+    with dataset_mgf_writer(dataset[1], args['background_writer'], args['output_format']) as mgf_files:
+        if args['blank_removal_only'] == False:
+            sample_spectrum = noise_removal(args['signal_noise_ratio'], args['noise_percentile'], sample_spectrum)
+            mgf_files.write(sample_spectrum[0], 'noise_removed')
+        if args['noise_removal_only'] == False:
+            spectrum, changed_spectrum_data = blank_removal(args['peak_mz_tolerance'],
+                                                            worker_plate_control(dataset[0]),
+                                                            [sample_spectrum[0].copy(), sample_spectrum[1]])
+            mgf_files.write(spectrum[0], 'processed')
+            if changed_spectrum_data != None:
+                mgf_files.write(changed_spectrum_data, 'removed_peaks')
+    return [dataset[0], 1, mgf_files.output_paths]
+
+def dataset_mgf_writer(output_dir, background=False, output_format='mgf', resume_files=None):
+    # .mgf writer that keeps output files open for a whole dataset; optionally writes on a background thread
+    # output_format = 'binary' writes memory mappable binary containers (blanka_binary) instead of .mgf
+    # resume_files: output file sizes from a checkpoint of an interrupted run to continue from
+    if output_format == 'binary':
+        return blanka_binary.BinaryWriter(output_dir, background, ms2_retention_time_factor=1, resume_files=resume_files)
+    return blanka_mgf.MgfWriter(output_dir, background, ms2_retention_time_factor=1, resume_files=resume_files)
+
 def mgf_writer(spectrum_data_dict, output_dir, datatype):
-    with open(output_dir + datatype + '_data_ms2.mgf', 'a') as mgf_file:
-        if spectrum_data_dict['msLevel'] >= 2:
-            mgf_file.write("BEGIN IONS" + "\n")
-            mgf_file.write("TITLE=" + output_dir.split("\\")[-1].split("_blanka_")[0] + "." + spectrum_data_dict['num']
-                       + "." + spectrum_data_dict['num'] + '. File:"' + output_dir.split("\\")[-1].split("_blanka_")[0]
-                       + '.RAW", NativeID:"controllerType=0 controllerNumber=1 scan=' + spectrum_data_dict['num'] + '"'
-                       + "\n")
-            mgf_file.write("RTINSECONDS=" + str(spectrum_data_dict['retentionTime']) + "\n")
-            mgf_file.write("PEPMASS=" + str(spectrum_data_dict['precursorMz'][0]['precursorMz']) + " "
-                           + str(spectrum_data_dict['precursorMz'][0]['precursorIntensity']) + "\n")
-            for mz, intensity in zip(spectrum_data_dict['m/z array'], spectrum_data_dict['intensity array']):
-                mgf_file.write(str(mz) + ' ' + str(intensity) + "\n")
-            mgf_file.write("END IONS" + "\n")
-    with open(output_dir + datatype + '_data_full.mgf', 'a') as mgf_file:
-        mgf_file.write("BEGIN IONS" + "\n")
-        mgf_file.write("TITLE=" + output_dir.split("\\")[-1].split("_blanka_")[0] + "." + spectrum_data_dict['num']
-                   + "." + spectrum_data_dict['num'] + '. File:"' + output_dir.split("\\")[-1].split("_blanka_")[0]
-                   + '.RAW", NativeID:"controllerType=0 controllerNumber=1 scan=' + spectrum_data_dict['num'] + '"'                       + "\n")
-        mgf_file.write("RTINSECONDS=" + str(spectrum_data_dict['retentionTime'] * 60) + "\n")
-        if spectrum_data_dict['msLevel'] >= 2:
-            mgf_file.write("PEPMASS=" + str(spectrum_data_dict['precursorMz'][0]['precursorMz']) + " "
-                           + str(spectrum_data_dict['precursorMz'][0]['precursorIntensity']) + "\n")
-        for mz, intensity in zip(spectrum_data_dict['m/z array'], spectrum_data_dict['intensity array']):
-            mgf_file.write(str(mz) + ' ' + str(intensity) + "\n")
-        mgf_file.write("END IONS" + "\n")
+    # append single spectrum to .mgf; dataset_mgf_writer avoids reopening the files for every spectrum
+    with blanka_mgf.MgfWriter(output_dir, ms2_retention_time_factor=1, append=True) as mgf_writer_files:
+        mgf_writer_files.write(spectrum_data_dict, datatype)
 
 def old_mgf_writer(spectrum_data_dict, output_dir, datatype):
     # deprecated function
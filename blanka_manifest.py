@@ -0,0 +1,97 @@
+import os, json, hashlib, timeit
+import blanka_cache as cache
+import blanka_mgf
+
+manifest_version = 2
+# increment when the manifest layout changes
+
+manifest_parameters = ['instrument', 'signal_noise_ratio', 'noise_percentile', 'retention_time_tolerance',
+                       'precursor_mz_tolerance', 'peak_mz_tolerance', 'noise_removal_only', 'blank_removal_only',
+                       'control_min_spots', 'output', 'output_format']
+# arguments that change the output of a dataset; a dataset done with different values is processed again
+
+class RunManifest(object):
+    # --manifest: record of datasets processed by previous runs, saved as .json at manifest_path
+    # each dataset has its input file hash, a hash of the parameters and control files used, its state ('complete' or
+    # 'partial'), for complete datasets the output files written and for partial datasets the number of spectra and
+    # output file sizes at the last checkpoint
+    # manifest_path = '' disables the manifest; methods then do nothing so callers need no checks
+
+    def __init__(self, manifest_path, args, save_interval=5):
+        self.manifest_path = manifest_path
+        self.enabled = manifest_path != ''
+        self.args = args
+        self.save_interval = save_interval
+        self.last_save = timeit.default_timer()
+        self.control_files = []
+        self.manifest = {'version': manifest_version, 'datasets': {}, 'file_hashes': {}}
+        if self.enabled and os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == manifest_version:
+                self.manifest = manifest
+
+    def add_control_files(self, control_files):
+        # control files used by this run; part of the parameters hash
+        self.control_files += [control for control in control_files if control not in self.control_files]
+
+    def parameters_hash(self):
+        key = {parameter: self.args.get(parameter) for parameter in manifest_parameters}
+        key['control_files'] = sorted([self.file_hash(control) for control in self.control_files])
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def file_hash(self, path):
+        return cache.file_hash(path, self.manifest['file_hashes'])
+
+    def record(self, dataset):
+        # manifest record of dataset if done with the same input file and parameters as this run, otherwise None
+        if not self.enabled:
+            return None
+        record = self.manifest['datasets'].get(os.path.abspath(dataset))
+        if record == None or record['input_hash'] != self.file_hash(dataset) or \
+                record['parameters_hash'] != self.parameters_hash():
+            return None
+        return record
+
+    def is_complete(self, dataset):
+        # complete and none of its output files removed since (a dataset with missing output is processed again)
+        record = self.record(dataset)
+        return record != None and record['state'] == 'complete' and \
+            all([os.path.exists(path) for path in (record['files'] or [])])
+
+    def resume_point(self, dataset):
+        # number of spectra already written and {output file: size} to resume dataset from; (0, None) to start over
+        record = self.record(dataset)
+        if record == None or record['state'] != 'partial':
+            return 0, None
+        return record['spectra'], record['files']
+
+    def update(self, dataset, state, spectra, files=None):
+        if not self.enabled:
+            return
+        self.manifest['datasets'][os.path.abspath(dataset)] = {'input_hash': self.file_hash(dataset),
+                                                               'parameters_hash': self.parameters_hash(),
+                                                               'state': state, 'spectra': spectra, 'files': files}
+
+    def checkpoint(self, dataset, spectra, files):
+        # dataset written up to spectra (in file order) with output files of the given sizes
+        self.update(dataset, 'partial', spectra, files)
+        self.save(True)
+
+    def complete(self, dataset, spectra=None, files=None):
+        # dataset output written to files (output files and binary containers); saved at most every save_interval
+        # seconds (and by save(True) at the end of a run)
+        if files != None:
+            files = [os.path.abspath(path) for path in files]
+        self.update(dataset, 'complete', spectra, files)
+        self.save()
+
+    def save(self, force=False):
+        # write manifest to a temporary file and rename it so an interrupted save never corrupts the manifest
+        if not self.enabled or (not force and timeit.default_timer() - self.last_save < self.save_interval):
+            return
+        temp_path = self.manifest_path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+        blanka_mgf.replace_file(temp_path, self.manifest_path)
+        self.last_save = timeit.default_timer()
@@ -0,0 +1,180 @@
+import os, shutil, threading, Queue, numpy
+
+def format_peaks(mz_array, intensity_array):
+    # format peak list as '<m/z> <intensity>' lines in one array-to-text conversion
+    # astype(str) gives the same text as str() on each value
+    if len(mz_array) == 0:
+        return ''
+    peak_lines = numpy.char.add(numpy.char.add(mz_array.astype(str), ' '), intensity_array.astype(str))
+    return '\n'.join(peak_lines.tolist()) + '\n'
+
+class MgfWriter(object):
+    # .mgf writer for one dataset; keeps <datatype>_data_ms2.mgf and <datatype>_data_full.mgf open until closed
+    # instead of reopening them for every spectrum
+    # background=True formats and writes spectra on a separate thread so writing overlaps with processing
+    # ms2_retention_time_factor: RTINSECONDS multiplier used in _data_ms2.mgf (dd mode writes retentionTime as is)
+    # files are written as <file>.part and renamed when closed, so an interrupted run never leaves partial output and a
+    # rerun replaces output instead of appending to it; append=True appends to the output files directly
+    # resume_files: {output file: size} from checkpoint(); .part files cut back to those sizes and appended to, all
+    # reopened at once so files that get no spectra after the checkpoint are still renamed when closed
+
+    def __init__(self, output_dir, background=False, ms2_retention_time_factor=60, queue_size=1000, append=False,
+                 resume_files=None):
+        self.output_dir = output_dir
+        self.title = output_title(output_dir)
+        self.ms2_retention_time_factor = ms2_retention_time_factor
+        self.append = append
+        self.resume_files = resume_files
+        self.mgf_files = {}
+        self.output_paths = []
+        # output files (binary: containers) renamed into place by close(); recorded by the run manifest
+        self.error = None
+        self.queue = None
+        if resume_files != None and not append:
+            for datatype in self.resumed_datatypes():
+                self.open_datatype(datatype)
+        if background:
+            self.queue = Queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.background_writer)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type == None)
+
+    def write(self, spectrum_data_dict, datatype):
+        # write spectrum to .mgf files for datatype ('noise_removed', 'processed', 'removed_peaks')
+        if self.queue == None:
+            self.write_spectrum(spectrum_data_dict, datatype)
+        else:
+            if self.error != None:
+                raise self.error
+            self.queue.put((spectrum_data_dict, datatype))
+
+    def background_writer(self):
+        # background thread; writes queued spectra until None is queued
+        while True:
+            queued = self.queue.get()
+            if queued == None:
+                self.queue.task_done()
+                break
+            if self.error == None:
+                try:
+                    self.write_spectrum(queued[0], queued[1])
+                except Exception as error:
+                    self.error = error
+            self.queue.task_done()
+
+    def open_file(self, path):
+        # open output file; <path>.part unless appending, cut back to its checkpoint size when resuming
+        if self.append:
+            return open(path, 'a')
+        if self.resume_files != None and path in self.resume_files and os.path.isfile(path + '.part'):
+            with open(path + '.part', 'r+b') as part_file:
+                part_file.truncate(self.resume_files[path])
+            return open(path + '.part', 'a')
+        return open(path + '.part', 'w')
+
+    def resumed_datatypes(self):
+        # datatypes with .part files in resume_files
+        return set([path[len(self.output_dir):-len(suffix)] for path in self.resume_files
+                    for suffix in ('_data_ms2.mgf', '_data_full.mgf')
+                    if path.startswith(self.output_dir) and path.endswith(suffix) and os.path.isfile(path + '.part')])
+
+    def open_datatype(self, datatype):
+        self.open_files(datatype)
+
+    def open_files(self, datatype):
+        # .mgf files for datatype opened on first use; both files created even if no ms2 spectra are written
+        if datatype not in self.mgf_files:
+            self.mgf_files[datatype] = (self.open_file(self.output_dir + datatype + '_data_ms2.mgf'),
+                                        self.open_file(self.output_dir + datatype + '_data_full.mgf'))
+        return self.mgf_files[datatype]
+
+    def output_files(self):
+        # {output file: open file} for all files written
+        return {output_file.name[:-len('.part')] if output_file.name.endswith('.part') else output_file.name:
+                output_file for datatype_files in self.mgf_files.values() for output_file in datatype_files}
+
+    def wait(self):
+        # wait until queued spectra are written; raises any error from the background thread
+        if self.queue != None:
+            self.queue.join()
+        if self.error != None:
+            raise self.error
+
+    def checkpoint(self):
+        # write everything queued so far to disk; returns {output file: size} for resume_files
+        self.wait()
+        sizes = {}
+        for path, output_file in self.output_files().items():
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            sizes[path] = output_file.tell()
+        return sizes
+
+    def write_spectrum(self, spectrum_data_dict, datatype):
+        ms2_file, full_file = self.open_files(datatype)
+        title = ("TITLE=" + self.title + "." + spectrum_data_dict['num'] + "." + spectrum_data_dict['num'] +
+                 '. File:"' + self.title + '.RAW", NativeID:"controllerType=0 controllerNumber=1 scan=' +
+                 spectrum_data_dict['num'] + '"' + "\n")
+        peaks = format_peaks(spectrum_data_dict['m/z array'], spectrum_data_dict['intensity array'])
+        if spectrum_data_dict['msLevel'] >= 2:
+            pepmass = ("PEPMASS=" + str(spectrum_data_dict['precursorMz'][0]['precursorMz']) + " " +
+                       str(spectrum_data_dict['precursorMz'][0]['precursorIntensity']) + "\n")
+            ms2_file.write("BEGIN IONS" + "\n" + title + "RTINSECONDS=" +
+                           str(spectrum_data_dict['retentionTime'] * self.ms2_retention_time_factor) + "\n" +
+                           pepmass + peaks + "END IONS" + "\n")
+        else:
+            pepmass = ''
+        full_file.write("BEGIN IONS" + "\n" + title + "RTINSECONDS=" + str(spectrum_data_dict['retentionTime'] * 60) +
+                        "\n" + pepmass + peaks + "END IONS" + "\n")
+
+    def close(self, commit=True):
+        # finish queued writes and close .mgf files; raises any error from the background thread
+        # .part files renamed to the output files if commit and no error, otherwise left for a resumed run
+        if self.queue != None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        output_paths = self.close_files()
+        if self.error != None:
+            raise self.error
+        if commit and not self.append:
+            for path in output_paths:
+                replace_file(path + '.part', path)
+            self.output_paths = sorted(output_paths)
+
+    def close_files(self):
+        # close output files; returns output file paths
+        output_files = self.output_files()
+        for output_file in output_files.values():
+            output_file.close()
+        self.mgf_files = {}
+        return output_files.keys()
+
+def output_title(output_dir):
+    # spectrum title prefix of an output prefix (ex: D:\folder\filename_blanka_ -> filename)
+    return output_dir.split("\\")[-1].split("_blanka_")[0]
+
+def concatenate_files(paths, path):
+    # write the files in paths one after another to path (ex: .mgf files written in pieces by --sample_store
+    # workers); copied as is, spectra are not parsed; written to <path>.part and renamed when complete
+    with open(path + '.part', 'wb') as output_file:
+        for piece_path in paths:
+            with open(piece_path, 'rb') as piece_file:
+                shutil.copyfileobj(piece_file, output_file, 1048576)
+    replace_file(path + '.part', path)
+
+def replace_file(source, destination):
+    # rename source to destination, replacing destination; os.rename replaces a file atomically on POSIX, so readers
+    # see either the old or the new file; on Windows it does not replace files, so the old file is removed first
+    # a destination directory (binary container) is removed first on every platform
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    elif os.name == 'nt' and os.path.isfile(destination):
+        os.remove(destination)
+    os.rename(source, destination)
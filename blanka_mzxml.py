@@ -0,0 +1,167 @@
+import re, mmap, zlib, base64, heapq, numpy
+import blanka_spectrum
+
+scan_pattern = re.compile(br'<scan\s')
+index_offset_pattern = re.compile(br'<indexOffset>\s*(\d+)\s*</indexOffset>')
+offset_pattern = re.compile(br'<offset\s[^>]*>\s*(\d+)\s*</offset>')
+attribute_pattern = re.compile(br'([\w:]+)\s*=\s*"([^"]*)"')
+precursor_pattern = re.compile(br'<precursorMz\b([^>]*)>\s*([^<\s]+)\s*</precursorMz>')
+peaks_pattern = re.compile(br'<peaks\b([^>]*?)(?:/>|>([^<]*)</peaks>)')
+duration_pattern = re.compile(r'(?P<sign>-?)P(?:(?P<years>\d+\.?\d*)Y)?(?:(?P<months>\d+\.?\d*)M)?'
+                              r'(?:(?P<days>\d+\.?\d*)D)?(?:T(?:(?P<hours>\d+\.?\d*)H)?(?:(?P<minutes>\d+\.?\d*)M)?'
+                              r'(?:(?P<seconds>\d+\.?\d*)S)?)?')
+# same duration pattern as pyteomics so retention times are identical
+
+def scan_offsets(mzxml):
+    # byte offset of each <scan> element in file order
+    # read from the mzXML scan index (<indexOffset>); files without a valid index are searched for <scan tags and
+    # must end with </msRun> so a truncated file is not read as a shorter run
+    with open(mzxml, 'rb') as mzxml_file:
+        mzxml_file.seek(0, 2)
+        file_size = mzxml_file.tell()
+        if file_size == 0:
+            return []
+        mzxml_file.seek(max(0, file_size - 4096))
+        index_offset = index_offset_pattern.search(mzxml_file.read())
+        if index_offset != None and int(index_offset.group(1)) < file_size:
+            mzxml_file.seek(int(index_offset.group(1)))
+            index_data = mzxml_file.read()
+            index_data = index_data[:index_data.find(b'</index>')]
+            # first index is the scan index
+            offsets = sorted([int(offset) for offset in offset_pattern.findall(index_data)])
+            if offsets != [] and all([offset_is_scan(mzxml_file, offset) for offset in (offsets[0], offsets[-1])]):
+                return offsets
+        mzxml_map = mmap.mmap(mzxml_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mzxml_map.rfind(b'</msRun>') == -1:
+                raise ValueError('truncated .mzXML file (no </msRun>): ' + mzxml)
+            return [match.start() for match in scan_pattern.finditer(mzxml_map)]
+        finally:
+            mzxml_map.close()
+
+def offset_is_scan(mzxml_file, offset):
+    mzxml_file.seek(offset)
+    return scan_pattern.match(mzxml_file.read(6)) != None
+
+def read_scan_data(mzxml_file, offset, block_size=65536):
+    # text of a scan from its start tag to the end of its own <peaks> element (nested scans not included)
+    # raises ValueError if the file ends before the <peaks> element is closed (truncated file)
+    mzxml_file.seek(offset)
+    scan_data = mzxml_file.read(block_size)
+    while True:
+        peaks = peaks_pattern.search(scan_data)
+        if peaks != None:
+            return scan_data[:peaks.end()]
+        more_data = mzxml_file.read(len(scan_data))
+        if more_data == b'':
+            raise ValueError('truncated .mzXML file (scan at byte ' + str(offset) + ' has no end of <peaks>): ' +
+                             mzxml_file.name)
+        scan_data += more_data
+
+def retention_time_minutes(value):
+    # mzXML retention time (xs:duration, ex: PT12.5S) in minutes, converted the same way as pyteomics
+    if value == None:
+        return None
+    if not value.startswith('P'):
+        return float(value)
+    duration = duration_pattern.search(value).groupdict()
+    hours = float(duration.get('hours', 0) or 0)
+    minutes = float(duration.get('minutes', 0) or 0)
+    seconds = float(duration.get('seconds', 0) or 0)
+    minutes += hours * 60.
+    minutes += (seconds / 60.)
+    return minutes
+
+def decode_peaks(peak_attributes, peak_data):
+    # base64 (optionally zlib compressed) interleaved m/z-intensity pairs decoded straight into native byte order
+    # m/z and intensity arrays
+    if peak_attributes.get('precision', '32') == '64':
+        dtype = numpy.dtype(numpy.float64)
+    else:
+        dtype = numpy.dtype(numpy.float32)
+    if peak_attributes.get('byteOrder', 'network') in ('network', 'big'):
+        stored_dtype = dtype.newbyteorder('>')
+    else:
+        stored_dtype = dtype.newbyteorder('<')
+    peak_data = base64.b64decode(peak_data or b'')
+    if peak_attributes.get('compressionType') == 'zlib' and peak_data != b'':
+        peak_data = zlib.decompress(peak_data)
+    peaks = numpy.frombuffer(peak_data, dtype=stored_dtype)
+    return peaks[0::2].astype(dtype), peaks[1::2].astype(dtype)
+
+def parse_scan(scan_data):
+    # Spectrum from the text of a scan; raises ValueError if the scan has no complete <peaks> element
+    scan_attributes = dict(attribute_pattern.findall(scan_data[:scan_data.find(b'>')]))
+    precursor = precursor_pattern.search(scan_data)
+    if precursor != None:
+        precursor_attributes = dict(attribute_pattern.findall(precursor.group(1)))
+        precursor_mz = float(precursor.group(2))
+        if 'precursorIntensity' in precursor_attributes:
+            precursor_intensity = float(precursor_attributes['precursorIntensity'])
+        else:
+            precursor_intensity = None
+    else:
+        precursor_mz = None
+        precursor_intensity = None
+    peaks = peaks_pattern.search(scan_data)
+    if peaks == None:
+        raise ValueError('corrupt .mzXML scan (no complete <peaks> element): ' + scan_data[:scan_data.find(b'>') + 1])
+    if peaks.group(2) != None:
+        mz_array, intensity_array = decode_peaks(dict(attribute_pattern.findall(peaks.group(1))), peaks.group(2))
+    else:
+        mz_array, intensity_array = decode_peaks({'precision': '64'}, b'')
+        # no peak data (ex: <peaks ... />); empty float64 arrays, same as pyteomics
+    return blanka_spectrum.Spectrum(str(scan_attributes['num']), int(scan_attributes.get('msLevel', 1)),
+                                    retention_time_minutes(scan_attributes.get('retentionTime')), precursor_mz,
+                                    precursor_intensity, mz_array, intensity_array)
+
+def read_offsets(mzxml, offsets):
+    # Spectrum objects for scans at offsets; used by workers to decode disjoint ranges of the same file
+    with open(mzxml, 'rb') as mzxml_file:
+        return [parse_scan(read_scan_data(mzxml_file, offset)) for offset in offsets]
+
+def scan_order(spectra):
+    # spectra in the order pyteomics.mzxml returns them; scans between two ms1 scans ordered by scan number
+    queue = []
+    for count, spectrum in enumerate(spectra):
+        heapq.heappush(queue, (int(spectrum.num), count, spectrum))
+        if spectrum.ms_level == 1:
+            barrier = int(spectrum.num)
+            while True:
+                num, queued_count, queued_spectrum = heapq.heappop(queue)
+                if num >= barrier:
+                    heapq.heappush(queue, (num, queued_count, queued_spectrum))
+                    break
+                yield queued_spectrum
+    while queue:
+        yield heapq.heappop(queue)[2]
+
+def read_spectra(mzxml):
+    # read .mzXML file as Spectrum objects one scan at a time using the scan index
+    def scans():
+        with open(mzxml, 'rb') as mzxml_file:
+            for offset in scan_offsets(mzxml):
+                yield parse_scan(read_scan_data(mzxml_file, offset))
+    return scan_order(scans())
+
+def read_first_spectrum(mzxml):
+    # first scan of an .mzXML file without decoding the rest (ex: dd spots)
+    offsets = scan_offsets(mzxml)
+    if offsets == []:
+        return None
+    return read_offsets(mzxml, offsets[:1])[0]
+
+def offset_ranges(offsets, range_count):
+    # split scan offsets into up to range_count contiguous ranges of similar size
+    range_size = max(1, int(numpy.ceil(len(offsets) / float(max(1, range_count)))))
+    return [offsets[i:i + range_size] for i in range(0, len(offsets), range_size)]
+
+def read_spectra_parallel(worker_pool, mzxml, range_count):
+    # read .mzXML file with worker_pool decoding disjoint scan offset ranges at the same time; list of Spectrum
+    ranges = offset_ranges(scan_offsets(mzxml), range_count)
+    decoded_ranges = worker_pool.map(read_offsets_range, [(mzxml, offsets) for offsets in ranges])
+    return list(scan_order(spectrum for decoded_range in decoded_ranges for spectrum in decoded_range))
+
+def read_offsets_range(mzxml_range):
+    # pool.map version of read_offsets; mzxml_range = (.mzXML path, offsets)
+    return read_offsets(mzxml_range[0], mzxml_range[1])
@@ -0,0 +1,218 @@
+import os, shutil, tempfile, uuid
+from functools import partial
+from itertools import islice, imap
+import blanka_run
+import blanka_cache as cache
+import blanka_lcms as lcms
+import blanka_maldi_dd as dd
+import blanka_mzxml
+import blanka_spectrum
+
+# in-process noise and blank removal for BLANKA as one stage of a larger Python pipeline
+# spectra in, spectra out; no .mgf files and no global pool so several pipelines can share one executor (or run in one
+# process) with different controls and parameters
+#
+#     pipeline = blanka_pipeline.Pipeline('lcq', control=['E:\\lcms_data\\media_control.mzXML'], executor=pool,
+#                                         signal_noise_ratio=4, peak_mz_tolerance=0.02)
+#     for noise_removed, processed, removed_peaks in pipeline.process(spectra):
+#         ...
+#     pipeline.close()
+
+worker_controls = {}
+# prepared control libraries by library id; a process executor worker loads a library the first time one of its
+# blocks arrives and keeps it for later blocks
+
+def worker_control(library_id, instrument, library_path):
+    # prepared control library in this process, loaded (memory mapped) from library_path if not already here
+    if library_id not in worker_controls:
+        if instrument == 'dd':
+            worker_controls[library_id] = cache.load_control_consensus(library_path, dd.consensus_keys)
+        else:
+            worker_controls[library_id] = cache.load_control_index(library_path)
+    return worker_controls[library_id]
+
+class ControlLibrary(object):
+    # handle for a prepared control library, bound into block tasks in place of the library itself
+    # pickled as library id and path (library saved to a temporary directory the first time it is pickled) so a
+    # process executor receives a few bytes per block; serial and thread executors use the library directly
+
+    def __init__(self, library_id, instrument, library_path, spectra=None):
+        self.library_id = library_id
+        self.instrument = instrument
+        self.library_path = library_path
+        self.spectra = spectra
+
+    def control(self):
+        return worker_control(self.library_id, self.instrument, self.library_path)
+
+    def save(self):
+        # lcq/qtof = control spectra and index arrays (blanka_cache.save_control_library), dd = consensus arrays
+        self.library_path = os.path.join(tempfile.mkdtemp(prefix='blanka_pipeline_'), 'library')
+        if self.instrument == 'dd':
+            cache.save_control_consensus(self.library_path, worker_controls[self.library_id])
+        else:
+            cache.save_control_library(self.library_path, self.spectra, worker_controls[self.library_id])
+
+    def close(self):
+        # forget the library in this process and remove the saved copy
+        worker_controls.pop(self.library_id, None)
+        if self.library_path != None:
+            shutil.rmtree(os.path.dirname(self.library_path))
+            self.library_path = None
+
+    def __reduce__(self):
+        if self.library_path == None:
+            self.save()
+        return (ControlLibrary, (self.library_id, self.instrument, self.library_path))
+
+def as_spectrum(spectrum):
+    # shallow copy of a Spectrum (arrays replaced, never modified in place, so the caller's spectra are not changed);
+    # pyteomics style dicts converted to Spectrum
+    if isinstance(spectrum, blanka_spectrum.Spectrum):
+        return spectrum.copy()
+    return blanka_spectrum.from_pyteomics(spectrum)
+
+def spectrum_blocks(spectra, block_size):
+    # lists of up to block_size spectra from an iterable without reading it all
+    spectra = iter(spectra)
+    while True:
+        block = list(islice(spectra, block_size))
+        if block == []:
+            return
+        yield block
+
+def lcms_block(args, control_library, spectra):
+    # noise and/or blank removal for a block of lcq/qtof spectra; [noise removed, processed, removed peaks] per spectrum
+    # processed = None for ms2 spectra removed as blank, removed peaks = None if no peaks were removed
+    if args['noise_removal_only'] == False:
+        control_index = control_library.control()
+    if args['blank_removal_only'] == False:
+        spectra = lcms.noise_removal_block(args['signal_noise_ratio'], args['noise_percentile'], spectra)
+    results = []
+    for spectrum in spectra:
+        noise_removed = spectrum if args['blank_removal_only'] == False else None
+        if args['noise_removal_only'] == True:
+            results.append([noise_removed, None, None])
+            continue
+        processed_spectrum = lcms.spectra_compare(args, control_index, spectrum.copy())
+        if processed_spectrum == None:
+            results.append([noise_removed, None, None])
+        else:
+            results.append([noise_removed, processed_spectrum[0], processed_spectrum[1]])
+    return results
+
+def dd_block(args, control_library, spectra):
+    # noise and/or blank removal for a block of dd spot spectra; [noise removed, processed, removed peaks] per spectrum
+    if args['noise_removal_only'] == False:
+        control_spectrum = control_library.control()
+    results = []
+    for spectrum in spectra:
+        sample_spectrum = [spectrum, None]
+        if args['blank_removal_only'] == False:
+            sample_spectrum = dd.noise_removal(args['signal_noise_ratio'], args['noise_percentile'], sample_spectrum)
+        noise_removed = sample_spectrum[0] if args['blank_removal_only'] == False else None
+        if args['noise_removal_only'] == True:
+            results.append([noise_removed, None, None])
+            continue
+        processed_spectrum, changed_spectrum_data = dd.blank_removal(args['peak_mz_tolerance'], control_spectrum,
+                                                                     [sample_spectrum[0].copy(), None])
+        results.append([noise_removed, processed_spectrum[0], changed_spectrum_data])
+    return results
+
+def dd_control_block(args, spectra):
+    # noise removed control spot spectra
+    return [spectrum[0] for spectrum in dd.noise_removal_block(args['signal_noise_ratio'], args['noise_percentile'],
+                                                               [[spectrum, None] for spectrum in spectra])]
+
+class Pipeline(object):
+    # instrument: 'lcq', 'qtof' or 'dd'
+    # control: control spectra (Spectrum objects or pyteomics style dicts) or .mzXML paths; lcq/qtof = control dataset,
+    # dd = one spectrum (or spot file) per control spot; not needed with noise_removal_only
+    # executor: None = run in the calling thread, multiprocessing Pool/ThreadPool or any object with a map method
+    # (ex: concurrent.futures executor); spectra are sent to it in blocks of block_size with a ControlLibrary handle,
+    # so each process pool worker loads the control library once from a temporary copy and a thread pool shares it
+    # max_in_flight: blocks read ahead of the results for executors with apply_async (default = 4 per cpu)
+    # parameters: any blanka_run option (ex: signal_noise_ratio=4, peak_mz_tolerance=0.02); defaults as on the
+    # command line
+
+    def __init__(self, instrument, control=None, executor=None, block_size=200, max_in_flight=None, **parameters):
+        self.args = blanka_run.get_args(['--instrument', instrument])
+        for parameter, value in parameters.items():
+            if parameter not in self.args:
+                raise ValueError('unknown BLANKA parameter: ' + parameter)
+            self.args[parameter] = value
+        self.executor = executor
+        self.block_size = block_size
+        if max_in_flight == None:
+            max_in_flight = max(1, self.args['cpu']) * 4
+        self.max_in_flight = max_in_flight
+        self.control = None
+        if self.args['noise_removal_only'] == False:
+            self.control = self.prepare_control(control)
+
+    def close(self):
+        # remove the temporary copy of the control library saved for process executors
+        if self.control != None:
+            self.control.close()
+
+    def map_blocks(self, function, spectra):
+        # function results for each block of spectra in order
+        blocks = spectrum_blocks(imap(as_spectrum, spectra), self.block_size)
+        if self.executor == None:
+            return imap(function, blocks)
+        if hasattr(self.executor, 'apply_async'):
+            return blanka_run.bounded_imap(self.executor, function, blocks, self.max_in_flight)
+        return self.executor.map(function, blocks)
+
+    def read_control(self, control):
+        # control spectra; .mzXML paths read (dd = first scan of each spot file)
+        for item in control:
+            if isinstance(item, basestring) and self.args['instrument'] == 'dd':
+                yield blanka_mzxml.read_first_spectrum(item)
+            elif isinstance(item, basestring):
+                for spectrum in blanka_mzxml.read_spectra(item):
+                    yield spectrum
+            else:
+                yield item
+
+    def prepare_control(self, control):
+        # lcq/qtof = indexed control dataset (noise removed unless blank removal only), dd = noise removed consensus
+        # control spectrum; same libraries as blanka_run builds from control files
+        if control == None:
+            raise ValueError('control spectra or files are needed for blank removal')
+        control = self.read_control(control)
+        library_id = uuid.uuid4().hex
+        if self.args['instrument'] == 'dd':
+            control_spectra = [spectrum for block in self.map_blocks(partial(dd_control_block, self.args), control)
+                               for spectrum in block]
+            worker_controls[library_id] = dd.consensus_control_spectrum([[spectrum, None]
+                                                                         for spectrum in control_spectra],
+                                                                        self.args['peak_mz_tolerance'],
+                                                                        self.args['control_min_spots'])
+            return ControlLibrary(library_id, 'dd', None)
+        if self.args['blank_removal_only'] == False:
+            control_noise_args = partial(lcms.noise_removal_block, self.args['signal_noise_ratio'],
+                                         self.args['noise_percentile'])
+            control = [spectrum for block in self.map_blocks(control_noise_args, control) for spectrum in block]
+        else:
+            control = [as_spectrum(spectrum) for spectrum in control]
+        worker_controls[library_id] = lcms.build_control_index(control)
+        return ControlLibrary(library_id, self.args['instrument'], None, control)
+
+    def process(self, spectra):
+        # [noise removed, processed, removed peaks] for each spectrum in spectra (iterable, read as needed) in order;
+        # noise removed = None with blank_removal_only, processed/removed peaks = None with noise_removal_only
+        # processed = None for lcq/qtof ms2 spectra removed as blank; removed peaks = None if no peaks were removed
+        if self.args['instrument'] == 'dd':
+            block_function = partial(dd_block, self.args, self.control)
+        else:
+            block_function = partial(lcms_block, self.args, self.control)
+        for results in self.map_blocks(block_function, spectra):
+            for result in results:
+                yield result
+
+    def process_file(self, mzxml):
+        # process spectra of an .mzXML file (dd = spot spectrum)
+        if self.args['instrument'] == 'dd':
+            return self.process([blanka_mzxml.read_first_spectrum(mzxml)])
+        return self.process(blanka_mzxml.read_spectra(mzxml))
@@ -0,0 +1,260 @@
+import os, sys, csv, json, cPickle, cProfile, timeit
+from contextlib import contextmanager
+from multiprocessing import util
+import blanka_lcms as lcms
+import blanka_maldi_dd as dd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+    # peak memory not reported on Windows
+
+report_fields = ['dataset', 'stage', 'source', 'spectra', 'wall_seconds', 'cpu_seconds', 'spectra_per_second',
+                 'peaks_in', 'peaks_removed', 'control_matches', 'control_match_rate', 'pickled_bytes',
+                 'peak_rss_mb']
+# source = 'main' for stages timed in the main process, 'workers' for stages timed in pool workers
+# worker wall/cpu seconds are summed over all workers, so spectra_per_second is per worker
+
+def cpu_time():
+    # user + system cpu time of this process
+    process_times = os.times()
+    return process_times[0] + process_times[1]
+
+def peak_rss_mb():
+    # peak resident memory of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)
+    if resource == None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 1048576.0
+    return peak_rss / 1024.0
+
+def pickled_size(data):
+    return len(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+
+def spectrum_peaks(spectrum):
+    # peak count of an lcq/qtof spectrum dict or a dd [spectrum dict, filename] pair
+    if isinstance(spectrum, list):
+        spectrum = spectrum[0]
+    return len(spectrum['m/z array'])
+
+def add_stage(stats, stage, wall_seconds=0, cpu_seconds=0, spectra=0, peaks_in=0, peaks_removed=0,
+              control_matches=0, pickled_bytes=0, peak_rss=None):
+    # add to totals for stage in stats dict ({stage: totals})
+    if stage not in stats:
+        stats[stage] = {'spectra': 0, 'wall_seconds': 0, 'cpu_seconds': 0, 'peaks_in': 0, 'peaks_removed': 0,
+                        'control_matches': 0, 'pickled_bytes': 0, 'peak_rss_mb': None}
+    totals = stats[stage]
+    totals['spectra'] += spectra
+    totals['wall_seconds'] += wall_seconds
+    totals['cpu_seconds'] += cpu_seconds
+    totals['peaks_in'] += peaks_in
+    totals['peaks_removed'] += peaks_removed
+    totals['control_matches'] += control_matches
+    totals['pickled_bytes'] += pickled_bytes
+    if peak_rss != None:
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak_rss)
+
+def timed(stats, stage, function, *function_args):
+    # call function and add its wall and cpu time to stage
+    start_wall = timeit.default_timer()
+    start_cpu = cpu_time()
+    result = function(*function_args)
+    add_stage(stats, stage, timeit.default_timer() - start_wall, cpu_time() - start_cpu)
+    return result
+
+class RunProfile(object):
+    # per dataset and stage metrics for --profile; written to report_path (.csv, anything else as .json)
+    # report_path = '' disables profiling; stage() and collect() then do nothing so callers need no checks
+
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.enabled = report_path != ''
+        self.stats = {}
+        self.order = []
+
+    def dataset_stats(self, dataset):
+        if dataset not in self.stats:
+            self.stats[dataset] = {}
+            self.order.append(dataset)
+        return self.stats[dataset]
+
+    @contextmanager
+    def stage(self, dataset, stage):
+        # time a stage run in the main process; counts (spectra, peaks_in, ...) added to the yielded dict
+        counts = {}
+        if not self.enabled:
+            yield counts
+            return
+        start_wall = timeit.default_timer()
+        start_cpu = cpu_time()
+        yield counts
+        add_stage(self.dataset_stats(dataset), (stage, 'main'), timeit.default_timer() - start_wall,
+                  cpu_time() - start_cpu, peak_rss=peak_rss_mb(), **counts)
+
+    def add(self, dataset, stage, **totals):
+        # add totals recorded outside stage() (ex: conversion times)
+        if self.enabled:
+            add_stage(self.dataset_stats(dataset), (stage, 'main'), **totals)
+
+    def worker(self, function, profiled_function):
+        # worker function to map; profiled_function returns [result, stats] and is only used when profiling
+        if self.enabled:
+            return profiled_function
+        return function
+
+    def collect_result(self, dataset, profiled_result):
+        result, worker_stats = profiled_result
+        for stage, totals in worker_stats.items():
+            peak_rss = totals.pop('peak_rss_mb')
+            add_stage(self.dataset_stats(dataset), (stage, 'workers'), peak_rss=peak_rss, **totals)
+        return result
+
+    def collect(self, dataset, results):
+        # strip worker stats from results of a profiled worker function; list in, list out, otherwise a generator
+        if not self.enabled:
+            return results
+        if isinstance(results, list):
+            return [self.collect_result(dataset, result) for result in results]
+        return (self.collect_result(dataset, result) for result in results)
+
+    def records(self):
+        # one record per dataset and stage in the order they were first seen
+        report = []
+        for dataset in self.order:
+            for (stage, source), totals in sorted(self.stats[dataset].items(), key=lambda i: i[0]):
+                record = dict(totals)
+                record.update({'dataset': dataset, 'stage': stage, 'source': source})
+                if totals['wall_seconds'] > 0:
+                    record['spectra_per_second'] = totals['spectra'] / totals['wall_seconds']
+                else:
+                    record['spectra_per_second'] = None
+                if stage == 'control matching' and totals['spectra'] > 0:
+                    record['control_match_rate'] = totals['control_matches'] / float(totals['spectra'])
+                else:
+                    record['control_match_rate'] = None
+                report.append(record)
+        return report
+
+    def write(self):
+        if not self.enabled:
+            return
+        report = self.records()
+        if self.report_path.endswith('.csv'):
+            with open(self.report_path, 'wb') as report_file:
+                writer = csv.DictWriter(report_file, fieldnames=report_fields)
+                writer.writeheader()
+                for record in report:
+                    writer.writerow(record)
+        else:
+            with open(self.report_path, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+        print "Profile written to " + self.report_path
+
+worker_profiler = None
+# cProfile.Profile of this worker process for --profile_workers
+
+def dump_worker_profiler(profile_dir):
+    worker_profiler.disable()
+    worker_profiler.dump_stats(os.path.join(profile_dir, 'worker_' + str(os.getpid()) + '.prof'))
+
+def start_worker_profiler(profile_dir):
+    # cProfile this worker process from its first profiled task; stats dumped to profile_dir when the worker exits
+    global worker_profiler
+    if profile_dir != '' and worker_profiler == None:
+        if not os.path.isdir(profile_dir):
+            try:
+                os.makedirs(profile_dir)
+            except OSError:
+                # created by another worker
+                pass
+        worker_profiler = cProfile.Profile()
+        util.Finalize(None, dump_worker_profiler, args=(profile_dir,), exitpriority=10)
+        worker_profiler.enable()
+
+def worker_stats_result(args, result, stats, sent_bytes):
+    # [result, stats] returned by profiled workers; bytes sent to and from the worker and worker peak memory
+    add_stage(stats, 'worker transfer', pickled_bytes=sent_bytes + pickled_size(result), peak_rss=peak_rss_mb())
+    return [result, stats]
+
+def lcms_spectra_compare(args, stats, sample_spectrum):
+    # lcms.spectra_compare with control matching and blank removal timed separately
+    def select_control_spectrum(*select_args):
+        control_spectrum = timed(stats, 'control matching', lcms.select_control_spectrum, *select_args)
+        add_stage(stats, 'control matching', spectra=1, control_matches=int(control_spectrum != None))
+        return control_spectrum
+    def blank_removal(sample_spectrum, control_spectrum, peak_mz_tolerance):
+        peaks_in = spectrum_peaks(sample_spectrum)
+        processed_spectrum = timed(stats, 'blank removal', lcms.blank_removal, sample_spectrum, control_spectrum,
+                                   peak_mz_tolerance)
+        add_stage(stats, 'blank removal', spectra=1, peaks_in=peaks_in,
+                  peaks_removed=peaks_in - spectrum_peaks(processed_spectrum[0]))
+        return processed_spectrum
+    return lcms.spectra_compare(args, lcms.worker_control_index, sample_spectrum, select_control_spectrum,
+                                blank_removal)
+
+def worker_lcms_noise_blank_removal(args, sample_spectrum):
+    # profiled lcms.worker_noise_blank_removal
+    start_worker_profiler(args['profile_workers'])
+    stats = {}
+    sent_bytes = pickled_size(sample_spectrum)
+    peaks_in = spectrum_peaks(sample_spectrum)
+    noiseless_spectrum = timed(stats, 'noise removal', lcms.noise_removal, args['signal_noise_ratio'],
+                               args['noise_percentile'], sample_spectrum)
+    add_stage(stats, 'noise removal', spectra=1, peaks_in=peaks_in,
+              peaks_removed=peaks_in - spectrum_peaks(noiseless_spectrum))
+    processed_spectrum = lcms_spectra_compare(args, stats, noiseless_spectrum.copy())
+    return worker_stats_result(args, [noiseless_spectrum, processed_spectrum], stats, sent_bytes)
+
+def worker_lcms_spectra_compare(args, sample_spectrum):
+    # profiled lcms.worker_spectra_compare
+    start_worker_profiler(args['profile_workers'])
+    stats = {}
+    sent_bytes = pickled_size(sample_spectrum)
+    return worker_stats_result(args, lcms_spectra_compare(args, stats, sample_spectrum), stats, sent_bytes)
+
+def worker_noise_removal(args, noise_args, spectrum):
+    # profiled noise removal of one spectrum (lcms.noise_removal or dd.noise_removal partial)
+    noiseless_spectra, stats = worker_noise_removal_block(args, lambda spectra: [noise_args(spectra[0])], [spectrum])
+    return [noiseless_spectra[0], stats]
+
+def worker_noise_removal_block(args, noise_block_args, spectra):
+    # profiled noise removal of a block of spectra (lcms.noise_removal_block or dd.noise_removal_block partial)
+    start_worker_profiler(args['profile_workers'])
+    stats = {}
+    sent_bytes = pickled_size(spectra)
+    peaks_in = sum([spectrum_peaks(spectrum) for spectrum in spectra])
+    noiseless_spectra = timed(stats, 'noise removal', noise_block_args, spectra)
+    add_stage(stats, 'noise removal', spectra=len(spectra), peaks_in=peaks_in,
+              peaks_removed=peaks_in - sum([spectrum_peaks(spectrum) for spectrum in noiseless_spectra]))
+    return worker_stats_result(args, noiseless_spectra, stats, sent_bytes)
+
+def dd_blank_removal(args, stats, sample_spectrum):
+    # dd.blank_removal against the combined control spectrum of the spot's plate, timed
+    peaks_in = spectrum_peaks(sample_spectrum)
+    processed_spectrum = timed(stats, 'blank removal', dd.blank_removal, args['peak_mz_tolerance'],
+                               dd.worker_plate_control(sample_spectrum[1]), sample_spectrum)
+    add_stage(stats, 'blank removal', spectra=1, peaks_in=peaks_in,
+              peaks_removed=peaks_in - spectrum_peaks(processed_spectrum[0]))
+    return processed_spectrum
+
+def worker_dd_noise_blank_removal(args, sample_spectrum):
+    # profiled dd.worker_noise_blank_removal
+    start_worker_profiler(args['profile_workers'])
+    stats = {}
+    sent_bytes = pickled_size(sample_spectrum)
+    peaks_in = spectrum_peaks(sample_spectrum)
+    noiseless_spectrum = timed(stats, 'noise removal', dd.noise_removal, args['signal_noise_ratio'],
+                               args['noise_percentile'], sample_spectrum)
+    add_stage(stats, 'noise removal', spectra=1, peaks_in=peaks_in,
+              peaks_removed=peaks_in - spectrum_peaks(noiseless_spectrum))
+    processed_spectrum = dd_blank_removal(args, stats, [noiseless_spectrum[0].copy(), noiseless_spectrum[1]])
+    return worker_stats_result(args, [noiseless_spectrum, processed_spectrum], stats, sent_bytes)
+
+def worker_dd_blank_removal(args, sample_spectrum):
+    # profiled dd.worker_blank_removal
+    start_worker_profiler(args['profile_workers'])
+    stats = {}
+    sent_bytes = pickled_size(sample_spectrum)
+    return worker_stats_result(args, dd_blank_removal(args, stats, sample_spectrum), stats, sent_bytes)
@@ -0,0 +1,143 @@
+import os, json, time, socket, sqlite3, threading, timeit
+
+# shared work queue for running one batch of datasets on several machines (--queue)
+# SQLite file on storage all nodes can reach; each dataset is a task leased by one worker at a time and kept alive
+# with heartbeats, so datasets of a node that stops are taken over by the others once the lease expires
+
+class WorkQueue(object):
+    # tasks: dataset, state ('pending', 'running', 'done' or 'failed'), worker, attempts, heartbeat time, seconds
+    # spent by the worker that finished it and the last error
+    # settings: run arguments saved by the coordinator so workers started with only --queue use the same parameters
+
+    def __init__(self, queue_path, timeout=60):
+        self.queue_path = queue_path
+        self.connection = sqlite3.connect(queue_path, timeout=timeout, isolation_level=None)
+        # autocommit; transactions started explicitly with BEGIN IMMEDIATE so claims never race
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tasks (dataset TEXT PRIMARY KEY, state TEXT, worker TEXT, '
+                                'attempts INTEGER, heartbeat REAL, seconds REAL, error TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+
+    def save_arguments(self, args):
+        self.connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', ('arguments', json.dumps(args)))
+
+    def load_arguments(self):
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', ('arguments',)).fetchone()
+        if row == None:
+            return None
+        return {str(key): value for key, value in json.loads(row[0]).items()}
+
+    def add(self, datasets):
+        # add datasets as pending tasks; datasets already in the queue (ex: done by an earlier run) are kept as they are
+        self.connection.executemany('INSERT OR IGNORE INTO tasks VALUES (?, ?, NULL, 0, NULL, NULL, NULL)',
+                                    [(dataset, 'pending') for dataset in datasets])
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        # lease the next pending dataset to worker; a running dataset whose lease expired (worker stopped) is taken
+        # over and counts as another attempt; returns None if nothing can be claimed now
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute("UPDATE tasks SET state = 'failed', error = 'lease expired' "
+                                    "WHERE state = 'running' AND heartbeat < ? AND attempts >= ?",
+                                    (now - lease_seconds, max_attempts))
+            row = self.connection.execute("SELECT dataset FROM tasks "
+                                          "WHERE (state = 'pending' OR (state = 'running' AND heartbeat < ?)) "
+                                          "AND attempts < ? ORDER BY attempts, rowid LIMIT 1",
+                                          (now - lease_seconds, max_attempts)).fetchone()
+            if row != None:
+                self.connection.execute("UPDATE tasks SET state = 'running', worker = ?, attempts = attempts + 1, "
+                                        "heartbeat = ? WHERE dataset = ?", (worker, now, row[0]))
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        if row == None:
+            return None
+        return row[0]
+
+    def heartbeat(self, worker, dataset):
+        self.connection.execute("UPDATE tasks SET heartbeat = ? WHERE dataset = ? AND worker = ? AND state = 'running'",
+                                (time.time(), dataset, worker))
+
+    def complete(self, worker, dataset, seconds):
+        # ignored if the lease expired and another worker took the dataset over
+        self.connection.execute("UPDATE tasks SET state = 'done', seconds = ?, error = NULL WHERE dataset = ? AND "
+                                "worker = ? AND state = 'running'", (seconds, dataset, worker))
+
+    def fail(self, worker, dataset, error, max_attempts):
+        # dataset pending again to be retried (by any worker) until max_attempts, then failed
+        self.connection.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                                "error = ? WHERE dataset = ? AND worker = ? AND state = 'running'",
+                                (max_attempts, error, dataset, worker))
+
+    def unfinished(self):
+        # number of pending and running datasets
+        return self.connection.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'running')").fetchone()[0]
+
+    def tasks(self):
+        return [dict(zip(['dataset', 'state', 'worker', 'attempts', 'seconds', 'error'], row)) for row in
+                self.connection.execute('SELECT dataset, state, worker, attempts, seconds, error FROM tasks '
+                                        'ORDER BY rowid')]
+
+    def summary(self):
+        # datasets by state and datasets/seconds by the worker that finished them
+        summary = {'states': {}, 'workers': {}, 'failed': []}
+        for task in self.tasks():
+            summary['states'][task['state']] = summary['states'].get(task['state'], 0) + 1
+            if task['state'] == 'done':
+                worker = summary['workers'].setdefault(task['worker'], {'datasets': 0, 'seconds': 0})
+                worker['datasets'] += 1
+                worker['seconds'] += task['seconds']
+            elif task['state'] == 'failed':
+                summary['failed'].append([task['dataset'], task['error']])
+        return summary
+
+class QueueWorker(object):
+    # claims datasets from a WorkQueue one at a time for run_lcms (datasets generator)
+    # a dataset is done when run_lcms asks for the next one; heartbeats sent from a background thread every third of
+    # the lease while a dataset is processed
+    # waits while other workers still have running datasets so it can take over those of a worker that stops
+
+    def __init__(self, queue_path, lease_seconds=300, max_attempts=3, poll_interval=2):
+        self.queue_path = queue_path
+        self.work_queue = WorkQueue(queue_path)
+        self.name = socket.gethostname() + ':' + str(os.getpid())
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.current = None
+        self.stopped = threading.Event()
+        heartbeat_thread = threading.Thread(target=self.send_heartbeats)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+    def send_heartbeats(self):
+        heartbeat_queue = WorkQueue(self.queue_path)
+        # sqlite connections can only be used by the thread that created them
+        while not self.stopped.wait(self.lease_seconds / 3.0):
+            dataset = self.current
+            if dataset != None:
+                heartbeat_queue.heartbeat(self.name, dataset)
+
+    def datasets(self):
+        while True:
+            dataset = self.work_queue.claim(self.name, self.lease_seconds, self.max_attempts)
+            if dataset == None:
+                if self.work_queue.unfinished() == 0:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            self.current = dataset
+            start_time = timeit.default_timer()
+            yield dataset
+            self.current = None
+            self.work_queue.complete(self.name, dataset, timeit.default_timer() - start_time)
+
+    def failed(self, error):
+        # dataset being processed failed with error; retried later
+        if self.current != None:
+            self.work_queue.fail(self.name, self.current, error, self.max_attempts)
+            self.current = None
+
+    def stop(self):
+        self.stopped.set()
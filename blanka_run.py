@@ -1,12 +1,25 @@
-import argparse, subprocess, os, copy, sys, pandas, numpy, timeit
+import argparse, subprocess, os, copy, sys, time, pandas, numpy, timeit, cPickle, math, signal
+import shutil, tempfile, collections
 import pyteomics.mzxml as pytmzxml
 import pyteomics.mgf as pytmgf
 from multiprocessing import Pool, cpu_count
 from functools import partial
+from itertools import islice
 import blanka_lcms as lcms
 import blanka_maldi_dd as dd
+import blanka_cache as cache
+import blanka_convert as convert
+import blanka_profile as profile
+import blanka_manifest as manifest
+import blanka_watch as watch
+import blanka_queue
+import blanka_store
+import blanka_binary
+import blanka_mgf
+import blanka_mzxml
 
-def get_args():
+def get_args(argv=None):
+    # argv: argument list to parse instead of sys.argv (ex: benchmarks)
     parser = argparse.ArgumentParser()
     parser.add_argument('--cpu', help="number of threads to use - default = max-1", default=cpu_count() - 1, type=int)
     parser.add_argument('--instrument', help="instrument/experiment: choose 'lcq', 'qtof', or 'dd'",
@@ -17,7 +30,9 @@ def get_args():
     parser.add_argument('--dd_template', help='dried droplet excel sheet with sample names', default='', type=str)
     parser.add_argument('--output', help="output directory for all generated files; default=source folder",
                         type=str, default='')
-    parser.add_argument('--signal_noise_ratio', help="integer signal to noise ratio - default = 4", default=4, type=int)
+    parser.add_argument('--signal_noise_ratio', help="signal to noise ratio - default = 4", default=4, type=float)
+    parser.add_argument('--noise_percentile', help="percent of lowest intensity peaks averaged as noise level - \
+                                                    default = 5", default=5, type=float)
     parser.add_argument('-r', '--retention_time_tolerance', help="retention time error in seconds - default = 0.1 s",
                         default=0.1, type=float)
     parser.add_argument('-m', '--precursor_mz_tolerance', help="absolute precursor m/z error in Da - default = 0.02 Da",
@@ -28,187 +43,817 @@ def get_args():
                         default=False, type=bool)
     parser.add_argument('--blank_removal_only', help='only perform blank removal; no noise removal',
                         default=False, type=bool)
-    arguments = parser.parse_args()
+    parser.add_argument('--ipc_stats', help='report bytes of tasks and results pickled between processes',
+                        default=False, type=bool)
+    parser.add_argument('--background_writer', help='write .mgf files on a background thread while processing',
+                        default=False, type=bool)
+    parser.add_argument('--control_cache', help='directory used to cache prepared control libraries between runs',
+                        default='', type=str)
+    parser.add_argument('--streaming', help='lcq/qtof: read spectra lazily and write .mgf as results arrive',
+                        default=False, type=bool)
+    parser.add_argument('--max_in_flight', help='streaming mode: max number of spectra being processed at once - \
+                                                 default = 2000', default=2000, type=int)
+    parser.add_argument('--parallel', help="'file' = process whole datasets in parallel, 'spectrum' = split spectra of \
+                                           one dataset at a time across workers, 'auto' = choose from number and size \
+                                           of datasets - default = auto", default='auto', type=str,
+                        choices=['auto', 'file', 'spectrum'])
+    parser.add_argument('--profile', help="write per stage timing and counts for each dataset to a .json or .csv file",
+                        default='', type=str)
+    parser.add_argument('--profile_workers', help="directory for a cProfile dump (.prof) of each worker process",
+                        default='', type=str)
+    parser.add_argument('--output_format', help="'mgf' = .mgf text files, 'binary' = memory mappable peak arrays and \
+                                                metadata table (export to .mgf with blanka_binary.py) - default = mgf",
+                        default='mgf', type=str, choices=['mgf', 'binary'])
+    parser.add_argument('--manifest', help="run manifest .json file; datasets completed by a previous run with the same \
+                                           inputs and parameters are skipped and interrupted streaming runs resume \
+                                           from their last checkpoint", default='', type=str)
+    parser.add_argument('--checkpoint_interval', help='streaming mode with --manifest: spectra written between \
+                                                       checkpoints - default = 1000', default=1000, type=int)
+    parser.add_argument('--control_min_spots', help='dd: only remove control peaks found in at least this many control \
+                                                     spots - default = 1', default=1, type=int)
+    parser.add_argument('--max_conversions', help='max number of MSConvert processes running at once - default = 2',
+                        default=2, type=int)
+    parser.add_argument('--watch', help='keep running and process new acquisitions as they are written to the sample \
+                                         directory', default=False, type=bool)
+    parser.add_argument('--watch_interval', help='watch mode: seconds between checks for new acquisitions - \
+                                                  default = 2', default=2, type=float)
+    parser.add_argument('--settle_time', help='watch mode: seconds an acquisition must be unchanged before it is \
+                                               processed - default = 5', default=5, type=float)
+    parser.add_argument('--watch_timeout', help='watch mode: stop after this many seconds without new acquisitions; \
+                                                 0 = run until Ctrl+C - default = 0', default=0, type=float)
+    parser.add_argument('--queue', help="lcq/qtof: shared work queue file (SQLite) for processing one batch on several \
+                                        machines; run with --sample/--control to start a batch", default='', type=str)
+    parser.add_argument('--queue_worker', help='join the batch in --queue as a worker using its parameters',
+                        default=False, type=bool)
+    parser.add_argument('--local_workers', help='queue mode: number of worker processes started on this machine next \
+                                                 to the coordinator - default = 0', default=0, type=int)
+    parser.add_argument('--max_attempts', help='queue mode: times a dataset is tried before it is marked as failed - \
+                                                default = 3', default=3, type=int)
+    parser.add_argument('--lease_seconds', help='queue mode: seconds without a heartbeat before a dataset of a \
+                                                 stopped worker is taken over - default = 300', default=300,
+                        type=float)
+    parser.add_argument('--sample_store', help='lcq/qtof: directory for memory mapped peak stores of sample .mzXML \
+                                                files; workers are sent scan ranges instead of spectra', default='',
+                        type=str)
+    arguments = parser.parse_args(argv)
+    if arguments.parallel == 'file' and (arguments.streaming == True or arguments.sample_store != ''):
+        parser.error('--parallel file cannot be used with --streaming or --sample_store (spectrum level only)')
     return vars(arguments)
 
-def run_lcms(args):
+def start_run(args):
+    # main pool, --profile report and --manifest used by the run functions; called before run_lcms/run_maldi_dd by
+    # __main__ and by scripts that call them directly
+    global pool, run_profile, run_manifest, pool_plate_controls
+    pool = Pool(processes=args['cpu'])
+    pool_plate_controls = {}
+    run_profile = profile.RunProfile(args['profile'])
+    run_manifest = manifest.RunManifest(args['manifest'], args)
+
+def finish_run():
+    # write --profile report and --manifest and stop the main pool
+    for converted_file, conversion_seconds in convert.conversion_times.items():
+        run_profile.add(converted_file, 'conversion', wall_seconds=conversion_seconds, spectra=0)
+    run_profile.write()
+    run_manifest.save(True)
+    pool.close()
+    pool.join()
+
+def pickled_size(data):
+    # number of bytes data takes up when pickled to be sent to a worker process
+    return len(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+
+def default_chunksize(data_length, processes):
+    # chunksize pool.map uses when none is given (same calculation as multiprocessing)
+    chunksize, extra = divmod(data_length, processes * 4)
+    if extra:
+        chunksize += 1
+    return max(1, chunksize)
+
+def map_task_count(data_length, processes, chunksize=None):
+    # number of tasks pool.map splits data into; default chunksize calculated the same way as multiprocessing
+    if data_length == 0:
+        return 0
+    if chunksize == None:
+        chunksize = default_chunksize(data_length, processes)
+    return int(math.ceil(data_length / float(chunksize)))
+
+def control_transfer_report(args, control_library, task_count):
+    # estimated bytes of control data sent to workers if bound to each task vs sent once by the pool initializer
+    # (pickled size of the control library times number of tasks or workers); payload_report measures what was sent
+    control_bytes = pickled_size(control_library)
+    print "Control library: " + str(control_bytes) + " bytes pickled"
+    print "Estimated if bound per task: " + str(control_bytes * task_count) + " bytes over " + str(task_count) + \
+          " tasks"
+    print "Estimated with pool initializer: " + str(control_bytes * args['cpu']) + " bytes over " + \
+          str(args['cpu']) + " workers"
+
+def payload_report(function, tasks, results, chunksize=1):
+    # bytes pickled to send tasks to workers and results back, measured by pickling the same (function, chunk) task
+    # and result chunks the pool sends; includes sample spectra and anything bound to the worker function
+    task_bytes = sum([pickled_size((function, tuple(tasks[i:i + chunksize])))
+                      for i in range(0, len(tasks), chunksize)])
+    result_bytes = sum([pickled_size(results[i:i + chunksize]) for i in range(0, len(results), chunksize)])
+    print "Tasks sent: " + str(task_bytes) + " bytes over " + str(map_task_count(len(tasks), 1, chunksize)) + \
+          " tasks"
+    print "Results returned: " + str(result_bytes) + " bytes"
+
+def control_worker_pool(args, initializer, initargs):
+    # replace the main pool with one whose workers are set up by initializer (ex: control library sent to each worker
+    # once) instead of starting a second pool next to it; the new pool is also used for tasks that do not need it
+    global pool, pool_plate_controls
+    pool.close()
+    pool.join()
+    pool = Pool(processes=args['cpu'], initializer=initializer, initargs=initargs)
+    pool_plate_controls = {}
+    return pool
+
+def block_noise_removal(args, noise_block_args, spectra, block_size=None, dataset=None):
+    # noise removal over blocks of spectra so each worker processes a whole block of scans at once
+    # default block_size calculated the same way as the multiprocessing default chunksize
+    # dataset: name worker stats are recorded under when profiling
+    if block_size == None:
+        block_size = max(1, int(math.ceil(len(spectra) / float(args['cpu'] * 4))))
+    blocks = [spectra[i:i + block_size] for i in range(0, len(spectra), block_size)]
+    noise_block_args = run_profile.worker(noise_block_args,
+                                          partial(profile.worker_noise_removal_block, args, noise_block_args))
+    return [spectrum for block in run_profile.collect(dataset, pool.map(noise_block_args, blocks))
+            for spectrum in block]
+
+def spectrum_chunksize(args, spectra_count, max_chunksize=200):
+    # chunksize for spectrum level parallelism; about four chunks per worker (multiprocessing default) so small
+    # datasets are still split across every worker, capped at max_chunksize for large datasets
+    return max(1, min(max_chunksize, int(math.ceil(spectra_count / float(args['cpu'] * 4)))))
+
+def dataset_weight(dataset):
+    # relative amount of work in a dataset; file size used since counting spectra means parsing the file
+    return os.path.getsize(dataset)
+
+def choose_parallelism(args, sample_file_list):
+    # 'file' or 'spectrum' parallelism from --parallel
+    # auto = file level when there are at least as many datasets as workers and no dataset is larger than an even
+    # share of the total, so one large file cannot leave the other workers idle; spectrum level otherwise
+    # files still being converted (not a list yet) are processed at spectrum level as they arrive
+    if args['parallel'] != 'auto':
+        return args['parallel']
+    if args['profile'] != '':
+        return 'spectrum'
+        # per stage metrics only recorded at spectrum level
+    if args['sample_store'] != '':
+        return 'spectrum'
+        # peak stores split scan ranges of one dataset across workers
+    if not isinstance(sample_file_list, list) or len(sample_file_list) < max(2, args['cpu']):
+        return 'spectrum'
+    weights = [dataset_weight(dataset) for dataset in sample_file_list]
+    if max(weights) <= sum(weights) / float(args['cpu']):
+        return 'file'
+    return 'spectrum'
+
+def dataset_output(args, dataset):
+    # output prefix for .mgf files of a dataset (or dd spot file)
+    if args['output'] == '':
+        return dataset.split('.')[0] + '_blanka_'
+        # ex: D:\folder\filename
+    else:
+        return args['output'] + dataset.split('\\')[-1].split('.')[0] + '_blanka_'
+
+def run_datasets(args, datasets, worker_function, initializer=None, initargs=()):
+    # file level parallelism; each worker reads, processes and writes whole datasets
+    # largest datasets started first so smaller ones fill in the remaining time on each worker
+    # main pool replaced by one set up with initializer if given; returns worker_function results in completion order
+    datasets = [[dataset, dataset_output(args, dataset)] for dataset in
+                sorted(datasets, key=dataset_weight, reverse=True)]
+    print "Processing " + str(len(datasets)) + " datasets in parallel"
+    if initializer == None:
+        worker_pool = pool
+    else:
+        worker_pool = control_worker_pool(args, initializer, initargs)
+    results = []
+    with run_profile.stage('all datasets', 'file level processing') as counts:
+        for result in worker_pool.imap_unordered(partial(worker_function, args), datasets):
+            run_manifest.complete(result[0], result[1], result[2])
+            results.append(result)
+    if args['ipc_stats'] == True:
+        payload_report(partial(worker_function, args), datasets, results)
+    return results
+
+def read_dataset(args, dataset):
+    # list of spectra in an .mzXML file; workers decode disjoint ranges of scans at the same time
+    return blanka_mzxml.read_spectra_parallel(pool, dataset, args['cpu'] * 4)
+
+def read_spots(file_list):
+    # dd: [first spectrum, filename] of each spot file; spot files decoded by workers at the same time
+    return [[spectrum, mzxml] for spectrum, mzxml in zip(pool.map(blanka_mzxml.read_first_spectrum, file_list),
+                                                         file_list)]
+
+def pending_datasets(datasets):
+    # datasets not completed by a previous run (--manifest); a list for lists, a generator for files being converted
+    def pending():
+        for dataset in datasets:
+            if run_manifest.is_complete(dataset):
+                print "Skipping " + dataset.split("\\")[-1] + " (completed by a previous run)"
+            else:
+                yield dataset
+    if isinstance(datasets, list):
+        return list(pending())
+    return pending()
+
+def checkpointed(args, dataset, mgf_files, results, start=0):
+    # results of a streamed dataset, one per spectrum in file order; output written so far is checkpointed to the
+    # manifest every checkpoint_interval results so an interrupted run can resume from the last checkpoint
+    # start: spectra written by the interrupted run this one resumes
+    written = start
+    for result in results:
+        yield result
+        # result written by the caller before the next one is requested
+        written += 1
+        if run_manifest.enabled and (written - start) % args['checkpoint_interval'] == 0:
+            run_manifest.checkpoint(dataset, written, mgf_files.checkpoint())
+
+def map_chunk(function, chunk):
+    # worker side of bounded_imap
+    return [function(item) for item in chunk]
+
+def bounded_imap(worker_pool, function, data, max_in_flight, chunksize=1):
+    # pool.imap that reads at most max_in_flight items from data ahead of the results returned; results in order
+    # chunks submitted from the calling thread with apply_async, so if reading data or handling results raises no pool
+    # thread is left waiting on this call (pool.imap keeps a stopped job in the pool and pool.join never returns)
+    # chunksize capped at max_in_flight so at least one chunk is always in flight
+    chunksize = max(1, min(chunksize, max_in_flight))
+    max_chunks = max(1, max_in_flight // chunksize)
+    data = iter(data)
+    pending = collections.deque()
+    for chunk in iter(lambda: list(islice(data, chunksize)), []):
+        pending.append(worker_pool.apply_async(map_chunk, (function, chunk)))
+        if len(pending) >= max_chunks:
+            for result in pending.popleft().get():
+                yield result
+    while pending:
+        for result in pending.popleft().get():
+            yield result
+
+def stream_chunksize(args):
+    # chunksize for streaming mode; at least two chunks per worker fit within max_in_flight
+    return max(1, min(200, args['max_in_flight'] // (args['cpu'] * 2)))
+
+def lcms_control_library(args, control_files, noise_removed):
+    # list of control spectra (noise removed if noise_removed) for lcq/qtof runs
+    if args['streaming'] == True:
+        with run_profile.stage('control', 'loading and noise removal') as counts:
+            control_data = lcms.read_control_data(args, control_files)
+            if noise_removed:
+                noise_args = partial(lcms.noise_removal, args['signal_noise_ratio'], args['noise_percentile'])
+                noise_args = run_profile.worker(noise_args, partial(profile.worker_noise_removal, args, noise_args))
+                control_data = run_profile.collect('control', bounded_imap(pool, noise_args, control_data,
+                                                                           args['max_in_flight'],
+                                                                           stream_chunksize(args)))
+            control_data = list(control_data)
+            # control spectra read lazily; only noise removed copy kept in memory
+            counts['spectra'] = len(control_data)
+    else:
+        with run_profile.stage('control', 'loading') as counts:
+            control_data = lcms.load_control_data(args, control_files, pool)
+            counts['spectra'] = len(control_data)
+        if noise_removed:
+            noise_args = partial(lcms.noise_removal_block, args['signal_noise_ratio'], args['noise_percentile'])
+            control_data = block_noise_removal(args, noise_args, control_data,
+                                               spectrum_chunksize(args, len(control_data)), 'control')
+    return control_data
+
+def dd_control_library(args, control_list):
+    # single noise removed consensus spectrum binned from control spot .mzXML files in control_list
+    # combined spectrum loaded from --control_cache if saved by a previous run with the same files and parameters
+    if args['control_cache'] != '':
+        library_path = cache.control_library_path(args, control_list, True)
+        if os.path.isdir(library_path):
+            print "Loading control library from " + library_path
+            return cache.load_control_consensus(library_path, dd.consensus_keys)
+    with run_profile.stage('control', 'loading') as counts:
+        control_data = [i[0] for i in dd.load_control_data(args, control_list)]
+        counts['spectra'] = len(control_data)
+    # list of control spectra (dict form)
+    control_noise_args = partial(dd.noise_removal_block, args['signal_noise_ratio'], args['noise_percentile'])
+    control_noiseless_data = block_noise_removal(args, control_noise_args, control_data, dataset='control')
+    # list of noise removed control spectra
+    control_noiseless_data = dd.consensus_control_spectrum(control_noiseless_data, args['peak_mz_tolerance'],
+                                                           args['control_min_spots'])
+    # single control dict
+    if args['control_cache'] != '':
+        print "Saving control library to " + library_path
+        cache.save_control_consensus(library_path, control_noiseless_data)
+    return control_noiseless_data
+
+dd_control_libraries = {}
+# noise removed control dicts by control spot files; kept between run_maldi_dd calls in watch mode
+
+pool_plate_controls = {}
+# {plate: control dict} sent to the workers of the main pool by dd_control_pool
+
+def dd_control_pool(args, plate_controls):
+    # main pool with the control dict of every plate sent to each worker once (dd.init_plate_control_worker); workers
+    # select the control of each spot's plate, so the pool is only replaced when a batch brings a plate (or control
+    # library) the workers do not have yet (ex: watch mode)
+    global pool_plate_controls
+    if all([pool_plate_controls.get(plate) is control for plate, control in plate_controls.items()]):
+        return pool
+    sent_plate_controls = dict(pool_plate_controls)
+    sent_plate_controls.update(plate_controls)
+    control_worker_pool(args, dd.init_plate_control_worker, (sent_plate_controls,))
+    pool_plate_controls = sent_plate_controls
+    return pool
+
+def lcms_streaming_dataset(args, dataset):
+    # streaming version of lcms_dataset; spectra read lazily from the .mzXML file and written to .mgf as results
+    # arrive; memory use bounded by max_in_flight instead of dataset size
+    chunksize = stream_chunksize(args)
+    noise_args = partial(lcms.noise_removal, args['signal_noise_ratio'], args['noise_percentile'])
+    blanka_output = dataset_output(args, dataset)
+    # prep output directory/filenames
+    print "Processing " + dataset.split("\\")[-1]
+    start, resume_files = run_manifest.resume_point(dataset)
+    if start > 0:
+        print "Resuming from spectrum " + str(start)
+    sample_data = islice(blanka_mzxml.read_spectra(dataset), start, None)
+    # spectra written before the last checkpoint of an interrupted run are skipped
+    with lcms.dataset_mgf_writer(blanka_output, args['background_writer'], args['output_format'],
+                                 resume_files) as mgf_files, \
+            run_profile.stage(dataset, 'loading, processing and mgf writing') as counts:
+        if args['noise_removal_only'] == False and args['blank_removal_only'] == False:
+            print "Removing Noise and Blank"
+            noise_blank_args = run_profile.worker(partial(lcms.worker_noise_blank_removal, args),
+                                                  partial(profile.worker_lcms_noise_blank_removal, args))
+            processed_data = run_profile.collect(dataset, bounded_imap(pool, noise_blank_args, sample_data,
+                                                                       args['max_in_flight'], chunksize))
+            for noiseless_spectrum, processed_spectrum in checkpointed(args, dataset, mgf_files,
+                                                                       processed_data, start):
+                mgf_files.write(noiseless_spectrum, 'noise_removed')
+                if processed_spectrum != None:
+                    mgf_files.write(processed_spectrum[0], 'processed')
+                    if processed_spectrum[1] != None:
+                        mgf_files.write(processed_spectrum[1], 'removed_peaks')
+            # remove noise and blank in one pass and write to .mgf
+        elif args['noise_removal_only'] == True:
+            print "Removing Noise"
+            sample_noise_args = run_profile.worker(noise_args,
+                                                   partial(profile.worker_noise_removal, args, noise_args))
+            noiseless_data = run_profile.collect(dataset, bounded_imap(pool, sample_noise_args, sample_data,
+                                                                       args['max_in_flight'], chunksize))
+            for spectrum in checkpointed(args, dataset, mgf_files, noiseless_data, start):
+                mgf_files.write(spectrum, 'noise_removed')
+            # remove noise and write to .mgf
+        elif args['blank_removal_only'] == True:
+            print "Removing Blank"
+            spectra_compare_args = run_profile.worker(partial(lcms.worker_spectra_compare, args),
+                                                      partial(profile.worker_lcms_spectra_compare, args))
+            processed_data = run_profile.collect(dataset, bounded_imap(pool, spectra_compare_args, sample_data,
+                                                                       args['max_in_flight'], chunksize))
+            for processed_spectrum in checkpointed(args, dataset, mgf_files, processed_data, start):
+                if processed_spectrum != None:
+                    mgf_files.write(processed_spectrum[0], 'processed')
+                    if processed_spectrum[1] != None:
+                        mgf_files.write(processed_spectrum[1], 'removed_peaks')
+            # remove blank and write to .mgf
+    run_manifest.complete(dataset, files=mgf_files.output_paths)
+
+def lcms_store_dataset(args, dataset, control_index):
+    # lcms_dataset with --sample_store; the sample .mzXML is converted once to a memory mapped peak store, workers read
+    # scan ranges from it and write the results of each range in the output format; range outputs are concatenated
+    # into the dataset output in scan order without decoding them, so result peaks never pass through this process
+    if not os.path.isdir(args['sample_store']):
+        os.makedirs(args['sample_store'])
+    blanka_output = dataset_output(args, dataset)
+    print "Processing " + dataset.split("\\")[-1]
+    with run_profile.stage(dataset, 'loading') as counts:
+        sample_store = blanka_store.store_path(args['sample_store'], dataset)
+        spectra_count = blanka_store.build_store(dataset, sample_store)
+        counts['spectra'] = spectra_count
+    range_dir = tempfile.mkdtemp(dir=args['sample_store'])
+    store_ranges = [[sample_store, os.path.join(range_dir, str(count) + '_blanka_'), start, stop, blanka_output]
+                    for count, (start, stop) in enumerate(blanka_store.store_ranges(
+                        spectra_count, spectrum_chunksize(args, spectra_count)))]
+    if args['ipc_stats'] == True and args['noise_removal_only'] == False:
+        control_transfer_report(args, control_index, len(store_ranges))
+    try:
+        with run_profile.stage(dataset, 'noise and blank removal') as counts:
+            range_counts = pool.map(partial(lcms.worker_store_removal, args), store_ranges, chunksize=1)
+            counts['spectra'] = spectra_count
+        if args['ipc_stats'] == True:
+            payload_report(partial(lcms.worker_store_removal, args), store_ranges, range_counts)
+        output_files = []
+        with run_profile.stage(dataset, 'mgf writing') as counts:
+            for datatype in ['noise_removed', 'processed', 'removed_peaks']:
+                if args['output_format'] == 'binary':
+                    pieces = [store_range[1] + datatype + '_data' for store_range in store_ranges
+                              if os.path.isdir(store_range[1] + datatype + '_data')]
+                    if pieces != []:
+                        blanka_binary.concatenate_containers(pieces, blanka_output + datatype + '_data')
+                        output_files.append(blanka_output + datatype + '_data')
+                else:
+                    for suffix in ('_data_ms2.mgf', '_data_full.mgf'):
+                        pieces = [store_range[1] + datatype + suffix for store_range in store_ranges
+                                  if os.path.isfile(store_range[1] + datatype + suffix)]
+                        if pieces != []:
+                            blanka_mgf.concatenate_files(pieces, blanka_output + datatype + suffix)
+                            output_files.append(blanka_output + datatype + suffix)
+            counts['spectra'] = spectra_count
+    finally:
+        shutil.rmtree(range_dir)
+    run_manifest.complete(dataset, spectra_count, output_files)
+
+def lcms_sample_files(args):
+    # sample .mzXML files in args['sample']; raw data converted if no .mzXML files are found (generator of files as
+    # their conversion finishes)
     if not args['sample'].endswith('.mzXML'):
         sample_file_list = lcms.mzxml_data_detection(args['sample'])
         # find .mzXML files in sample and control directory
         if sample_file_list == []:
             sample_raw_list = lcms.raw_data_detection(args, args['sample'])
-            lcms.msconvert(args, sample_raw_list)
+            sample_file_list = lcms.msconvert_iter(args, sample_raw_list)
             # detect raw data if no .mzXML files found and convert to .mzXML
-            if args['output'] == '':
-                files_dir = args['sample']
-            else:
-                files_dir = args['output']
-            sample_file_list = lcms.mzxml_data_detection(files_dir)
-            # list of .mzXML files
+            # each .mzXML file is processed as soon as it is converted while remaining conversions keep running
     else:
         sample_file_list = [args['sample']]
         # single .mzXML file
-    control_data = lcms.load_control_data(args)
-    # list of control spectra from .mzXML file
-    control_noise_args = partial(lcms.noise_removal, args['signal_noise_ratio'])
-    control_noiseless_data = pool.map(control_noise_args, control_data, chunksize=200)
-    # list of noise removed control spectra
+    return sample_file_list
 
+def lcms_dataset(args, dataset, control_index):
+    # noise and/or blank removal for one sample dataset at spectrum level with the main pool (set up with the control
+    # library by lcms_control_pool unless noise removal only)
+    blanka_output = dataset_output(args, dataset)
+    # prep output directory/filenames
     if args['noise_removal_only'] == False and args['blank_removal_only'] == False:
-        for dataset in sample_file_list:
-            if args['control'] != dataset:
-                if args['output'] == '':
-                    blanka_output = dataset.split('.')[0] + '_blanka_'
-                    # ex: D:\folder\filename
-                else:
-                    blanka_output = args['output'] + dataset.split('\\')[-1].split('.')[0] + '_blanka_'
-                # prep output directory/filenames
-                print "Processing " + dataset.split("\\")[-1]
-                sample_data = list(pytmzxml.read(dataset))
-                print "Removing Noise"
-                sample_noise_args = partial(lcms.noise_removal, args['signal_noise_ratio'])
-                sample_noiseless_data = pool.map(sample_noise_args, sample_data, chunksize=200)
-                for spectrum in sample_noiseless_data:
-                    lcms.mgf_writer(spectrum, blanka_output, 'noise_removed')
-                # remove noise and write to .mgf
-                print "Removing Blank"
-                spectra_compare_args = partial(lcms.spectra_compare, args, control_noiseless_data)
-                processed_data = filter(None, pool.map(spectra_compare_args, sample_noiseless_data, chunksize=200))
-                for processed_spectrum, changed_spectrum_data in processed_data:
-                    lcms.mgf_writer(processed_spectrum, blanka_output, 'processed')
-                    if changed_spectrum_data != None:
-                        lcms.mgf_writer(changed_spectrum_data, blanka_output, 'removed_peaks')
-                # remove blank and write to .mgf
+        print "Processing " + dataset.split("\\")[-1]
+        with run_profile.stage(dataset, 'loading') as counts:
+            sample_data = read_dataset(args, dataset)
+            counts['spectra'] = len(sample_data)
+        print "Removing Noise and Blank"
+        if args['ipc_stats'] == True:
+            control_transfer_report(args, control_index,
+                                    map_task_count(len(sample_data), args['cpu'],
+                                                   spectrum_chunksize(args, len(sample_data))))
+        noise_blank_args = run_profile.worker(partial(lcms.worker_noise_blank_removal, args),
+                                              partial(profile.worker_lcms_noise_blank_removal, args))
+        processed_data = run_profile.collect(dataset, pool.map(noise_blank_args, sample_data,
+                                                               chunksize=spectrum_chunksize(args, len(sample_data))))
+        if args['ipc_stats'] == True:
+            payload_report(noise_blank_args, sample_data, processed_data,
+                           spectrum_chunksize(args, len(sample_data)))
+        with run_profile.stage(dataset, 'mgf writing') as counts, \
+                lcms.dataset_mgf_writer(blanka_output, args['background_writer'], args['output_format']) as mgf_files:
+            for noiseless_spectrum, processed_spectrum in processed_data:
+                mgf_files.write(noiseless_spectrum, 'noise_removed')
+                if processed_spectrum != None:
+                    mgf_files.write(processed_spectrum[0], 'processed')
+                    if processed_spectrum[1] != None:
+                        mgf_files.write(processed_spectrum[1], 'removed_peaks')
+            # remove noise and blank in one pass and write to .mgf
+            counts['spectra'] = len(processed_data)
+        run_manifest.complete(dataset, len(sample_data), mgf_files.output_paths)
     elif args['noise_removal_only'] == True:
-        for dataset in sample_file_list:
-            if args['control'] != dataset:
-                if args['output'] == '':
-                    blanka_output = dataset.split('.')[0] + '_blanka_'
-                    # ex: D:\folder\filename
-                else:
-                    blanka_output = args['output'] + dataset.split('\\')[-1].split('.')[0] + '_blanka_'
-                # prep output directory/filenames
-                print "Processing " + dataset.split("\\")[-1]
-                sample_data = list(pytmzxml.read(dataset))
-                print "Removing Noise"
-                sample_noise_args = partial(lcms.noise_removal, args['signal_noise_ratio'])
-                sample_noiseless_data = pool.map(sample_noise_args, sample_data, chunksize=200)
-                for spectrum in sample_noiseless_data:
-                    lcms.mgf_writer(spectrum, blanka_output, 'noise_removed')
-                # remove noise and write to .mgf
+        print "Processing " + dataset.split("\\")[-1]
+        with run_profile.stage(dataset, 'loading') as counts:
+            sample_data = read_dataset(args, dataset)
+            counts['spectra'] = len(sample_data)
+        print "Removing Noise"
+        sample_noise_args = partial(lcms.noise_removal_block, args['signal_noise_ratio'],
+                                    args['noise_percentile'])
+        sample_noiseless_data = block_noise_removal(args, sample_noise_args, sample_data,
+                                                    spectrum_chunksize(args, len(sample_data)), dataset)
+        with run_profile.stage(dataset, 'mgf writing') as counts, \
+                lcms.dataset_mgf_writer(blanka_output, args['background_writer'], args['output_format']) as mgf_files:
+            for spectrum in sample_noiseless_data:
+                mgf_files.write(spectrum, 'noise_removed')
+            # remove noise and write to .mgf
+            counts['spectra'] = len(sample_noiseless_data)
+        run_manifest.complete(dataset, len(sample_data), mgf_files.output_paths)
     elif args['blank_removal_only'] == True:
-        for dataset in sample_file_list:
-            if args['control'] != dataset:
-                if args['output'] == '':
-                    blanka_output = dataset.split('.')[0] + '_blanka_'
-                    # ex: D:\folder\filename
-                else:
-                    blanka_output = args['output'] + dataset.split('\\')[-1].split('.')[0] + '_blanka_'
-                # prep output directory/filenames
-                print "Processing " + dataset.split("\\")[-1]
-                sample_data = list(pytmzxml.read(dataset))
-                print "Removing Blank"
-                spectra_compare_args = partial(lcms.spectra_compare, args, control_data)
-                processed_data = filter(None, pool.map(spectra_compare_args, sample_data, chunksize=200))
-                for processed_spectrum, changed_spectrum_data in processed_data:
-                    lcms.mgf_writer(processed_spectrum, blanka_output, 'processed')
-                    if changed_spectrum_data != None:
-                        lcms.mgf_writer(changed_spectrum_data, blanka_output, 'removed_peaks')
-                # remove blank and write to .mgf
+        print "Processing " + dataset.split("\\")[-1]
+        with run_profile.stage(dataset, 'loading') as counts:
+            sample_data = read_dataset(args, dataset)
+            counts['spectra'] = len(sample_data)
+        print "Removing Blank"
+        if args['ipc_stats'] == True:
+            control_transfer_report(args, control_index,
+                                    map_task_count(len(sample_data), args['cpu'],
+                                                   spectrum_chunksize(args, len(sample_data))))
+        spectra_compare_args = run_profile.worker(partial(lcms.worker_spectra_compare, args),
+                                                  partial(profile.worker_lcms_spectra_compare, args))
+        compared_data = run_profile.collect(dataset, pool.map(
+            spectra_compare_args, sample_data, chunksize=spectrum_chunksize(args, len(sample_data))))
+        if args['ipc_stats'] == True:
+            payload_report(spectra_compare_args, sample_data, compared_data,
+                           spectrum_chunksize(args, len(sample_data)))
+        processed_data = filter(None, compared_data)
+        with run_profile.stage(dataset, 'mgf writing') as counts, \
+                lcms.dataset_mgf_writer(blanka_output, args['background_writer'], args['output_format']) as mgf_files:
+            for processed_spectrum, changed_spectrum_data in processed_data:
+                mgf_files.write(processed_spectrum, 'processed')
+                if changed_spectrum_data != None:
+                    mgf_files.write(changed_spectrum_data, 'removed_peaks')
+            # remove blank and write to .mgf
+            counts['spectra'] = len(processed_data)
+        run_manifest.complete(dataset, len(sample_data), mgf_files.output_paths)
 
-def run_maldi_dd(args):
-    if not args['sample'].endswith('.mzXML'):
+def lcms_control_index(args):
+    # control spectra (noise removed unless blank removal only) indexed by ms level, retention time and precursor m/z
+    # loaded from --control_cache if a library with the same control files and parameters was saved by a previous run;
+    # the saved index is memory mapped instead of rebuilt
+    noise_removed = args['blank_removal_only'] == False
+    control_files = lcms.control_file_detection(args)
+    if args['control_cache'] != '':
+        library_path = cache.control_library_path(args, control_files, noise_removed)
+        if os.path.isdir(library_path):
+            print "Loading control library from " + library_path
+            return cache.load_control_index(library_path)
+    control_data = lcms_control_library(args, control_files, noise_removed)
+    control_index = lcms.build_control_index(control_data)
+    if args['control_cache'] != '':
+        print "Saving control library to " + library_path
+        cache.save_control_library(library_path, control_data, control_index)
+    return control_index
+
+def lcms_control_pool(args, control_index):
+    # main pool replaced by one with the control library sent to each worker once; kept for every dataset of the run
+    if args['noise_removal_only'] == False:
+        control_worker_pool(args, lcms.init_control_worker, (control_index,))
+
+def run_lcms_dataset(args, dataset, control_index):
+    # spectrum level processing of one sample dataset (streamed, from a peak store or read into memory)
+    if args['streaming'] == True:
+        lcms_streaming_dataset(args, dataset)
+    elif args['sample_store'] != '':
+        lcms_store_dataset(args, dataset, control_index)
+    else:
+        lcms_dataset(args, dataset, control_index)
+
+def run_lcms(args, sample_file_list=None):
+    # sample_file_list: .mzXML files to process (list or generator, ex: watch_lcms); default = found in args['sample']
+    if sample_file_list == None:
+        sample_file_list = lcms_sample_files(args)
+    if run_manifest.enabled:
+        run_manifest.add_control_files(lcms.control_file_detection(args))
+        sample_file_list = pending_datasets(sample_file_list)
+        # control files are part of the parameters datasets were completed with
+    control_index = lcms_control_index(args)
+    if args['streaming'] == False and choose_parallelism(args, sample_file_list) == 'file':
+        datasets = [dataset for dataset in sample_file_list if args['control'] != dataset]
+        if args['ipc_stats'] == True and args['noise_removal_only'] == False:
+            control_transfer_report(args, control_index, len(datasets))
+        if args['noise_removal_only'] == True:
+            results = run_datasets(args, datasets, lcms.worker_dataset_removal)
+        else:
+            results = run_datasets(args, datasets, lcms.worker_dataset_removal, lcms.init_control_worker,
+                                   (control_index,))
+        for dataset, spectra_count, output_files in results:
+            print "Processed " + dataset.split("\\")[-1] + " (" + str(spectra_count) + " spectra)"
+        return
+    lcms_control_pool(args, control_index)
+    for dataset in sample_file_list:
+        if args['control'] != dataset:
+            run_lcms_dataset(args, dataset, control_index)
+
+def watch_lcms(args):
+    # --watch: .mzXML files written to the sample directory, yielded once complete; raw acquisitions are converted
+    # first and the converted .mzXML file yielded instead
+    watcher = watch.FolderWatcher(args['sample'], args['instrument'], args['watch_interval'], args['settle_time'])
+    watcher.ignore(args['control'])
+    print "Watching " + args['sample'] + " for new acquisitions"
+    for batch in watcher.batches(args['watch_timeout']):
+        for acquisition in batch:
+            if acquisition.endswith('.mzXML'):
+                yield acquisition
+            else:
+                for mzxml in lcms.msconvert_iter(args, [(acquisition, os.path.dirname(acquisition))]):
+                    if watcher.ignore(mzxml):
+                        yield mzxml
+                # .mzXML already processed if it was in the directory before its raw data
+
+def queue_arguments(args):
+    # --queue: datasets tracked by the queue instead of --manifest
+    # coordinator = arguments as given, control library cached next to the queue for all workers unless
+    # --control_cache is set; worker = arguments saved in the queue by the coordinator with this machine's --cpu
+    args['manifest'] = ''
+    if args['queue_worker'] == False:
+        if args['control_cache'] == '':
+            args['control_cache'] = os.path.splitext(args['queue'])[0] + '_control_cache'
+        return args
+    work_queue = blanka_queue.WorkQueue(args['queue'])
+    queue_args = work_queue.load_arguments()
+    if queue_args == None:
+        print "Waiting for the coordinator to start the batch in " + args['queue']
+        while queue_args == None:
+            time.sleep(2)
+            queue_args = work_queue.load_arguments()
+    for local_arg in ['cpu', 'queue', 'queue_worker', 'profile', 'profile_workers', 'ipc_stats']:
+        queue_args[local_arg] = args[local_arg]
+    return queue_args
+
+def run_queue(args):
+    # --queue coordinator: add sample datasets to the shared queue, prepare the control library once for all workers
+    # and save the run arguments so workers join with only --queue; starts --local_workers worker processes, processes
+    # datasets alongside them and reports the results of all workers once the queue is finished
+    if args['instrument'] not in ('lcq', 'qtof'):
+        print "--queue is only available for lcq and qtof data. Exiting BLANKA."
+        sys.exit(1)
+    sample_file_list = [dataset for dataset in lcms_sample_files(args) if dataset != args['control']]
+    # raw data converted before datasets are queued
+    work_queue = blanka_queue.WorkQueue(args['queue'])
+    work_queue.add([os.path.abspath(dataset) for dataset in sample_file_list])
+    lcms_control_index(args)
+    # saved to control_cache; workers load it instead of preparing their own
+    work_queue.save_arguments(args)
+    print "Queued " + str(len(sample_file_list)) + " datasets in " + args['queue']
+    local_workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--queue', args['queue'],
+                                       '--queue_worker', 'True', '--cpu', str(args['cpu'])])
+                     for i in range(args['local_workers'])]
+    run_queue_worker(args)
+    for local_worker in local_workers:
+        local_worker.wait()
+    summary = work_queue.summary()
+    print "Queue finished: " + ', '.join([str(count) + ' ' + state
+                                          for state, count in sorted(summary['states'].items())])
+    for worker, totals in sorted(summary['workers'].items()):
+        print worker + ": " + str(totals['datasets']) + " datasets, " + str(round(totals['seconds'], 1)) + " s"
+    for dataset, error in summary['failed']:
+        print "Failed: " + dataset + " (" + str(error) + ")"
+
+def run_queue_worker(args):
+    # process datasets claimed from --queue until every dataset is done or failed; a dataset that raises an error is
+    # queued again for any worker until --max_attempts
+    # control library and worker pool set up once and kept for every dataset, including after a dataset fails
+    worker = blanka_queue.QueueWorker(args['queue'], args['lease_seconds'], args['max_attempts'])
+    print "Worker " + worker.name + " processing " + args['queue']
+    control_index = lcms_control_index(args)
+    lcms_control_pool(args, control_index)
+    for dataset in worker.datasets():
+        try:
+            run_lcms_dataset(args, dataset, control_index)
+        except Exception as error:
+            print "Error processing " + dataset + ": " + repr(error)
+            worker.failed(repr(error))
+    worker.stop()
+
+def run_maldi_dd(args, file_list=None):
+    # file_list: spot .mzXML files to process (ex: batch from watch_maldi_dd); default = found in args['sample']
+    if file_list != None:
+        pass
+    elif not args['sample'].endswith('.mzXML'):
         file_list = dd.mzxml_data_detection(args['sample'])
         # find .mzXML files in sample directory
         if file_list == []:
             raw_file_list = dd.raw_data_detection(args)
-            #raw_file_list = dd.parse_maldi_template(args, raw_file_list)
-            raw_file_list = [(i, i.split('\\')[-5]) for i in raw_file_list]
-            dd.msconvert(args, raw_file_list)
-            # detect raw data if no .mzXML files found and convert to .mzXML
-            if args['output'] == '':
-                files_dir = args['sample']
+            if args['dd_template'] != '':
+                raw_file_list = dd.parse_maldi_template(args, raw_file_list)
             else:
-                files_dir = args['output']
-            file_list = dd.mzxml_data_detection(files_dir)
-            # list of .mzXML files
+                raw_file_list = [(i, i.split('\\')[-5]) for i in raw_file_list]
+            file_list = dd.msconvert(args, raw_file_list)
+            # detect raw data if no .mzXML files found and convert to .mzXML
     else:
         file_list = [args['sample']]
         # single .mzXML file
 
-    control_data = dd.load_control_data(args)
-    control_list = control_data[0][1]
-    control_data = [i[0] for i in control_data]
-    # list of control spectra (dict form)
-    control_noise_args = partial(dd.noise_removal, args['signal_noise_ratio'])
-    control_noiseless_data = pool.map(control_noise_args, control_data)
-    # list of noise removed control spectra
-    control_noiseless_data = dd.combine_control_spectra(control_noiseless_data)
-    # single control dict
-
-    if args['noise_removal_only'] == False and args['blank_removal_only'] == False:
-        file_list = [i for i in file_list if not i.startswith(args['control']) and i not in control_list]
-        sample_data = [[list(pytmzxml.read(mzxml))[0], mzxml] for mzxml in file_list]
-        print "Removing noise from samples."
-        sample_noise_args = partial(dd.noise_removal, args['signal_noise_ratio'])
-        sample_noiseless_data = pool.map(sample_noise_args, sample_data)
-        for spectrum, filename in sample_noiseless_data:
-            if args['output'] == '':
-                blanka_output = filename.split('.')[0] + '_blanka_'
-                # ex: D:\folder\filename
+    control_list = dd.control_file_detection(args)
+    run_manifest.add_control_files(control_list)
+    file_list = [i for i in file_list if not i.startswith(args['control']) and i not in control_list]
+    if run_manifest.enabled:
+        file_list = pending_datasets(file_list)
+    plates = dd.group_plates(file_list, control_list)
+    # [plate, control spot files, sample spot files]; each plate uses its own control spots
+    plate_controls = {}
+    if args['noise_removal_only'] == False:
+        for plate, plate_control_list, plate_file_list in plates:
+            if tuple(plate_control_list) not in dd_control_libraries:
+                dd_control_libraries[tuple(plate_control_list)] = dd_control_library(args, plate_control_list)
+            plate_controls[plate] = dd_control_libraries[tuple(plate_control_list)]
+        # single noise removed control dict for each plate; plates sharing control spots share one
+    if len(plates) > 1:
+        print "Processing " + str(len(plates)) + " plates"
+    parallelism = choose_parallelism(args, file_list)
+    if args['noise_removal_only'] == False:
+        if args['ipc_stats'] == True:
+            if parallelism == 'file':
+                task_count = len(file_list)
             else:
-                blanka_output = args['output'] + filename.split('\\')[-1].split('.')[0] + '_blanka_'
-            dd.mgf_writer(spectrum, blanka_output, 'noise_removed')
-        print "Removing blank from samples."
-        sample_blank_args = partial(dd.blank_removal, args['peak_mz_tolerance'], control_noiseless_data)
-        sample_blankless_data = pool.map(sample_blank_args, sample_noiseless_data)
-        for spectrum, changed_spectrum_data in sample_blankless_data:
-            if args['output'] == '':
-                blanka_output = spectrum[1].split('.')[0] + '_blanka_'
-                # ex: D:\folder\filename
+                task_count = sum([map_task_count(len(plate_file_list), args['cpu'])
+                                  for plate, plate_control_list, plate_file_list in plates])
+            control_transfer_report(args, plate_controls, task_count)
+        dd_control_pool(args, plate_controls)
+        # controls of all plates sent to the workers once; kept for later batches in watch mode
+
+    if parallelism == 'file':
+        run_datasets(args, file_list, dd.worker_dataset_removal)
+        # spots of all plates streamed through one pool; each worker reads its spot file and uses its plate control
+        return
+
+    for plate, plate_control_list, plate_file_list in plates:
+        run_maldi_dd_plate(args, plate, plate_file_list)
+        # spectrum level; spots read one plate at a time
+
+def watch_maldi_dd(args):
+    # --watch: process spot files written to the sample directory in batches as they are completed; raw spots are
+    # converted first
+    # spots wait until control spots have been written; control libraries stay in memory between batches
+    watcher = watch.FolderWatcher(args['sample'], 'dd', args['watch_interval'], args['settle_time'])
+    waiting = []
+    print "Watching " + args['sample'] + " for new spots"
+    for batch in watcher.batches(args['watch_timeout']):
+        raw_file_list = [acquisition for acquisition in batch if not acquisition.endswith('.mzXML')]
+        if raw_file_list != []:
+            if args['dd_template'] != '':
+                raw_file_list = dd.parse_maldi_template(args, raw_file_list)
             else:
-                blanka_output = args['output'] + spectrum[1].split('\\')[-1].split('.')[0] + '_blanka_'
-            dd.mgf_writer(spectrum[0], blanka_output, 'processed')
-            if changed_spectrum_data != None:
-                dd.mgf_writer(changed_spectrum_data, blanka_output, 'removed_peaks')
+                raw_file_list = [(i, i.split('\\')[-5]) for i in raw_file_list]
+            converted_list = [mzxml for mzxml in dd.msconvert(args, raw_file_list) if watcher.ignore(mzxml)]
+        else:
+            converted_list = []
+        waiting += [acquisition for acquisition in batch if acquisition.endswith('.mzXML')] + converted_list
+        if args['noise_removal_only'] == True or dd.control_file_detection(args) != []:
+            run_maldi_dd(args, waiting)
+            run_manifest.save(True)
+            waiting = []
+    if waiting != []:
+        print "No control spots found for " + str(len(waiting)) + " spots"
+
+def run_maldi_dd_plate(args, plate, file_list):
+    # process sample spot files of one plate; workers use the combined control spectrum of the plate sent by
+    # dd_control_pool
+    if args['noise_removal_only'] == False and args['blank_removal_only'] == False:
+        with run_profile.stage(plate, 'loading') as counts:
+            sample_data = read_spots(file_list)
+            counts['spectra'] = len(sample_data)
+        print "Removing noise and blank from samples."
+        sample_noise_blank_args = run_profile.worker(partial(dd.worker_noise_blank_removal, args),
+                                                     partial(profile.worker_dd_noise_blank_removal, args))
+        sample_processed_data = run_profile.collect(plate, pool.map(sample_noise_blank_args, sample_data))
+        if args['ipc_stats'] == True:
+            payload_report(sample_noise_blank_args, sample_data, sample_processed_data,
+                           default_chunksize(len(sample_data), args['cpu']))
+        with run_profile.stage(plate, 'mgf writing') as counts:
+            for noiseless_spectrum, (spectrum, changed_spectrum_data) in sample_processed_data:
+                with dd.dataset_mgf_writer(dataset_output(args, spectrum[1]), args['background_writer'],
+                                           args['output_format']) as mgf_files:
+                    mgf_files.write(noiseless_spectrum[0], 'noise_removed')
+                    mgf_files.write(spectrum[0], 'processed')
+                    if changed_spectrum_data != None:
+                        mgf_files.write(changed_spectrum_data, 'removed_peaks')
+                run_manifest.complete(spectrum[1], 1, mgf_files.output_paths)
+            counts['spectra'] = len(sample_processed_data)
+        # remove noise and blank in one pass and write to .mgf
     elif args['noise_removal_only'] == True:
-        file_list = [i for i in file_list if not i.startswith(args['control']) and i not in control_list]
-        sample_data = [[list(pytmzxml.read(mzxml))[0], mzxml] for mzxml in file_list]
+        with run_profile.stage(plate, 'loading') as counts:
+            sample_data = read_spots(file_list)
+            counts['spectra'] = len(sample_data)
         print "Removing noise from samples."
-        sample_noise_args = partial(dd.noise_removal, args['signal_noise_ratio'])
-        sample_noiseless_data = pool.map(sample_noise_args, sample_data)
-        for spectrum, filename in sample_noiseless_data:
-            if args['output'] == '':
-                blanka_output = filename.split('.')[0] + '_blanka_'
-                # ex: D:\folder\filename
-            else:
-                blanka_output = args['output'] + filename.split('\\')[-1].split('.')[0] + '_blanka_'
-            dd.mgf_writer(spectrum, blanka_output, 'noise_removed')
+        sample_noise_args = partial(dd.noise_removal_block, args['signal_noise_ratio'], args['noise_percentile'])
+        sample_noiseless_data = block_noise_removal(args, sample_noise_args, sample_data, dataset=plate)
+        with run_profile.stage(plate, 'mgf writing') as counts:
+            for spectrum, filename in sample_noiseless_data:
+                with dd.dataset_mgf_writer(dataset_output(args, filename), args['background_writer'],
+                                           args['output_format']) as mgf_files:
+                    mgf_files.write(spectrum, 'noise_removed')
+                run_manifest.complete(filename, 1, mgf_files.output_paths)
+            counts['spectra'] = len(sample_noiseless_data)
     elif args['blank_removal_only'] == True:
-        file_list = [i for i in file_list if not i.startswith(args['control']) and i not in control_list]
-        sample_data = [[list(pytmzxml.read(mzxml))[0], mzxml] for mzxml in file_list]
+        with run_profile.stage(plate, 'loading') as counts:
+            sample_data = read_spots(file_list)
+            counts['spectra'] = len(sample_data)
         print "Removing blank from samples."
-        sample_blank_args = partial(dd.blank_removal, args['peak_mz_tolerance'], control_noiseless_data)
-        sample_blankless_data = pool.map(sample_blank_args, sample_data)
-        for spectrum, changed_spectrum_data in sample_blankless_data:
-            if args['output'] == '':
-                blanka_output = spectrum[1].split('.')[0] + '_blanka_'
-                # ex: D:\folder\filename
-            else:
-                blanka_output = args['output'] + spectrum[1].split('\\')[-1].split('.')[0] + '_blanka_'
-            dd.mgf_writer(spectrum[0], blanka_output, 'processed')
-            if changed_spectrum_data != None:
-                dd.mgf_writer(changed_spectrum_data, blanka_output, 'removed_peaks')
+        sample_blank_args = run_profile.worker(partial(dd.worker_blank_removal, args['peak_mz_tolerance']),
+                                               partial(profile.worker_dd_blank_removal, args))
+        sample_blankless_data = run_profile.collect(plate, pool.map(sample_blank_args, sample_data))
+        if args['ipc_stats'] == True:
+            payload_report(sample_blank_args, sample_data, sample_blankless_data,
+                           default_chunksize(len(sample_data), args['cpu']))
+        with run_profile.stage(plate, 'mgf writing') as counts:
+            for spectrum, changed_spectrum_data in sample_blankless_data:
+                with dd.dataset_mgf_writer(dataset_output(args, spectrum[1]), args['background_writer'],
+                                           args['output_format']) as mgf_files:
+                    mgf_files.write(spectrum[0], 'processed')
+                    if changed_spectrum_data != None:
+                        mgf_files.write(changed_spectrum_data, 'removed_peaks')
+                run_manifest.complete(spectrum[1], 1, mgf_files.output_paths)
+            counts['spectra'] = len(sample_blankless_data)
 
 if __name__ == "__main__":
 
     arguments = get_args()
-    pool = Pool(processes=arguments['cpu'])
+    if arguments['queue'] != '':
+        arguments = queue_arguments(arguments)
+    if arguments['watch'] == True:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # worker pools ignore Ctrl+C; watch mode stops once the acquisitions being processed are done
+    start_run(arguments)
 
-    if arguments['instrument'] == 'lcq' or arguments['instrument'] == 'qtof':
+    if arguments['queue'] != '' and arguments['queue_worker'] == True:
+        run_queue_worker(arguments)
+    elif arguments['queue'] != '':
+        run_queue(arguments)
+    elif arguments['watch'] == True and (arguments['instrument'] == 'lcq' or arguments['instrument'] == 'qtof'):
+        run_lcms(arguments, watch_lcms(arguments))
+        # one run over an endless list of datasets; pools and control library kept for the whole session
+    elif arguments['watch'] == True and arguments['instrument'] == 'dd':
+        watch_maldi_dd(arguments)
+    elif arguments['instrument'] == 'lcq' or arguments['instrument'] == 'qtof':
         run_lcms(arguments)
     elif arguments['instrument'] == 'dd':
         run_maldi_dd(arguments)
-
-    pool.close()
-    pool.join()
+    finish_run()
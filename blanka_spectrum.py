@@ -0,0 +1,83 @@
+import pyteomics.mzxml as pytmzxml
+import blanka_kernels as kernels
+
+class Spectrum(object):
+    # compact spectrum; scan number, ms level, retention time (minutes), precursor m/z and intensity with native byte
+    # order m/z and intensity arrays; all other mzXML attributes are dropped when loaded
+    # supports the dict style access used for pyteomics spectra (spectrum['m/z array'],
+    # spectrum['precursorMz'][0]['precursorMz'], ...) so functions work on either
+
+    __slots__ = ['num', 'ms_level', 'retention_time', 'precursor_mz', 'precursor_intensity', 'mz_array',
+                 'intensity_array']
+
+    key_slots = {'num': 'num', 'msLevel': 'ms_level', 'retentionTime': 'retention_time', 'm/z array': 'mz_array',
+                 'intensity array': 'intensity_array'}
+    # pyteomics keys mapped to slots; 'precursorMz' handled separately
+
+    def __init__(self, num, ms_level, retention_time, precursor_mz, precursor_intensity, mz_array, intensity_array):
+        self.num = num
+        self.ms_level = ms_level
+        self.retention_time = retention_time
+        self.precursor_mz = precursor_mz
+        self.precursor_intensity = precursor_intensity
+        self.mz_array = mz_array
+        self.intensity_array = intensity_array
+
+    def __getitem__(self, key):
+        if key == 'precursorMz':
+            if self.precursor_mz == None:
+                raise KeyError(key)
+            return [{'precursorMz': self.precursor_mz, 'precursorIntensity': self.precursor_intensity}]
+        return getattr(self, self.key_slots[key])
+
+    def __setitem__(self, key, value):
+        if key == 'precursorMz':
+            self.precursor_mz = value[0]['precursorMz']
+            self.precursor_intensity = value[0].get('precursorIntensity')
+        else:
+            setattr(self, self.key_slots[key], value)
+
+    def __contains__(self, key):
+        if key == 'precursorMz':
+            return self.precursor_mz != None
+        return key in self.key_slots
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return [key for key in ['num', 'msLevel', 'retentionTime', 'precursorMz', 'm/z array', 'intensity array']
+                if key in self]
+
+    def copy(self):
+        # shallow copy; arrays shared until replaced (same as dict.copy())
+        return Spectrum(self.num, self.ms_level, self.retention_time, self.precursor_mz, self.precursor_intensity,
+                        self.mz_array, self.intensity_array)
+
+    def __getstate__(self):
+        return (self.num, self.ms_level, self.retention_time, self.precursor_mz, self.precursor_intensity,
+                self.mz_array, self.intensity_array)
+
+    def __setstate__(self, state):
+        (self.num, self.ms_level, self.retention_time, self.precursor_mz, self.precursor_intensity, self.mz_array,
+         self.intensity_array) = state
+
+def from_pyteomics(spectrum):
+    # Spectrum from a pyteomics.mzxml spectrum dict; arrays converted to native byte order once here
+    if 'precursorMz' in spectrum:
+        precursor_mz = spectrum['precursorMz'][0]['precursorMz']
+        precursor_intensity = spectrum['precursorMz'][0].get('precursorIntensity')
+    else:
+        precursor_mz = None
+        precursor_intensity = None
+    return Spectrum(spectrum['num'], int(spectrum['msLevel']), float(spectrum['retentionTime']), precursor_mz,
+                    precursor_intensity,
+                    kernels.native_array(spectrum['m/z array']), kernels.native_array(spectrum['intensity array']))
+
+def read_spectra(mzxml):
+    # read .mzXML file as Spectrum objects, one scan at a time using pyteomics (reference for blanka_mzxml)
+    with pytmzxml.read(mzxml) as mzxml_reader:
+        for spectrum in mzxml_reader:
+            yield from_pyteomics(spectrum)
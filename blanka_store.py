@@ -0,0 +1,48 @@
+import os, hashlib, numpy
+import blanka_binary
+import blanka_mgf
+import blanka_mzxml
+
+# --sample_store: sample .mzXML files converted once to memory mapped peak stores (same layout as BinaryWriter
+# containers) so pool workers are sent scan index ranges and read peaks from the mapping instead of receiving
+# pickled spectra
+
+def store_path(store_dir, mzxml):
+    # peak store of an .mzXML file in store_dir; path hash keeps files with the same name in different directories apart
+    path_hash = hashlib.sha1(os.path.abspath(mzxml).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(store_dir, os.path.splitext(os.path.basename(mzxml))[0] + '_' + path_hash + '_store')
+
+def build_store(mzxml, path):
+    # convert .mzXML to a peak store at path unless one newer than the .mzXML exists; returns number of spectra
+    # spectra read one at a time and appended so the dataset is never held in memory
+    metadata_path = os.path.join(path, 'metadata.npy')
+    if os.path.isfile(metadata_path) and os.path.getmtime(metadata_path) >= os.path.getmtime(mzxml):
+        return len(numpy.load(metadata_path, mmap_mode='r'))
+    container = None
+    count = 0
+    for spectrum in blanka_mzxml.read_spectra(mzxml):
+        if container == None:
+            container = blanka_binary.PeakContainer(path, '', 60, spectrum['m/z array'].dtype,
+                                                    spectrum['intensity array'].dtype)
+            # array dtypes of the first spectrum used for the whole store, same as BinaryWriter
+        container.write(spectrum)
+        count += 1
+    if container == None:
+        container = blanka_binary.PeakContainer(path, '', 60, numpy.float64, numpy.float64)
+    container.close()
+    blanka_mgf.replace_file(container.part_path, path)
+    return count
+
+def store_ranges(count, range_size):
+    # [start, stop] scan index ranges of up to range_size scans
+    return [[start, min(start + range_size, count)] for start in range(0, count, range_size)]
+
+def read_range(path, start, stop):
+    # flat m/z and intensity arrays, offsets (from 0) and metadata table of scans [start, stop) of a peak store
+    # arrays are views of the memory mapped store; nothing is copied until peaks are filtered
+    mz_array = numpy.load(os.path.join(path, 'mz.npy'), mmap_mode='r')
+    intensity_array = numpy.load(os.path.join(path, 'intensity.npy'), mmap_mode='r')
+    offsets = numpy.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+    metadata = numpy.load(os.path.join(path, 'metadata.npy'), mmap_mode='r')
+    return (mz_array[offsets[start]:offsets[stop]], intensity_array[offsets[start]:offsets[stop]],
+            numpy.array(offsets[start:stop + 1]) - offsets[start], metadata[start:stop])
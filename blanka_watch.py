@@ -0,0 +1,113 @@
+import os, time, signal
+
+def acquisition_detection(directory, instrument):
+    # .mzXML files and raw acquisitions in directory; lcq = Thermo .RAW files, qtof = Agilent .d directories,
+    # dd = Bruker Autoflex fid files
+    acquisitions = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        acquisitions += [os.path.join(dirpath, files) for files in filenames if files.endswith('.mzXML')]
+        if instrument == 'lcq':
+            acquisitions += [os.path.join(dirpath, files) for files in filenames if files.endswith('.RAW')]
+        elif instrument == 'qtof':
+            acquisitions += [os.path.join(dirpath, directory) for directory in dirnames if directory.endswith('.d')]
+            dirnames[:] = [directory for directory in dirnames if not directory.endswith('.d')]
+            # files inside raw data directories are part of the acquisition
+        elif instrument == 'dd':
+            acquisitions += [os.path.join(dirpath, files) for files in filenames if files == 'fid']
+    return acquisitions
+
+def acquisition_state(path):
+    # total size and newest modification time of a file or raw data directory
+    if os.path.isdir(path):
+        file_stats = [os.stat(os.path.join(dirpath, files)) for dirpath, dirnames, filenames in os.walk(path)
+                      for files in filenames]
+        return [sum([file_stat.st_size for file_stat in file_stats]),
+                max([file_stat.st_mtime for file_stat in file_stats] + [os.path.getmtime(path)])]
+    file_stat = os.stat(path)
+    return [file_stat.st_size, file_stat.st_mtime]
+
+def mzxml_complete(mzxml):
+    # .mzXML written to the end (closing </mzXML> tag)
+    with open(mzxml, 'rb') as mzxml_file:
+        mzxml_file.seek(0, 2)
+        mzxml_file.seek(max(0, mzxml_file.tell() - 1024))
+        return b'</mzXML>' in mzxml_file.read()
+
+class FolderWatcher(object):
+    # polls directory for new acquisitions (acquisition_detection)
+    # an acquisition is complete once its size and modification time are unchanged since the previous poll and it has
+    # not been modified for settle_time seconds (.mzXML files must also end with </mzXML>); each is returned once
+
+    def __init__(self, directory, instrument, interval=2, settle_time=5):
+        self.directory = directory
+        self.instrument = instrument
+        self.interval = interval
+        self.settle_time = settle_time
+        self.seen = set()
+        self.states = {}
+        self.stop = False
+        self.waiting = False
+
+    def ignore(self, path):
+        # never return path (ex: control file, .mzXML converted from a returned raw acquisition)
+        # returns False if path was already returned or ignored
+        key = os.path.abspath(path)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def poll(self):
+        # acquisitions completed since the last poll
+        complete = []
+        now = time.time()
+        for path in acquisition_detection(self.directory, self.instrument):
+            key = os.path.abspath(path)
+            if key in self.seen:
+                continue
+            try:
+                state = acquisition_state(path)
+                if self.states.get(key) == state and now - state[1] >= self.settle_time and \
+                        (not path.endswith('.mzXML') or mzxml_complete(path)):
+                    complete.append(path)
+                    self.seen.add(key)
+                    del self.states[key]
+                else:
+                    self.states[key] = state
+            except (IOError, OSError):
+                # removed or still being created
+                continue
+        return complete
+
+    def interrupt(self, signum, frame):
+        # Ctrl+C: stop now if waiting for acquisitions, otherwise once the batch being processed is done
+        self.stop = True
+        if self.waiting == True:
+            raise KeyboardInterrupt
+
+    def batches(self, idle_timeout=0):
+        # lists of newly completed acquisitions as they arrive, until idle_timeout seconds pass without any
+        # (0 = until Ctrl+C); a batch being processed is always completed
+        # worker pools created before should ignore SIGINT so Ctrl+C does not interrupt workers
+        previous_handler = signal.signal(signal.SIGINT, self.interrupt)
+        last_batch = time.time()
+        try:
+            while self.stop == False:
+                complete = []
+                self.waiting = True
+                try:
+                    complete = self.poll()
+                    if complete == [] and idle_timeout > 0 and time.time() - last_batch >= idle_timeout:
+                        return
+                    if complete == []:
+                        time.sleep(self.interval)
+                except KeyboardInterrupt:
+                    pass
+                self.waiting = False
+                if complete != [] and self.stop == False:
+                    yield complete
+                    last_batch = time.time()
+                    # timed from when the batch has been processed
+            print "Stopped watching " + self.directory
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
@@ -0,0 +1,47 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_binary
+import blanka_benchmark
+
+# binary containers written in pieces and concatenated are the same as one container written in one go
+
+class ContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        self.spectra = blanka_benchmark.synthetic_spectra(50, 20, 0.5, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_container(self, name, spectra):
+        with blanka_binary.BinaryWriter(os.path.join(self.work_dir, name + '_blanka_')) as binary_files:
+            binary_files.title = 'sample'
+            for spectrum in spectra:
+                binary_files.write(spectrum, 'processed')
+        return os.path.join(self.work_dir, name + '_blanka_processed_data')
+
+    def container_data(self, path):
+        data = {}
+        for name in ('mz.npy', 'intensity.npy', 'offsets.npy', 'metadata.npy', 'info.json'):
+            with open(os.path.join(path, name), 'rb') as data_file:
+                data[name] = data_file.read()
+        return data
+
+    def test_concatenate_containers(self):
+        whole = self.write_container('whole', self.spectra)
+        pieces = [self.write_container('piece' + str(count), self.spectra[start:stop])
+                  for count, (start, stop) in enumerate([(0, 20), (20, 21), (21, 50)])]
+        blanka_binary.concatenate_containers(pieces, os.path.join(self.work_dir, 'merged_blanka_processed_data'))
+        self.assertEqual(self.container_data(whole),
+                         self.container_data(os.path.join(self.work_dir, 'merged_blanka_processed_data')))
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'merged_blanka_processed_data.part')))
+
+    def test_container_detection(self):
+        container = self.write_container('sample', self.spectra)
+        shutil.copytree(container, os.path.join(self.work_dir, 'partial_blanka_processed_data.part'))
+        # container still being written
+        self.assertEqual(blanka_binary.container_detection(self.work_dir), [container])
+
+if __name__ == '__main__':
+    unittest.main()
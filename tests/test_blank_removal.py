@@ -0,0 +1,80 @@
+import os, sys, unittest, numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_lcms as lcms
+import blanka_maldi_dd as dd
+
+# array blank_removal gives the same processed and removed peaks as the deprecated merge_asof old_blank_removal
+# m/z values on a 1/64 grid with peak_mz_tolerance = 4/64 so exact tolerance ties are common
+
+peak_mz_tolerance = 0.0625
+
+def random_spectrum(random_state, dtype, zero_fraction):
+    # spectrum dict with sorted unique m/z values on a 1/64 grid in dtype with random byte order; zero_fraction of
+    # intensities set to 0
+    dtype = numpy.dtype(dtype).newbyteorder(random_state.choice(['<', '>']))
+    mz_array = numpy.unique(random_state.randint(100 * 64, 110 * 64, random_state.randint(0, 60))) / 64.0
+    intensity_array = random_state.uniform(1, 1000, len(mz_array))
+    intensity_array[random_state.rand(len(mz_array)) < zero_fraction] = 0
+    return {'num': '1', 'msLevel': 1, 'retentionTime': 1.0, 'm/z array': mz_array.astype(dtype),
+            'intensity array': intensity_array.astype(dtype)}
+
+def copy_spectrum(spectrum):
+    copied = spectrum.copy()
+    copied['m/z array'] = spectrum['m/z array'].copy()
+    copied['intensity array'] = spectrum['intensity array'].copy()
+    return copied
+
+class BlankRemovalTest(unittest.TestCase):
+
+    def assertSameRemoval(self, result, old_result):
+        # [processed spectrum, removed peaks spectrum or None] compared by value
+        for key in ('m/z array', 'intensity array'):
+            numpy.testing.assert_array_equal(result[0][key], old_result[0][key])
+        self.assertEqual(result[1] == None, old_result[1] == None)
+        if result[1] != None:
+            for key in ('m/z array', 'intensity array'):
+                numpy.testing.assert_array_equal(result[1][key], old_result[1][key])
+
+    def test_lcms(self):
+        random_state = numpy.random.RandomState(0)
+        for count in range(500):
+            dtype = random_state.choice([numpy.float32, numpy.float64])
+            sample_spectrum = random_spectrum(random_state, dtype, 0)
+            control_spectrum = random_spectrum(random_state, dtype, 0.3)
+            # zero intensity control peaks never match and keep sample peaks they are nearest to (fillna(0))
+            self.assertSameRemoval(lcms.blank_removal(copy_spectrum(sample_spectrum), control_spectrum,
+                                                      peak_mz_tolerance),
+                                   lcms.old_blank_removal(copy_spectrum(sample_spectrum), control_spectrum,
+                                                          peak_mz_tolerance))
+
+    def dd_removal(self, sample_spectrum, control_spectra):
+        control_data = [[control_spectrum, 'control.mzXML'] for control_spectrum in control_spectra]
+        return (dd.blank_removal(peak_mz_tolerance, dd.consensus_control_spectrum(control_data, peak_mz_tolerance),
+                                 [copy_spectrum(sample_spectrum), 'sample.mzXML']),
+                dd.old_blank_removal(peak_mz_tolerance, dd.old_combine_control_spectra(control_data),
+                                     [copy_spectrum(sample_spectrum), 'sample.mzXML']))
+
+    def test_dd(self):
+        random_state = numpy.random.RandomState(1)
+        for count in range(500):
+            dtype = random_state.choice([numpy.float32, numpy.float64])
+            sample_spectrum = random_spectrum(random_state, dtype, 0)
+            control_spectra = [random_spectrum(random_state, dtype, 0) for spot in range(random_state.randint(1, 4))]
+            result, old_result = self.dd_removal(sample_spectrum, control_spectra)
+            self.assertSameRemoval([result[0][0], result[1]], [old_result[0][0], old_result[1]])
+
+    def test_dd_zero_intensity_control(self):
+        # zero intensity control peaks are dropped from the consensus spectrum, so a sample peak is removed if any
+        # control peak with intensity is within tolerance; old_blank_removal kept it if its nearest control peak
+        # had zero intensity
+        sample_spectrum = {'m/z array': numpy.array([100.0, 200.0], dtype=numpy.float32),
+                           'intensity array': numpy.array([10.0, 10.0], dtype=numpy.float32)}
+        control_spectrum = {'m/z array': numpy.array([100.0, 100.0625, 200.0], dtype=numpy.float32),
+                            'intensity array': numpy.array([0.0, 10.0, 0.0], dtype=numpy.float32)}
+        result, old_result = self.dd_removal(sample_spectrum, [control_spectrum])
+        numpy.testing.assert_array_equal(result[1]['m/z array'], [100.0])
+        numpy.testing.assert_array_equal(old_result[1]['m/z array'], [])
+        numpy.testing.assert_array_equal(result[0][0]['m/z array'], old_result[0][0]['m/z array'][1:])
+
+if __name__ == '__main__':
+    unittest.main()
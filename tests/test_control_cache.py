@@ -0,0 +1,55 @@
+import os, sys, shutil, tempfile, unittest, cPickle, numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_cache as cache
+import blanka_lcms as lcms
+import blanka_benchmark
+
+# control index loaded from a saved control library selects the same control spectra as the index it was saved from
+
+class ControlCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def saved_index(self, spectra):
+        control_index = lcms.build_control_index(spectra)
+        library_path = os.path.join(self.work_dir, 'library')
+        cache.save_control_library(library_path, spectra, control_index)
+        return control_index, cache.load_control_index(library_path)
+
+    def test_select_control_spectrum(self):
+        spectra = blanka_benchmark.synthetic_spectra(300, 20, 0.5, 0)
+        control_index, loaded_index = self.saved_index(spectra)
+        loaded_index = cPickle.loads(cPickle.dumps(loaded_index, cPickle.HIGHEST_PROTOCOL))
+        # as sent to pool workers
+        args = {'retention_time_tolerance': 0.3, 'precursor_mz_tolerance': 0.5}
+        random_state = numpy.random.RandomState(0)
+        matched = 0
+        for count in range(300):
+            ms_mode = random_state.randint(1, 3)
+            query = (ms_mode, random_state.uniform(0, 200), random_state.uniform(199, 221) if ms_mode == 2 else None)
+            selected = lcms.select_control_spectrum(args, query[0], query[1], query[2], control_index)
+            loaded = lcms.select_control_spectrum(args, query[0], query[1], query[2], loaded_index)
+            self.assertEqual(selected == None, loaded == None)
+            if selected != None:
+                matched += 1
+                self.assertEqual((selected['num'], selected['msLevel'], selected['retentionTime'],
+                                  selected.get('precursorMz')), (loaded['num'], loaded['msLevel'],
+                                                                 loaded['retentionTime'], loaded.get('precursorMz')))
+                numpy.testing.assert_array_equal(selected['m/z array'], loaded['m/z array'])
+                numpy.testing.assert_array_equal(selected['intensity array'], loaded['intensity array'])
+        self.assertGreater(matched, 50)
+
+    def test_single_ms_level(self):
+        # no ms2 control spectra; empty ms2 index arrays saved and loaded
+        control_index, loaded_index = self.saved_index(blanka_benchmark.synthetic_spectra(20, 20, 0, 0))
+        self.assertEqual(len(loaded_index[2]['spectra']), 0)
+        self.assertEqual(lcms.select_control_spectrum({'retention_time_tolerance': 0.3,
+                                                       'precursor_mz_tolerance': 0.5}, 2, 6, 210, loaded_index), None)
+        self.assertEqual(loaded_index[1]['spectra'][3]['num'], control_index[1]['spectra'][3]['num'])
+
+if __name__ == '__main__':
+    unittest.main()
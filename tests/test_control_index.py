@@ -0,0 +1,68 @@
+import os, sys, unittest, numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_lcms as lcms
+
+# indexed control selection picks the same control spectrum as the linear scan in old_select_control_spectrum
+
+def grid_spectra(count, random_state):
+    # retention times and precursor m/z values drawn from coarse grids so ties and exact tolerance edges are common
+    spectra = []
+    for num in range(count):
+        spectrum = {'num': str(num + 1),
+                    'msLevel': random_state.randint(1, 3),
+                    'retentionTime': random_state.randint(0, 40) * 0.25}
+        if spectrum['msLevel'] == 2:
+            spectrum['precursorMz'] = [{'precursorMz': 200 + random_state.randint(0, 20) * 0.25}]
+        spectra.append(spectrum)
+    return spectra
+
+class ControlIndexTest(unittest.TestCase):
+
+    def compare(self, args, spectra, queries):
+        control_index = lcms.build_control_index(spectra)
+        matched = 0
+        for ms_mode, ret_time, precursor_mz in queries:
+            selected = lcms.select_control_spectrum(args, ms_mode, ret_time, precursor_mz, control_index)
+            expected = lcms.old_select_control_spectrum(args, ms_mode, ret_time, precursor_mz, spectra)
+            self.assertTrue(selected is expected, (ms_mode, ret_time, precursor_mz))
+            if expected != None:
+                matched += 1
+        return matched
+
+    def test_random_controls(self):
+        random_state = numpy.random.RandomState(0)
+        args = {'retention_time_tolerance': 30, 'precursor_mz_tolerance': 0.5}
+        for count in (1, 5, 50, 400):
+            spectra = grid_spectra(count, random_state)
+            queries = []
+            for query in range(300):
+                ms_mode = random_state.randint(1, 3)
+                # half the queries sit on the grid, half fall between grid points
+                if query % 2 == 0:
+                    ret_time = random_state.randint(-4, 164) * 7.5
+                    precursor_mz = 199 + random_state.randint(0, 32) * 0.125
+                else:
+                    ret_time = random_state.uniform(-30, 630)
+                    precursor_mz = random_state.uniform(199, 206)
+                queries.append((ms_mode, ret_time, precursor_mz if ms_mode == 2 else None))
+            matched = self.compare(args, spectra, queries)
+            if count >= 50:
+                self.assertTrue(matched > 0)
+
+    def test_identical_controls(self):
+        # every control spectrum ties on both retention time and precursor m/z
+        spectra = [{'num': str(num + 1), 'msLevel': 2, 'retentionTime': 2.0, 'precursorMz': [{'precursorMz': 300.0}]}
+                   for num in range(30)]
+        args = {'retention_time_tolerance': 30, 'precursor_mz_tolerance': 0.5}
+        queries = [(2, 120.0, 300.0), (2, 150.0, 300.5), (2, 90.0, 299.5), (2, 150.1, 300.0), (1, 120.0, None)]
+        self.assertEqual(self.compare(args, spectra, queries), 3)
+
+    def test_single_level(self):
+        random_state = numpy.random.RandomState(1)
+        spectra = [i for i in grid_spectra(100, random_state) if i['msLevel'] == 1]
+        args = {'retention_time_tolerance': 15, 'precursor_mz_tolerance': 0.5}
+        queries = [(ms_mode, random_state.randint(0, 80) * 7.5, 201.0) for ms_mode in (1, 2) for count in range(50)]
+        self.compare(args, spectra, queries)
+
+if __name__ == '__main__':
+    unittest.main()
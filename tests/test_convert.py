@@ -0,0 +1,89 @@
+import os, sys, shutil, stat, tempfile, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_convert as convert
+import blanka_lcms as lcms
+import blanka_run
+
+# lcq raw data conversion with a stub in place of MSConvert: duplicate jobs converted once, up to date .mzXML files
+# skipped by modification time and conversion times recorded for the conversions that ran
+
+stub_converter = '''import os, sys
+# stub MSConvert: raw_path -o output_dir [msconvert settings]; logs raw_path and writes an .mzXML file
+raw_path, output_dir = sys.argv[1], sys.argv[3]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversions.log'), 'a') as log_file:
+    log_file.write(raw_path + '\\n')
+if 'broken' in raw_path:
+    sys.exit(1)
+with open(os.path.join(output_dir, os.path.splitext(os.path.basename(raw_path))[0] + '.mzXML'), 'w') as mzxml:
+    mzxml.write('<mzXML></mzXML>')
+'''
+
+class ConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        self.raw_dir = os.path.join(self.work_dir, 'raw')
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.makedirs(os.path.join(self.raw_dir, 'run_2'))
+        # lcq raw data detection pairs every .RAW file with every directory, so each file gets two jobs
+        self.raw_files = [os.path.join(self.raw_dir, 'sample_1.RAW'), os.path.join(self.raw_dir, 'sample_2.RAW')]
+        for raw_file in self.raw_files:
+            with open(raw_file, 'w') as raw:
+                raw.write('raw data')
+            os.utime(raw_file, (time.time() - 100, time.time() - 100))
+        self.converter = os.path.join(self.work_dir, 'msconvert')
+        with open(self.converter, 'w') as converter:
+            converter.write('#!' + sys.executable + '\n' + stub_converter)
+        os.chmod(self.converter, os.stat(self.converter).st_mode | stat.S_IEXEC)
+        convert.msconvert_paths['config.ini'] = self.converter
+        convert.conversion_times.clear()
+
+    def tearDown(self):
+        convert.msconvert_paths.clear()
+        convert.conversion_times.clear()
+        shutil.rmtree(self.work_dir)
+
+    def conversions(self):
+        # raw files passed to the stub converter since the last call
+        log_path = os.path.join(self.work_dir, 'conversions.log')
+        if not os.path.isfile(log_path):
+            return []
+        with open(log_path, 'r') as log_file:
+            converted = sorted(log_file.read().split())
+        os.remove(log_path)
+        return converted
+
+    def convert(self):
+        args = blanka_run.get_args(['--instrument', 'lcq', '--output', self.output_dir, '--max_conversions', '2'])
+        return sorted(lcms.msconvert(args, lcms.raw_data_detection(args, self.raw_dir)))
+
+    def test_skip_by_mtime(self):
+        mzxml_files = [os.path.join(self.output_dir, 'sample_1.mzXML'), os.path.join(self.output_dir, 'sample_2.mzXML')]
+        self.assertEqual(self.convert(), mzxml_files)
+        self.assertEqual(self.conversions(), self.raw_files)
+        self.assertEqual(sorted(convert.conversion_times.keys()), mzxml_files)
+
+        # up to date: nothing converted, files still returned
+        convert.conversion_times.clear()
+        self.assertEqual(self.convert(), mzxml_files)
+        self.assertEqual(self.conversions(), [])
+        self.assertEqual(convert.conversion_times, {})
+
+        # raw data newer than its .mzXML file or an empty .mzXML file: converted again
+        os.utime(self.raw_files[0], (time.time() + 100, time.time() + 100))
+        open(mzxml_files[1], 'w').close()
+        self.assertEqual(self.convert(), mzxml_files)
+        self.assertEqual(self.conversions(), self.raw_files)
+        self.assertEqual(sorted(convert.conversion_times.keys()), mzxml_files)
+
+    def test_failed_conversion(self):
+        broken_file = os.path.join(self.raw_dir, 'broken.RAW')
+        with open(broken_file, 'w') as raw:
+            raw.write('raw data')
+        self.assertEqual(self.convert(), [os.path.join(self.output_dir, 'sample_1.mzXML'),
+                                          os.path.join(self.output_dir, 'sample_2.mzXML')])
+        self.assertEqual(self.conversions(), sorted([broken_file] + self.raw_files))
+        self.assertTrue(os.path.join(self.output_dir, 'broken.mzXML') in convert.conversion_times)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os, sys, shutil, stat, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_maldi_dd as dd
+import blanka_convert as convert
+import blanka_run
+
+# raw spots of two plates converted and grouped as two plates, each with its own control spots
+
+class RawPlatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        self.sample_dir = os.path.join(self.work_dir, 'plates')
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        for plate in ('plate_1', 'plate_2'):
+            for spot in ('0_A1', '0_A2', '0_B1'):
+                os.makedirs(os.path.join(self.sample_dir, plate, spot, '1', '1SLin'))
+                with open(os.path.join(self.sample_dir, plate, spot, '1', '1SLin', 'fid'), 'w') as fid_file:
+                    fid_file.write('fid')
+        self.msconvert_path = os.path.join(self.work_dir, 'msconvert')
+        with open(self.msconvert_path, 'w') as msconvert_file:
+            msconvert_file.write('#!/bin/sh\necho "$1" > "$3/$5.mzXML"\n')
+            # msconvert <raw> -o <output directory> --outfile <name> ...; writes the raw path as the .mzXML file
+        os.chmod(self.msconvert_path, os.stat(self.msconvert_path).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @unittest.skipIf(os.name == 'nt', 'shell script used as msconvert')
+    def test_two_plates(self):
+        args = {'sample': self.sample_dir, 'output': self.output_dir, 'control': 'media'}
+        raw_file_list = sorted(dd.raw_data_detection(args))
+        raw_file_list = [(path, ('media' if '0_B1' in path else 'sample') + '_' + path.split(os.sep)[-4])
+                         for path in raw_file_list]
+        # template style names; the same names used on both plates
+        converted_list = list(convert.convert(dd.msconvert_jobs(args, raw_file_list), 2, self.msconvert_path))
+        self.assertEqual(len(converted_list), 6)
+        for mzxml in converted_list:
+            with open(mzxml, 'r') as mzxml_file:
+                raw_plate = mzxml_file.read().split(os.sep)[-5]
+            self.assertEqual(dd.spot_plate(mzxml), os.path.join(self.output_dir, raw_plate))
+        control_list = dd.control_file_detection(args)
+        plates = dd.group_plates(sorted([mzxml for mzxml in converted_list if mzxml not in control_list]),
+                                 control_list)
+        self.assertEqual([(plate, [os.path.basename(mzxml) for mzxml in plate_control_list],
+                           [os.path.basename(mzxml) for mzxml in plate_file_list])
+                          for plate, plate_control_list, plate_file_list in plates],
+                         [(os.path.join(self.output_dir, plate), ['media_0_B1.mzXML'],
+                           ['sample_0_A1.mzXML', 'sample_0_A2.mzXML']) for plate in ('plate_1', 'plate_2')])
+
+    def test_control_pool(self):
+        # main pool replaced only when a batch brings a plate control its workers do not have (ex: watch mode)
+        args = blanka_run.get_args(['--sample', self.sample_dir, '--control', 'media', '--instrument', 'dd',
+                                    '--cpu', '2'])
+        blanka_run.start_run(args)
+        try:
+            plate_1 = os.path.join(self.output_dir, 'plate_1')
+            plate_2 = os.path.join(self.output_dir, 'plate_2')
+            plate_1_control = {'m/z array': [100.0]}
+            worker_pool = blanka_run.dd_control_pool(args, {plate_1: plate_1_control})
+            self.assertIs(blanka_run.dd_control_pool(args, {plate_1: plate_1_control}), worker_pool)
+            plate_2_control = {'m/z array': [200.0]}
+            worker_pool = blanka_run.dd_control_pool(args, {plate_2: plate_2_control})
+            self.assertIs(blanka_run.dd_control_pool(args, {plate_1: plate_1_control, plate_2: plate_2_control}),
+                          worker_pool)
+            self.assertEqual(sorted(blanka_run.pool_plate_controls.keys()), [plate_1, plate_2])
+            self.assertEqual(worker_pool.apply(dd.worker_plate_control, (os.path.join(plate_2, 'A1.mzXML'),)),
+                             plate_2_control)
+        finally:
+            blanka_run.finish_run()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os, sys, shutil, tempfile, unittest, numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_mzxml
+import blanka_benchmark
+
+# .mzXML files cut short are rejected instead of read as a shorter run
+
+class TruncatedMzxmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        self.mzxml = os.path.join(self.work_dir, 'sample.mzXML')
+        blanka_benchmark.write_mzxml(self.mzxml, blanka_benchmark.synthetic_spectra(20, 50, 0.5, 0))
+        with open(self.mzxml, 'rb') as mzxml_file:
+            self.mzxml_data = mzxml_file.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_truncated(self, size):
+        truncated = os.path.join(self.work_dir, 'truncated.mzXML')
+        with open(truncated, 'wb') as mzxml_file:
+            mzxml_file.write(self.mzxml_data[:size])
+        return truncated
+
+    def test_complete(self):
+        spectra = list(blanka_mzxml.read_spectra(self.mzxml))
+        self.assertEqual(len(spectra), 20)
+        self.assertEqual(len(blanka_mzxml.read_first_spectrum(self.mzxml)['m/z array']),
+                         len(spectra[0]['m/z array']))
+
+    def test_truncated_in_peaks(self):
+        # file ends inside the <peaks> element of the last scan
+        truncated = self.write_truncated(self.mzxml_data.rfind(b'</peaks>') - 10)
+        self.assertRaises(ValueError, list, blanka_mzxml.read_spectra(truncated))
+
+    def test_truncated_in_scan(self):
+        # file ends inside the last scan tag
+        truncated = self.write_truncated(self.mzxml_data.rfind(b'<scan') + 20)
+        self.assertRaises(ValueError, list, blanka_mzxml.read_spectra(truncated))
+
+    def test_truncated_after_scan(self):
+        # every scan complete but no </msRun>
+        truncated = self.write_truncated(self.mzxml_data.rfind(b'</msRun>'))
+        self.assertRaises(ValueError, list, blanka_mzxml.read_spectra(truncated))
+
+    def test_corrupt_scan(self):
+        # scan read directly (ex: from a scan index offset) with no complete <peaks> element
+        scan_data = self.mzxml_data[self.mzxml_data.find(b'<scan'):self.mzxml_data.find(b'<peaks')]
+        self.assertRaises(ValueError, blanka_mzxml.parse_scan, scan_data)
+
+if __name__ == '__main__':
+    unittest.main()
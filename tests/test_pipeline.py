@@ -0,0 +1,61 @@
+import os, sys, unittest, cPickle, numpy
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_pipeline
+import blanka_benchmark
+
+# a process pool gets the same results as serial processing while receiving only a handle for the control library
+
+def result_arrays(results):
+    return [[None if spectrum == None else (spectrum['num'], spectrum['m/z array'].tolist(),
+                                            spectrum['intensity array'].tolist())
+             for spectrum in result[:2]] + [None if result[2] == None else len(result[2]['m/z array'])]
+            for result in results]
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control = blanka_benchmark.synthetic_spectra(300, 40, 0.5, 0)
+        shared_mz = numpy.concatenate([spectrum['m/z array'] for spectrum in self.control])
+        self.spectra = blanka_benchmark.synthetic_spectra(300, 40, 0.5, 1, shared_mz)
+
+    def process(self, executor):
+        pipeline = blanka_pipeline.Pipeline('lcq', control=self.control, executor=executor, block_size=50, cpu=2,
+                                            peak_mz_tolerance=0.02)
+        try:
+            return result_arrays(pipeline.process(self.spectra))
+        finally:
+            pipeline.close()
+
+    def test_executors(self):
+        serial = self.process(None)
+        pool = Pool(2)
+        try:
+            process_pool = self.process(pool)
+        finally:
+            pool.close()
+            pool.join()
+        thread_pool = ThreadPool(2)
+        try:
+            threads = self.process(thread_pool)
+        finally:
+            thread_pool.close()
+        self.assertEqual(process_pool, serial)
+        self.assertEqual(threads, serial)
+        self.assertTrue(any(result[2] != None for result in serial))
+
+    def test_task_size(self):
+        pipeline = blanka_pipeline.Pipeline('lcq', control=self.control, peak_mz_tolerance=0.02)
+        try:
+            task = partial(blanka_pipeline.lcms_block, pipeline.args, pipeline.control)
+            self.assertTrue(len(cPickle.dumps(task, cPickle.HIGHEST_PROTOCOL)) < 4096)
+            library_path = pipeline.control.library_path
+            self.assertTrue(os.path.isdir(library_path))
+        finally:
+            pipeline.close()
+        self.assertFalse(os.path.exists(library_path))
+
+if __name__ == '__main__':
+    unittest.main()
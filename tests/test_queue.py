@@ -0,0 +1,107 @@
+import os, sys, shutil, tempfile, threading, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_queue
+
+# two local workers sharing a queue file: claims, heartbeats, lease expiry and take over, retries and the summary
+# workers run in threads of this process with a stub in place of run_lcms_dataset
+
+def run_worker(queue_path, name, process, processed, lease_seconds=60, max_attempts=3):
+    # same loop as blanka_run.run_queue_worker
+    worker = blanka_queue.QueueWorker(queue_path, lease_seconds, max_attempts, poll_interval=0.05)
+    worker.name = name
+    for dataset in worker.datasets():
+        processed.append([name, dataset])
+        try:
+            process(dataset)
+        except Exception as error:
+            worker.failed(repr(error))
+    worker.stop()
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        self.queue_path = os.path.join(self.work_dir, 'queue.sqlite')
+        self.work_queue = blanka_queue.WorkQueue(self.queue_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_workers(self, process, names=('worker 1', 'worker 2'), **worker_args):
+        processed = []
+        threads = [threading.Thread(target=run_worker, args=(self.queue_path, name, process, processed),
+                                    kwargs=worker_args) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+        return processed
+
+    def tasks(self):
+        return {task['dataset']: task for task in self.work_queue.tasks()}
+
+    def test_claim(self):
+        datasets = ['sample_' + str(count) for count in range(8)]
+        self.work_queue.add(datasets)
+        self.work_queue.add(datasets[:2])
+        # queued again (ex: coordinator restarted); kept as they are
+        processed = self.run_workers(lambda dataset: time.sleep(0.05))
+        self.assertEqual(sorted(dataset for name, dataset in processed), datasets)
+        self.assertEqual(set(name for name, dataset in processed), set(['worker 1', 'worker 2']))
+        tasks = self.tasks()
+        self.assertEqual([tasks[dataset]['state'] for dataset in datasets], ['done'] * 8)
+        self.assertEqual([tasks[dataset]['attempts'] for dataset in datasets], [1] * 8)
+        summary = self.work_queue.summary()
+        self.assertEqual(summary['states'], {'done': 8})
+        self.assertEqual(sum(worker['datasets'] for worker in summary['workers'].values()), 8)
+        self.assertEqual(summary['failed'], [])
+        self.assertEqual(self.work_queue.unfinished(), 0)
+
+    def test_lease_expiry(self):
+        self.work_queue.add(['sample_1', 'sample_2'])
+        self.assertEqual(self.work_queue.claim('stopped worker', 0.3, 3), 'sample_1')
+        # claimed by a worker that stops without finishing; taken over once its lease expires
+        processed = self.run_workers(lambda dataset: None, lease_seconds=0.3)
+        self.assertEqual(sorted(dataset for name, dataset in processed), ['sample_1', 'sample_2'])
+        self.work_queue.complete('stopped worker', 'sample_1', 1)
+        # late result of the stopped worker ignored
+        tasks = self.tasks()
+        self.assertEqual(tasks['sample_1']['state'], 'done')
+        self.assertTrue(tasks['sample_1']['worker'] in ['worker 1', 'worker 2'])
+        self.assertEqual(tasks['sample_1']['attempts'], 2)
+        self.assertEqual(tasks['sample_2']['attempts'], 1)
+
+    def test_lease_expiry_max_attempts(self):
+        self.work_queue.add(['sample_1'])
+        self.assertEqual(self.work_queue.claim('stopped worker', 0.2, 1), 'sample_1')
+        self.run_workers(lambda dataset: None, lease_seconds=0.2, max_attempts=1)
+        self.assertEqual(self.work_queue.summary()['failed'], [['sample_1', 'lease expired']])
+
+    def test_heartbeat(self):
+        # datasets that take several leases to process are kept by their worker through heartbeats
+        self.work_queue.add(['sample_1', 'sample_2'])
+        processed = self.run_workers(lambda dataset: time.sleep(1.5), lease_seconds=0.6)
+        self.assertEqual(sorted(dataset for name, dataset in processed), ['sample_1', 'sample_2'])
+        self.assertEqual([task['attempts'] for task in self.work_queue.tasks()], [1, 1])
+        self.assertEqual(self.work_queue.summary()['states'], {'done': 2})
+
+    def test_fail_retry(self):
+        self.work_queue.add(['sample_1', 'bad_sample', 'flaky_sample'])
+        attempts = {}
+        def process(dataset):
+            attempts[dataset] = attempts.get(dataset, 0) + 1
+            if dataset == 'bad_sample' or (dataset == 'flaky_sample' and attempts[dataset] == 1):
+                raise ValueError('cannot read dataset')
+        self.run_workers(process, max_attempts=3)
+        self.assertEqual(attempts, {'sample_1': 1, 'bad_sample': 3, 'flaky_sample': 2})
+        tasks = self.tasks()
+        self.assertEqual(tasks['flaky_sample']['state'], 'done')
+        self.assertEqual(tasks['flaky_sample']['error'], None)
+        summary = self.work_queue.summary()
+        self.assertEqual(summary['states'], {'done': 2, 'failed': 1})
+        self.assertEqual(summary['failed'], [['bad_sample', repr(ValueError('cannot read dataset'))]])
+        self.assertEqual(sum(worker['datasets'] for worker in summary['workers'].values()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
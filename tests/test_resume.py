@@ -0,0 +1,97 @@
+import os, sys, shutil, tempfile, unittest, numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_run
+import blanka_mzxml
+import blanka_benchmark
+
+# interrupted --streaming --manifest run resumed from its last checkpoint gives the same output as a clean run
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+        control_spectra = blanka_benchmark.synthetic_spectra(200, 100, 0.5, 1)
+        shared_mz = numpy.unique(numpy.concatenate([spectrum['m/z array'] for spectrum in control_spectra[:50]]))
+        sample_spectra = blanka_benchmark.synthetic_spectra(200, 100, 0.5, 0, shared_mz)
+        for spectrum in sample_spectra[100:]:
+            spectrum['retentionTime'] = spectrum['retentionTime'] + 100
+        # no control scans near spectra after 100, so removed_peaks output gets nothing after a checkpoint there
+        blanka_benchmark.write_mzxml(os.path.join(self.work_dir, 'control.mzXML'), control_spectra)
+        for run in ('clean', 'resumed'):
+            os.makedirs(os.path.join(self.work_dir, run))
+            blanka_benchmark.write_mzxml(os.path.join(self.work_dir, run, 'sample.mzXML'), sample_spectra)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_lcms(self, run, output_format, crash_at=None):
+        # streaming run of the run directory; raises RuntimeError after reading crash_at sample spectra
+        args = blanka_run.get_args(['--sample', os.path.join(self.work_dir, run), '--control',
+                                    os.path.join(self.work_dir, 'control.mzXML'), '--instrument', 'lcq', '--cpu', '2',
+                                    '--streaming', 'True', '--max_in_flight', '20', '--checkpoint_interval', '50',
+                                    '--manifest', os.path.join(self.work_dir, run + '_manifest.json'),
+                                    '--output_format', output_format])
+        read_spectra = blanka_mzxml.read_spectra
+        def crashing_read_spectra(mzxml):
+            for count, spectrum in enumerate(read_spectra(mzxml)):
+                if count == crash_at and mzxml.endswith('sample.mzXML'):
+                    raise RuntimeError('interrupted')
+                yield spectrum
+        blanka_mzxml.read_spectra = crashing_read_spectra
+        blanka_run.start_run(args)
+        try:
+            blanka_run.run_lcms(args)
+        finally:
+            blanka_mzxml.read_spectra = read_spectra
+            blanka_run.finish_run()
+
+    def output_files(self, run):
+        return sorted([os.path.relpath(os.path.join(dirpath, filename), os.path.join(self.work_dir, run))
+                       for dirpath, dirnames, filenames in os.walk(os.path.join(self.work_dir, run))
+                       for filename in filenames if not filename.endswith('.mzXML')])
+
+    def output_data(self, run, output_file):
+        # file contents with the run directory (part of spectrum titles) removed
+        with open(os.path.join(self.work_dir, run, output_file), 'rb') as data_file:
+            return data_file.read().replace(os.path.join(self.work_dir, run), '')
+
+    def resumed_run(self, output_format):
+        # clean run, run interrupted after the checkpoint at spectrum 100 and resumed run; same output files
+        self.run_lcms('clean', output_format)
+        self.assertRaises(RuntimeError, self.run_lcms, 'resumed', output_format, 120)
+        self.run_lcms('resumed', output_format)
+        self.assertEqual(self.output_files('clean'), self.output_files('resumed'))
+        for output_file in self.output_files('clean'):
+            self.assertEqual(self.output_data('clean', output_file), self.output_data('resumed', output_file))
+        return self.output_files('resumed')
+
+    def test_mgf(self):
+        output_files = self.resumed_run('mgf')
+        self.assertIn('sample_blanka_removed_peaks_data_full.mgf', output_files)
+        self.assertEqual([path for path in output_files if '.part' in path], [])
+
+    def test_binary(self):
+        output_files = self.resumed_run('binary')
+        self.assertIn(os.path.join('sample_blanka_removed_peaks_data', 'mz.npy'), output_files)
+        self.assertEqual([path for path in output_files if '.part' in path], [])
+
+    def rerun_missing_output(self, output_format, output, remove):
+        # completed dataset skipped by the next run unless one of its outputs was removed
+        self.run_lcms('clean', output_format)
+        output = os.path.join(self.work_dir, 'clean', output)
+        os.utime(output, (0, 0))
+        self.run_lcms('clean', output_format)
+        self.assertEqual(os.path.getmtime(output), 0)
+        remove(output)
+        self.run_lcms('clean', output_format)
+        self.assertTrue(os.path.exists(output))
+        self.assertNotEqual(os.path.getmtime(output), 0)
+
+    def test_missing_mgf_output(self):
+        self.rerun_missing_output('mgf', 'sample_blanka_processed_data_full.mgf', os.remove)
+
+    def test_missing_binary_output(self):
+        self.rerun_missing_output('binary', 'sample_blanka_noise_removed_data', shutil.rmtree)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os, sys, shutil, tempfile, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import blanka_watch
+
+# FolderWatcher returns an acquisition once it has settled (and an .mzXML file once it ends with </mzXML>), never
+# returns it twice and stops after idle_timeout seconds without new acquisitions
+
+class FolderWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='blanka_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, data, age=100):
+        # file modified age seconds ago
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'a') as data_file:
+            data_file.write(data)
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_partial_mzxml(self):
+        watcher = blanka_watch.FolderWatcher(self.work_dir, 'lcq', interval=0.05, settle_time=5)
+        mzxml = self.write('sample.mzXML', '<?xml version="1.0"?>\n<mzXML>\n<msRun scanCount="1">\n')
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+        # settled but not written to the end
+        self.write('sample.mzXML', '</msRun>\n</mzXML>\n', age=0)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+        # complete but modified less than settle_time seconds ago
+        os.utime(mzxml, (time.time() - 10, time.time() - 10))
+        self.assertEqual(watcher.poll(), [])
+        # state changed since the previous poll
+        self.assertEqual(watcher.poll(), [mzxml])
+        self.assertEqual(watcher.poll(), [])
+
+    def test_settle_time(self):
+        watcher = blanka_watch.FolderWatcher(self.work_dir, 'lcq', interval=0.05, settle_time=0.5)
+        raw = self.write('sample.RAW', 'raw data', age=0)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+        time.sleep(0.6)
+        self.assertEqual(watcher.poll(), [raw])
+
+    def test_idle_timeout(self):
+        watcher = blanka_watch.FolderWatcher(self.work_dir, 'lcq', interval=0.05, settle_time=0)
+        control = self.write('control.mzXML', '<mzXML>\n</mzXML>\n')
+        watcher.ignore(control)
+        samples = [self.write('sample_1.mzXML', '<mzXML>\n</mzXML>\n'), self.write('sample_2.RAW', 'raw data')]
+        start = time.time()
+        batches = [sorted(batch) for batch in watcher.batches(idle_timeout=0.5)]
+        self.assertEqual(batches, [sorted(samples)])
+        self.assertTrue(0.5 <= time.time() - start < 5)
+        self.assertFalse(watcher.ignore(samples[0]))
+
+if __name__ == '__main__':
+    unittest.main()